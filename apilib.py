@@ -1,45 +1,245 @@
 #! /usr/bin/env python3
-import requests
 import json
+import time
+import itertools
+import zlog
+import zmetrics
+import ztrace
 from datetime import datetime
+from collections import namedtuple
+from functools import lru_cache
+from zratelimit import PRIORITY_WRITE, PRIORITY_LOOKUP, retryAfterSeconds, backoffSeconds
+from zcodec import decodeResponse, encodeRequest, encodeBatch, Template
+
+# HTTP methods that are safe to retry automatically on connection errors or 5xx responses.
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'])
+
+
+@lru_cache(maxsize=None)
+def sessionRetryClass():
+    # Defined on first use so importing apilib does not load requests and urllib3; a client builds its session only when first used.
+    from urllib3.util.retry import Retry
+
+    class SessionRetry(Retry):
+        # 429 is left to the caller so a throttle can pause the shared rate limiter instead of one thread sleeping.
+        RETRY_AFTER_STATUS_CODES = frozenset([413, 503])
+
+    return SessionRetry
+
+
+def buildSession(poolSize=10, retries=3, backoff=0.5):
+    """
+    :param poolSize: Maximum number of keep-alive connections kept per host.
+    :param retries: Number of automatic retries for idempotent requests.
+    :param backoff: Backoff factor in seconds between retries.
+    :return: A requests Session with a pooled, keep-alive adapter mounted for http and https.
+    """
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    retry = sessionRetryClass()(
+        total=retries,
+        backoff_factor=backoff,
+        status_forcelist=(502, 503, 504),
+        allowed_methods=IDEMPOTENT_METHODS,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=poolSize, max_retries=retry)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers['Connection'] = 'keep-alive'
+    return session
+
+
+def requestBytes(response):
+    """
+    :param response: A requests response, or None.
+    :return: Size of the body that was sent for it.
+    """
+    body = response.request.body if response is not None else None
+    return len(body) if body else 0
+
+
+def getSessionStats(session):
+    """
+    :param session: A session created with buildSession.
+    :return: Dictionary with the number of requests sent, connections opened and connections reused.
+    """
+    stats = {'requests': 0, 'connections': 0, 'reused': 0}
+    seen = set()
+    for adapter in session.adapters.values():
+        if id(adapter) in seen:
+            continue
+        seen.add(id(adapter))
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools[key]
+            if pool is None:
+                continue
+            stats['requests'] += pool.num_requests
+            stats['connections'] += pool.num_connections
+    stats['reused'] = max(stats['requests'] - stats['connections'], 0)
+    return stats
+
+
+def pickClosedStatusID(statuses):
+    """
+    :param statuses: List of board status records with 'id' and 'name'.
+    :return: The id of the closed status to use, preferring ">Closed - No Automatic Email" style statuses.
+    """
+    closedID = ""
+    for item in statuses:
+        if item["name"][:7] == ">Closed" and not closedID:
+            closedID = item["id"]
+        # if item["name"] == ">Closed - No Automatic Email":
+        if ">Closed" in item["name"] and "No" in item["name"] and "Email" in item["name"]:
+            closedID = item["id"]
+    return closedID
+
+
+# Fields fetched for companies and tickets when only a compact record is needed.
+COMPANY_FIELDS = 'id,identifier,name,deletedFlag'
+TICKET_FIELDS = 'id,summary,board,status,company'
+
+
+# Immutable, slotted records. namedtuple keeps dataclasses (and inspect) off the import path.
+class CWCompany(namedtuple('CWCompany', 'id identifier name deletedFlag')):
+    __slots__ = ()
+
+    @classmethod
+    def fromJson(cls, record):
+        return cls(record['id'], record.get('identifier', ''), record.get('name', ''), record.get('deletedFlag', False))
+
+
+class CWTicket(namedtuple('CWTicket', 'id summary boardId statusId statusName')):
+    __slots__ = ()
+
+    @classmethod
+    def fromJson(cls, record):
+        board = record.get('board') or {}
+        status = record.get('status') or {}
+        return cls(record['id'], record.get('summary', ''), board.get('id'), status.get('id'), status.get('name', ''))
+
 
 #######################################################################  CONNECTWISE API  ################################################
 class ConnectWiseApi:
 
-    def __init__(self, baseurl, clientid, company, publickey, privatekey, zDebug):
+    def __init__(self, baseurl, clientid, company, publickey, privatekey, zDebug, poolSize=10, timeout=(5, 30), retries=3, limiter=None):
         self.baseurl = baseurl
         self.auth = (str(company) + '+' + str(publickey), str(privatekey))
         self.headers = {'clientID': clientid}
         self.agreementCache = {}
         self.zDebug = zDebug
+        self.timeout = timeout
+        self.retries = retries
+        self.limiter = limiter
+        # Optional zcompanies.CompanyDirectory; when set, the company getters are answered from it.
+        self.companies = None
+        self.throttled = 0
+        self.session = buildSession(poolSize, retries)
+        self.session.headers.update(self.headers)
+        self.session.auth = self.auth
+
+    def _request(self, method, url, **kwargs):
+        # All ConnectWise calls go through the one pooled session so TCP/TLS connections are reused.
+        kwargs.setdefault('timeout', self.timeout)
+        priority = PRIORITY_LOOKUP if method == 'GET' else PRIORITY_WRITE
+        endpointName = zmetrics.endpoint(url[len(self.baseurl):] if url.startswith(self.baseurl) else url)
+        attempt = 0
+        while True:
+            if self.limiter:
+                self.limiter.acquire(priority)
+            started = time.monotonic()
+            response = None
+            with ztrace.span(f'cw {method} {endpointName}') as span:
+                try:
+                    response = self.session.request(method, url, **kwargs)
+                finally:
+                    zmetrics.observeRequest('cw', method, endpointName, time.monotonic() - started, response, requestBytes(response))
+                if span:
+                    span.set(status_code=response.status_code)
+            if response.status_code != 429 or attempt >= self.retries:
+                return response
+            # A 429 means ConnectWise did not process the request, so it is safe to resend any method.
+            delay = retryAfterSeconds(response) or backoffSeconds(attempt)
+            self.throttled += 1
+            zmetrics.apiRetries.inc('cw', endpointName, 'throttled')
+            zlog.warning(f'ConnectWise throttled {method} {url}, retrying in {delay:.1f}s')
+            if self.limiter:
+                self.limiter.penalize(delay)
+            else:
+                time.sleep(delay)
+            attempt += 1
 
-    def _get(self, url, params=None):
+    def _get(self, url, params=None, fields=None):
         if params is None:
             params = {}
-        params['pageSize'] = 1000
-        session = requests.Session()
-        response = session.get(url, params=params, headers=self.headers, auth=self.auth)
-        return response
+        params.setdefault('pageSize', 1000)
+        if fields:
+            # Ask ConnectWise to return only these fields instead of the full objects.
+            params['fields'] = fields if isinstance(fields, str) else ','.join(fields)
+        return self._request('GET', url, params=params)
 
     def _put(self, url, **kwargs):
-        session = requests.Session()
-        response = session.put(url, headers=self.headers, auth=self.auth, **kwargs)
-        return response
+        return self._request('PUT', url, **kwargs)
 
     def _patch(self, url, **kwargs):
-        session = requests.Session()
-        response = session.patch(url, headers=self.headers, auth=self.auth, **kwargs)
-        return response
+        return self._request('PATCH', url, **kwargs)
 
     def _post(self, url, **kwargs):
-        session = requests.Session()
-        response = session.post(url, headers=self.headers, auth=self.auth, **kwargs)
-        return response
+        return self._request('POST', url, **kwargs)
 
     def _delete(self, url, **kwargs):
-        session = requests.Session()
-        response = session.delete(url, headers=self.headers, auth=self.auth, **kwargs)
-        return response
+        return self._request('DELETE', url, **kwargs)
+
+    def iterate(self, path, conditions=None, orderBy=None, pageSize=100, fields=None, limit=None):
+        """
+        Yields records from a ConnectWise list endpoint one page at a time, following pagination.
+        :param path: Endpoint path below the base URL, e.g. '/service/tickets'.
+        :param conditions: Optional ConnectWise conditions string.
+        :param orderBy: Optional orderBy string, e.g. 'id asc'. Use a stable order when paging large results.
+        :param pageSize: Records per request (ConnectWise allows up to 1000).
+        :param fields: Optional comma separated list of fields to return.
+        :param limit: Stop after this many records.
+        :return: Generator of record dictionaries.
+        """
+        url = self.baseurl + path
+        params = {'pageSize': pageSize, 'page': 1}
+        if conditions:
+            params['conditions'] = conditions
+        if orderBy:
+            params['orderBy'] = orderBy
+        if fields:
+            params['fields'] = fields
+        count = 0
+        while True:
+            response = self._get(url, params=dict(params))
+            if response.status_code != 200:
+                raise RuntimeError(f"Failed to get {path} page {params['page']}. HTTP Status Code: {response.status_code}")
+            records = decodeResponse(response)
+            for record in records:
+                yield record
+                count += 1
+                if limit is not None and count >= limit:
+                    return
+            if len(records) < pageSize:
+                return
+            params['page'] += 1
+
+    def getConnectionStats(self):
+        """
+        :return: Dictionary with request, connection and reuse counts for this client's session, plus
+                 the number of throttled (429) responses and seconds spent waiting on the rate limiter.
+        """
+        stats = getSessionStats(self.session)
+        stats['throttled'] = self.throttled
+        stats['rateWait'] = round(self.limiter.waited, 3) if self.limiter else 0
+        return stats
+
+    def close(self):
+        """Close the pooled session and any idle keep-alive connections."""
+        self.session.close()
 
     def getCompanyByIdentifier(self, identifier, **kwargs):
         """
@@ -59,15 +259,20 @@ class ConnectWiseApi:
         :param identifier: A unique identifier, which can be either the ID or the name of the company.
         :return: The company ID if the identifier is found; otherwise, None.
         """
+        if self.companies is not None:
+            company = self.companies.lookup(identifier)
+            return company.id if company else None
         url = self.baseurl + '/company/companies'
         params = {
-            'conditions': f'identifier=\"{identifier}\" OR name=\"{identifier}\"'
+            'conditions': f'identifier=\"{identifier}\" OR name=\"{identifier}\"',
+            'pageSize': 1,
+            'fields': 'id'
         }
         response = self._get(url, params=params)
 
         if response:
             try:
-                companyID = response.json()[0]['id']
+                companyID = decodeResponse(response)[0]['id']
                 return companyID
             except (KeyError, IndexError):
                 return None
@@ -79,25 +284,33 @@ class ConnectWiseApi:
         :param identifier: The unique identifier for the company.
         :return: The company identifier corresponding to the given ID.
         """
+        if self.companies is not None:
+            company = self.companies.lookupId(identifier)
+            if company is not None:
+                return company.identifier
         url = self.baseurl + '/company/companies'
         params = {
-            'conditions': f'id={identifier}'
+            'conditions': f'id={identifier}',
+            'pageSize': 1,
+            'fields': 'identifier'
         }
         response = self._get(url, params=params)
-        companyID = response.json()[0]['identifier']
+        companyID = decodeResponse(response)[0]['identifier']
         return companyID
 
-    def getCompanyByID(self, identifier):
+    def getCompanyByID(self, identifier, fields=None):
         """
         :param identifier: The unique identifier for the company.
+        :param fields: Optional list of fields to return instead of the full company.
         :return: The company identifier corresponding to the given ID.
         """
         url = self.baseurl + '/company/companies'
         params = {
-            'conditions': f'id={identifier}'
+            'conditions': f'id={identifier}',
+            'pageSize': 1
         }
-        response = self._get(url, params=params)
-        companyInfo = response.json()[0]
+        response = self._get(url, params=params, fields=fields)
+        companyInfo = decodeResponse(response)[0]
         return companyInfo
 
     def getCompanyDeletedStatusByID(self, identifier):
@@ -105,14 +318,70 @@ class ConnectWiseApi:
         :param identifier: The unique identifier for the company.
         :return: The company identifier corresponding to the given ID.
         """
+        if self.companies is not None:
+            company = self.companies.lookupId(identifier)
+            if company is not None:
+                return company.deletedFlag
         url = self.baseurl + '/company/companies'
         params = {
-            'conditions': f'id={identifier}'
+            'conditions': f'id={identifier}',
+            'pageSize': 1,
+            'fields': 'deletedFlag'
         }
         response = self._get(url, params=params)
-        companyDeleted = response.json()[0]['deletedFlag']
+        companyDeleted = decodeResponse(response)[0]['deletedFlag']
         return companyDeleted
 
+    def getCompanyRecord(self, identifier):
+        """
+        :param identifier: The company identifier or name.
+        :return: A CWCompany with id, identifier, name and deletedFlag, or None if not found.
+        """
+        if self.companies is not None:
+            return self.companies.lookup(identifier)
+        return self.fetchCompanyRecord(identifier)
+
+    def fetchCompanyRecord(self, identifier):
+        """
+        :param identifier: The company identifier or name.
+        :return: A CWCompany with id, identifier, name and deletedFlag from one projected query, or None if not found.
+        """
+        url = self.baseurl + '/company/companies'
+        params = {
+            'conditions': f'identifier=\"{identifier}\" OR name=\"{identifier}\"',
+            'pageSize': 1
+        }
+        response = self._get(url, params=params, fields=COMPANY_FIELDS)
+        if response.status_code != 200:
+            return None
+        records = decodeResponse(response)
+        return CWCompany.fromJson(records[0]) if records else None
+
+    def getCompanyRecordByID(self, identifier):
+        """
+        :param identifier: The ConnectWise company id.
+        :return: A CWCompany for that id, or None if not found.
+        """
+        if self.companies is not None:
+            return self.companies.lookupId(identifier)
+        return self.fetchCompanyRecordByID(identifier)
+
+    def fetchCompanyRecordByID(self, identifier):
+        """
+        :param identifier: The ConnectWise company id.
+        :return: A CWCompany for that id from one projected query, or None if not found.
+        """
+        url = self.baseurl + '/company/companies'
+        params = {
+            'conditions': f'id={identifier}',
+            'pageSize': 1
+        }
+        response = self._get(url, params=params, fields=COMPANY_FIELDS)
+        if response.status_code != 200:
+            return None
+        records = decodeResponse(response)
+        return CWCompany.fromJson(records[0]) if records else None
+
     def getServiceTicketBoardStatusDefaultStatus(self, boardId, statusName):
         """
         :param boardId: The identifier for the service board.
@@ -121,7 +390,7 @@ class ConnectWiseApi:
         """
         # print(f'boardId: {boardId}  statusName: {statusName}')
         url = self.baseurl + '/service/boards/' + str(boardId) + '/statuses'
-        params = {'conditions': 'name="%s"' % statusName}
+        params = {'conditions': 'name="%s"' % statusName, 'pageSize': 1, 'fields': 'id'}
         response = self._get(url, params=params)
 
         # Check if the HTTP response was successful
@@ -129,7 +398,7 @@ class ConnectWiseApi:
             raise RuntimeError(f"Failed to get service ticket board status. HTTP Status Code: {response.status_code}")
 
         try:
-            jsonResponse = response.json()
+            jsonResponse = decodeResponse(response)
             if not jsonResponse:
                 raise ValueError("Empty JSON response")
             defaultStatus = jsonResponse[0]['id']
@@ -140,32 +409,35 @@ class ConnectWiseApi:
 
         return defaultStatus
 
-    def getServiceTicketBoardIdFromName(self, boardName):
+    def getServiceTicketBoardIdFromName(self, boardName, fields='id,name'):
         """
         :param boardName: The name of the service ticket board to search for
+        :param fields: Fields to return for the board.
         :return: The ID of the service ticket board if found, otherwise None
         """
         url = self.baseurl + '/service/boards'
         params = {
             'conditions': f'name="{boardName}"',
+            'pageSize': 1,
         }
-        response = self._get(url, params=params)
+        response = self._get(url, params=params, fields=fields)
         if response:
             # print(f'response: {response.text}')
             return response
         else:
             return None
 
-    def getServiceTicketBoardIDStatuses(self, boardID):
+    def getServiceTicketBoardIDStatuses(self, boardID, fields='id,name'):
         """
         :param boardID: ID of the service ticket board to fetch statuses for
+        :param fields: Fields to return for each status.
         :return: JSON response containing statuses of the specified service ticket board
         """
         try:
             url = self.baseurl + '/service/boards/%d/statuses' % boardID
-            return self._get(url)
+            return self._get(url, fields=fields)
         except Exception as e:
-            self.zDebug(f'getServiceTicketBoardsStatuses error {e}')
+            zlog.error(f'getServiceTicketBoardsStatuses error {e}')
             exit(0)
 
     def getTicketBoardClosedStatusID(self, boardID):
@@ -174,14 +446,7 @@ class ConnectWiseApi:
         :return: The ID of the closed status for the specified ticket board.
         """
         ticketStatuses = self.getServiceTicketBoardIDStatuses(boardID)
-        closedID = ""
-        for item in ticketStatuses.json():
-            if item["name"][:7] == ">Closed" and not closedID:
-                closedID = item["id"]
-            # if item["name"] == ">Closed - No Automatic Email":
-            if ">Closed" in item["name"] and "No" in item["name"] and "Email" in item["name"]:
-                closedID = item["id"]
-        return closedID
+        return pickClosedStatusID(decodeResponse(ticketStatuses))
 
     def getTicketBoardStatusFromID(self, boardID, statusID):
         """
@@ -208,7 +473,7 @@ class ConnectWiseApi:
         """
 
         url = self.baseurl + '/service/boards/' + str(boardID) + '/statuses'
-        params = {'conditions': 'id=%s' % statusID}
+        params = {'conditions': 'id=%s' % statusID, 'pageSize': 1, 'fields': 'name'}
         response = self._get(url, params=params)
 
         # Check if the HTTP response was successful
@@ -217,10 +482,10 @@ class ConnectWiseApi:
                 f"Failed to get service ticket board status. HTTP Status Code: {response.status_code}")
 
         try:
-            jsonResponse = response.json()
+            jsonResponse = decodeResponse(response)
             if not jsonResponse:
                 raise ValueError("Empty JSON response")
-            defaultStatus = response.json()[0]['name']
+            defaultStatus = jsonResponse[0]['name']
         except ValueError as e:
             raise RuntimeError(f"Failed to parse JSON response: {e}")
         except (KeyError, IndexError) as e:
@@ -236,13 +501,14 @@ class ConnectWiseApi:
         url = self.baseurl + '/service/tickets'
         return self._post(url, json=ticketSummary)
 
-    def getServiceTicketId(self, ticketid):
+    def getServiceTicketId(self, ticketid, fields=None):
         """
         :param ticketid: The unique identifier for the service ticket.
+        :param fields: Optional list of fields to return instead of the full ticket.
         :return: The details of the service ticket retrieved from the specified URL.
         """
         url = self.baseurl + '/service/tickets/%d' % ticketid
-        return self._get(url)
+        return self._get(url, fields=fields)
 
     # def getServiceTicketSearch(self, boardID, messageText):
     #     """
@@ -262,23 +528,32 @@ class ConnectWiseApi:
     #         #print("No Ticket Found")
     #         return None
 
-    def getOpenServiceTicketSearch(self, boardID, messageText):
+    def getOpenServiceTicketSearch(self, boardID, messageText, fields=TICKET_FIELDS):
         """
         :param boardID: The unique identifier of the service board where tickets are searched.
         :param messageText: The text to be searched at the beginning of the ticket summaries.
+        :param fields: Fields to return for each ticket. Pass None for full tickets.
         :return: A list of open service tickets matching the search criteria, or None if no tickets are found.
         """
         url = self.baseurl + '/service/tickets'
         params = {
             'conditions': f'board/id = {boardID} AND summary like "{messageText}%" AND status/name not like ">Closed%"'
         }
-        ticketsFound = self._get(url, params=params).json()
+        ticketsFound = decodeResponse(self._get(url, params=params, fields=fields))
 
         if ticketsFound:
             return ticketsFound
         else:
             return
 
+    def getOpenServiceTicketRecords(self, boardID, messageText):
+        """
+        :param boardID: The unique identifier of the service board where tickets are searched.
+        :param messageText: The text to be searched at the beginning of the ticket summaries.
+        :return: A list of CWTicket records for the matching open tickets.
+        """
+        return [CWTicket.fromJson(ticket) for ticket in self.getOpenServiceTicketSearch(boardID, messageText) or []]
+
     def closeServiceTicketByID(self, ticketID, ticketClosedStatusId):
         """
         :param ticketID: ID of the service ticket to be closed
@@ -322,40 +597,210 @@ class ConnectWiseApi:
         :param messageText: The debug message text to be written to the log file.
         :return: None
         """
-        if self.zDebug:
-            f = open('/tmp/zalert.txt', 'a')
-            f.write(f'{messageText}\n')
-            f.close()
+        # Kept for callers outside zalert; records go through the buffered zlog writer.
+        zlog.debug(messageText)
 
 
 #######################################################################  ZABBIX API #######################################################################
+class ZabbixAPIError(Exception):
+
+    def __init__(self, method, error):
+        self.method = method
+        self.code = error.get('code')
+        self.data = error.get('data')
+        super().__init__(f"Zabbix API error in {method}: {error.get('message')} {self.data or ''}".strip())
+
+
+class ZabbixBatch:
+
+    def __init__(self, zabbix):
+        self.zabbix = zabbix
+        self.calls = []
+        self.methods = {}
+        self.responses = {}
+
+    def add(self, method, params):
+        """
+        :param method: The name of the Zabbix API method to be called.
+        :param params: The parameters to be passed to the Zabbix API method, or bytes from a zcodec Template.
+        :return: The request id used to fetch this call's result after execute().
+        """
+        requestId = self.zabbix.nextRequestId()
+        self.calls.append((method, encodeRequest(method, params, requestId)))
+        self.methods[requestId] = method
+        return requestId
+
+    def execute(self):
+        """
+        Sends all queued calls as one JSON-RPC batch request and stores the responses by id.
+        :return: Dictionary of request id to response envelope.
+        """
+        if not self.calls:
+            return self.responses
+        label, body = self.encode()
+        return self.decode(label, self.zabbix._post(label, body))
+
+    def encode(self):
+        """
+        :return: Tuple of (transport label, JSON body) for the queued calls.
+        """
+        # Only let the transport resend the batch when every call in it is read-only.
+        label = 'batch.get' if all(method.endswith('.get') for method, request in self.calls) else 'batch'
+        return label, encodeBatch([request for method, request in self.calls])
+
+    def decode(self, label, response):
+        """
+        :param label: The transport label returned by encode().
+        :param response: The HTTP response to the batch request.
+        :return: Dictionary of request id to response envelope.
+        """
+        if response.status_code != 200:
+            raise ZabbixAPIError(label, {'code': response.status_code, 'message': 'HTTP error', 'data': response.text})
+        decoded = decodeResponse(response)
+        if isinstance(decoded, dict):
+            # A malformed batch gets a single error object back instead of a list.
+            raise ZabbixAPIError(label, decoded.get('error', {'message': 'Unexpected batch response'}))
+        for item in decoded:
+            self.responses[item.get('id')] = item
+        self.calls = []
+        return self.responses
+
+    def result(self, requestId):
+        """
+        :param requestId: The id returned by add().
+        :return: The 'result' member for that call. Raises ZabbixAPIError if that call failed.
+        """
+        method = self.methods.get(requestId, 'batch')
+        response = self.responses.get(requestId)
+        if response is None:
+            raise ZabbixAPIError(method, {'message': f'No response for request id {requestId}'})
+        if 'error' in response:
+            raise ZabbixAPIError(method, response['error'])
+        return response['result']
+
+
+# Constant params of the hot event lookups, encoded once.
+ALERT_DETAIL = Template({
+    "output": "extend",
+    "selectAcknowledges": "extend"
+})
+EVENT_DETAIL = Template({
+    "selectHosts": "extend",
+    "output": "extend",
+    "select_acknowledges": "extend",
+    "selectTags": "extend",
+    "selectSuppressionData": "extend"
+})
+
+
 class JWZabbix:
 
-    def __init__(self, zURL, zAPIKey, zDebug):
+    def __init__(self, zURL, zAPIKey, zDebug, poolSize=10, timeout=(5, 30), retries=3):
         self.zURL = zURL
         self.zAPIKey = zAPIKey
         self.agreementCache = {}
         self.zDebug = zDebug
+        self.timeout = timeout
+        self.retries = retries
+        self.requestIds = itertools.count(1)
+        self.callCount = 0
+        self.callSeconds = 0.0
+        self.session = buildSession(poolSize, retries)
+        self.session.headers.update({
+            'Content-Type': 'application/json-rpc',
+            'Authorization': f'Bearer {self.zAPIKey}'  # Use the API token for authentication
+        })
+
+    def nextRequestId(self):
+        # itertools.count is atomic, so ids stay unique when pipeline stages share this client across threads.
+        return next(self.requestIds)
+
+    def _post(self, method, body):
+        import requests
+        # Read-only methods are safe to resend if the connection drops; writes are sent once.
+        attempts = self.retries + 1 if method.endswith('.get') else 1
+        started = time.monotonic()
+        try:
+            for attempt in range(attempts):
+                sent = time.monotonic()
+                response = None
+                try:
+                    with ztrace.span(f'zabbix {method}'):
+                        response = self.session.post(self.zURL, data=body, timeout=self.timeout)
+                    return response
+                except requests.exceptions.ConnectionError:
+                    if attempt == attempts - 1:
+                        raise
+                    zmetrics.apiRetries.inc('zabbix', method, 'connection')
+                finally:
+                    zmetrics.observeRequest('zabbix', 'POST', method, time.monotonic() - sent, response, len(body))
+        finally:
+            self.callCount += 1
+            self.callSeconds += time.monotonic() - started
+
+    def batch(self):
+        """
+        :return: A new ZabbixBatch that sends queued calls in one HTTP request.
+        """
+        return ZabbixBatch(self)
 
     def zabbixAPIRequest(self, method, params):
         """
         :param method: The name of the Zabbix API method to be called.
-        :param params: The parameters to be passed to the Zabbix API method.
+        :param params: The parameters to be passed to the Zabbix API method, or bytes from a zcodec Template.
         :return: The JSON response from the Zabbix API.
 
         """
-        headers = {
-            'Content-Type': 'application/json-rpc',
-            'Authorization': f'Bearer {self.zAPIKey}'  # Use the API token for authentication
-        }
-        payload = {
-            'jsonrpc': '2.0',
-            'method': method,
-            'params': params,
-            'id': 1
-        }
-        response = requests.post(self.zURL, headers=headers, data=json.dumps(payload))
-        return response.json()
+        response = self._post(method, encodeRequest(method, params, self.nextRequestId()))
+        if response.status_code != 200:
+            raise ZabbixAPIError(method, {'code': response.status_code, 'message': 'HTTP error', 'data': response.text})
+        return decodeResponse(response)
+
+    def zabbixAPIResult(self, method, params):
+        """
+        :param method: The name of the Zabbix API method to be called.
+        :param params: The parameters to be passed to the Zabbix API method.
+        :return: The 'result' member of the JSON response. Raises ZabbixAPIError if the API returned an error.
+        """
+        response = self.zabbixAPIRequest(method, params)
+        if 'error' in response:
+            raise ZabbixAPIError(method, response['error'])
+        return response['result']
+
+    def getTransportStats(self):
+        """
+        :return: Dictionary with call count, total seconds spent in API calls and connection reuse counts.
+        """
+        stats = getSessionStats(self.session)
+        stats['calls'] = self.callCount
+        stats['seconds'] = round(self.callSeconds, 3)
+        return stats
+
+    def close(self):
+        """Close the pooled session and any idle keep-alive connections."""
+        self.session.close()
+
+    def getEventContext(self, event_id):
+        """
+        :param event_id: The unique identifier of the event to retrieve.
+        :return: Dictionary with the 'alerts', 'event' and 'macros' for the event, fetched in two round trips.
+        """
+        batch = self.batch()
+        alertCall = batch.add('alert.get', ALERT_DETAIL.encode(eventids=event_id))
+        eventCall = batch.add('event.get', EVENT_DETAIL.encode(eventids=event_id))
+        batch.execute()
+
+        try:
+            alerts = batch.result(alertCall)
+        except ZabbixAPIError as e:
+            zlog.error(f'Error: {e}')
+            alerts = None
+        context = {'alerts': alerts, 'event': batch.result(eventCall), 'macros': []}
+
+        # Macros need the host id from the event. The host's company comes from the resolver's host map, not its groups.
+        if context['event'] and context['event'][0]['hosts']:
+            context['macros'] = self.zabbixAPIResult('usermacro.get', {"hostids": context['event'][0]['hosts'][0]['hostid']})
+        return context
 
     def truncateStringMessage(self, s, max_length=100):
 
@@ -370,47 +815,54 @@ class JWZabbix:
         :param event_id: The unique identifier of the event to be retrieved.
         :return: JSON response containing details of the non-active (resolved) event.
         """
-        payload = {
-            "jsonrpc": "2.0",
-            "method": "event.get",
-            "params": {
-                "eventids": event_id,
-                "output": "extend",
-                "value": 1  # 1 indicates resolved events, 0 indicates active events
-            },
-            "id": 2,
-            "auth": self.zAPIKey
-        }
-        headers = {
-            'Content-Type': 'application/json-rpc'
-        }
-        response = requests.post(self.zURL, headers=headers, data=json.dumps(payload))
-        return response.json()
+        return self.zabbixAPIRequest('event.get', {
+            "eventids": event_id,
+            "output": "extend",
+            "value": 1  # 1 indicates resolved events, 0 indicates active events
+        })
 
     def getEventByEventId(self, event_id):
         """
         :param event_id: The unique identifier of the event to retrieve.
         :return: A dictionary containing the event details, including hosts, acknowledges, tags, and suppression data.
         """
-        payload = {
-            "jsonrpc": "2.0",
-            "method": "event.get",
-            "params": {
-                "eventids": event_id,
-                "selectHosts": "extend",
-                "output": "extend",
-                "select_acknowledges": "extend",
-                "selectTags": "extend",
-                "selectSuppressionData": "extend"
-            },
-            "id": 1,
-            "auth": self.zAPIKey
-        }
-        headers = {
-            'Content-Type': 'application/json-rpc'
-        }
-        response = requests.post(self.zURL, headers=headers, data=json.dumps(payload))
-        return response.json()['result']
+        return self.zabbixAPIResult('event.get', EVENT_DETAIL.encode(eventids=event_id))
+
+    def getEventsByIds(self, event_ids, output=("eventid", "r_eventid", "clock", "name")):
+        """
+        :param event_ids: List of event ids to fetch in one call.
+        :param output: Event fields to return.
+        :return: The events found. Events Zabbix no longer has are missing from the result.
+        """
+        return self.zabbixAPIResult('event.get', {
+            "eventids": list(event_ids),
+            "output": list(output)
+        })
+
+    def getAlertsByEvents(self, event_ids):
+        """
+        :param event_ids: List of event ids whose alerts to fetch in one call.
+        :return: The alerts for those events, with their event id and message.
+        """
+        return self.zabbixAPIResult('alert.get', {
+            "eventids": list(event_ids),
+            "output": ["alertid", "eventid", "message"]
+        })
+
+    def getAcknowledgedProblems(self, time_from):
+        """
+        :param time_from: Unix time of the oldest problem event to return.
+        :return: Acknowledged problem events since time_from, with their acknowledges.
+        """
+        return self.zabbixAPIResult('event.get', {
+            "source": 0,
+            "object": 0,
+            "value": 1,
+            "acknowledged": True,
+            "time_from": time_from,
+            "output": ["eventid", "r_eventid", "clock"],
+            "select_acknowledges": ["clock", "message"]
+        })
 
     def addMessageToProblem(self, event_id, action, message):
         """
@@ -420,21 +872,25 @@ class JWZabbix:
         :return: None
         """
         message = self.truncateStringMessage(message, 1000)
-        payload = {
-            'jsonrpc': '2.0',
-            'method': 'event.acknowledge',
-            'params': {
-                'eventids': [event_id],
-                'message': message,
-                'action': action
-            },
-            'auth': self.zAPIKey,
-            'id': 1
-        }
+        return self.zabbixAPIRequest('event.acknowledge', {
+            'eventids': [event_id],
+            'message': message,
+            'action': action
+        })
 
-        response = requests.post(self.zURL, headers={'Content-Type': 'application/json-rpc'}, data=json.dumps(payload))
-        result = response.json()
-        return result
+    def addMessageToProblems(self, event_ids, action, message):
+        """
+        :param event_ids: List of event identifiers that get the same message.
+        :param action: The action type that is being acknowledged.
+        :param message: The message content that needs to be added to the problems.
+        :return: The JSON response from the Zabbix API.
+        """
+        message = self.truncateStringMessage(message, 1000)
+        return self.zabbixAPIRequest('event.acknowledge', {
+            'eventids': list(event_ids),
+            'message': message,
+            'action': action
+        })
 
 
     def getGlobalMacro(self, macro_id):
@@ -443,21 +899,12 @@ class JWZabbix:
         :return: The value of the global macro if found, otherwise None.
         """
         # Get global macros
-        payload = {
-            "jsonrpc": "2.0",
-            "method": "usermacro.get",
-            "params": {
-                "globalmacro": True,  # to get global macros
-            },
-            "auth": self.zAPIKey,
-            "id": 1
-        }
-        response = requests.post(self.zURL, headers={'Content-Type': 'application/json-rpc'}, data=json.dumps(payload))
-        result = response.json()
-        for item in result['result']:
+        result = self.zabbixAPIResult('usermacro.get', {
+            "globalmacro": True,  # to get global macros
+        })
+        for item in result:
             if item['macro'] == macro_id:
                 return item['value']
-                # macro = item['value']
         return None
 
 
@@ -467,21 +914,9 @@ class JWZabbix:
         :return: A list of macros associated with the specified host.
         """
         # Get specific macros from the host.
-        payload = {
-            "jsonrpc": "2.0",
-            "method": "usermacro.get",
-            "params": {
-                "hostids": host_id
-            },
-            "auth": self.zAPIKey,
-            "id": 3
-        }
-
-        response = requests.post(self.zURL, headers={'Content-Type': 'application/json-rpc'}, data=json.dumps(payload))
-        result = response.json()
-
-
-        return result['result']
+        return self.zabbixAPIResult('usermacro.get', {
+            "hostids": host_id
+        })
 
     def getMacroValue(self, json_data, macro_name):
         """
@@ -507,33 +942,10 @@ class JWZabbix:
         :return: The alert details for the specified event if successful; otherwise, None.
         """
         # Get alert details for an event.
-
-        headers = {
-            'Content-Type': 'application/json-rpc'
-        }
-
-        data = {
-            "jsonrpc": "2.0",
-            "method": "alert.get",
-            "params": {
-                "output": "extend",
-                "eventids": event_id,
-                "selectAcknowledges": "extend"
-            },
-            "auth": self.zAPIKey,
-            "id": 1
-        }
-        data = json.dumps(data)
-        response = requests.post(self.zURL, headers=headers, data=data)
-        if response.status_code == 200:
-            result = response.json()
-            if 'result' in result:
-                return result['result']
-            else:
-                self.writeDebugLog(f'No alerts found for the given event ID')
-                return None
-        else:
-            self.writeDebugLog(f'Error: {response.status_code}')
+        try:
+            return self.zabbixAPIResult('alert.get', ALERT_DETAIL.encode(eventids=event_id))
+        except ZabbixAPIError as e:
+            zlog.error(f'Error: {e}')
             return None
 
     def getAlertMessageByEvent(self, event_id):
@@ -542,20 +954,11 @@ class JWZabbix:
         :return: The alert message for the given event ID if available, else None.
         """
         # Get alert details for an event.
-
-        payload = {
-            "jsonrpc": "2.0",
-            "method": "alert.get",
-            "params": {
-                "eventids": event_id,
-                "output": "extend",
-                "selectMediatypes": "extend"
-            },
-            "auth": self.zAPIKey,
-            "id": 3
-        }
-
-        alert_data = requests.post(self.zURL, headers={'Content-Type': 'application/json-rpc'}, data=json.dumps(payload)).json()['result']
+        alert_data = self.zabbixAPIResult('alert.get', {
+            "eventids": event_id,
+            "output": "extend",
+            "selectMediatypes": "extend"
+        })
 
         if alert_data:
             alert_message = json.dumps(alert_data[0]['message'])
@@ -570,101 +973,60 @@ class JWZabbix:
         """
         # Get alert info from alert id. The id will be passed by Zabbix to the script.
         # Not used in code, for debug purposes.
-        headers = {
-            'Content-Type': 'application/json-rpc'
-        }
-
-        data = {
-            "jsonrpc": "2.0",
-            "method": "alert.get",
-            "params": {
+        try:
+            return self.zabbixAPIResult('alert.get', {
                 "alertids": alert_id,
                 "output": "extend",
                 "selectHosts": "extend",
                 "selectTriggers": "extend",
                 "selectEvents": "extend"
-            },
-            "auth": self.zAPIKey,
-            "id": 1
-        }
-
-        response = requests.post(self.zURL, headers=headers, data=json.dumps(data))
-        if response.status_code == 200:
-            result = response.json()
-            if 'result' in result:
-                return result['result']
-            else:
-                print("No such alert found")
-                return None
-        else:
-            print("Error: ", response.status_code)
+            })
+        except ZabbixAPIError as e:
+            print("Error: ", e)
             return None
 
 
     def getAlertDetails(self, alertid):
-        headers = {
-            'Content-Type': 'application/json',
-            'Authorization': f'Bearer {self.zAPIKey}'
-        }
-        payload = {
-            "jsonrpc": "2.0",
-            "method": "alert.get",
-            "params": {
-                "alertids": alertid,
-                "output": "extend",
-                "selectHosts": "extend",
-                "selectTriggers": "extend",
-                "selectEvents": "extend"
-            },
-            "auth": self.zAPIKey,
-            "id": 2
-        }
-        response = requests.post(self.zURL, headers=headers, data=json.dumps(payload))
-        result = response.json()
-        return result['result']
+        return self.zabbixAPIResult('alert.get', {
+            "alertids": alertid,
+            "output": "extend",
+            "selectHosts": "extend",
+            "selectTriggers": "extend",
+            "selectEvents": "extend"
+        })
 
     def getHostCountForGroup(self, groupID):
-        payload = {
-            "jsonrpc": "2.0",
-            "method": "host.get",
-            "params": {
-                "output": ["hostid"],
-                "groupids": groupID,
-                "countOutput": True
-            },
-            "auth": self.zAPIKey,
-            "id": 1
-        }
-        headers = {
-            'Content-Type': 'application/json-rpc'
-        }
-        response = requests.post(self.zURL, headers=headers, data=json.dumps(payload))
-        return response.json()
+        return self.zabbixAPIRequest('host.get', {
+            "output": ["hostid"],
+            "groupids": groupID,
+            "countOutput": True
+        })
 
-    def getGroupsForHost(self, hostid):
-        headers = {
-            "Content-Type": "application/json-rpc",
-            'Authorization': f'Bearer {self.zAPIKey}'
-        }
+    def getTriggerDependencies(self, triggerid):
+        """
+        :param triggerid: The identifier of the trigger.
+        :return: List of trigger ids the trigger depends on.
+        """
+        result = self.zabbixAPIResult('trigger.get', {
+            "triggerids": triggerid,
+            "output": ["triggerid"],
+            "selectDependencies": ["triggerid"]
+        })
+        if not result:
+            return []
+        return [dependency['triggerid'] for dependency in result[0].get('dependencies', [])]
 
-        # Create the payload for retrieving host groups
-        payload = {
-            "jsonrpc": "2.0",
-            "method": "host.get",
-            "params": {
-                "output": ["hostid"],
-                "selectGroups": ["groupid", "name"],
-                "filter": {
-                    "hostid": [
-                        hostid
-                    ]
-                }
-            },
-            "id": 1,
-            "auth": None
-        }
-        response = requests.post(self.zURL, headers=headers, data=json.dumps(payload))
-        data = response.json()
+    def getGroupsForHost(self, hostid):
+        # Retrieve host groups for the host
+        data = self.zabbixAPIRequest('host.get', {
+            "output": ["hostid"],
+            "selectGroups": ["groupid", "name"],
+            "filter": {
+                "hostid": [
+                    hostid
+                ]
+            }
+        })
 
         # Check if the request was successful
         if 'result' in data:
@@ -681,85 +1043,60 @@ class JWZabbix:
 
 
     def getAllHostGroups(self):
-        headers = {
-            'Content-Type': 'application/json',
-            'Authorization': f'Bearer {self.zAPIKey}'
-        }
+        return self.zabbixAPIResult('hostgroup.get', {
+            "output": "extend"
+        })
 
-        payload = {
-            "jsonrpc": "2.0",
-            "method": "hostgroup.get",
-            "params": {
-                "output": "extend"
-            },
-            "id": 1,
-            "auth": None  # Using token-based authentication
-        }
-        response = requests.post(self.zURL, headers=headers, data=json.dumps(payload))
+    def getHostGroupHostCounts(self):
+        """
+        :return: Every host group with its groupid, name and number of hosts, from one hostgroup.get.
+        """
+        return self.zabbixAPIResult('hostgroup.get', {
+            "output": ["groupid", "name"],
+            "selectHosts": "count"
+        })
 
-        if response.status_code == 200:
-            result = response.json()
-            if 'result' in result:
-                return result['result']
-            else:
-                raise ValueError("Invalid response from Zabbix API: 'result' not found")
-        else:
-            raise Exception(f"Failed to retrieve host groups: {response.status_code}, {response.text}")
+    def getHostGroupMembers(self):
+        """
+        :return: Every host group with its groupid, name and the ids of its hosts, from one hostgroup.get.
+        """
+        return self.zabbixAPIResult('hostgroup.get', {
+            "output": ["groupid", "name"],
+            "selectHosts": ["hostid"]
+        })
 
     def getHost(self, hostid):
-        headers = {
-            'Content-Type': 'application/json',
-            'Authorization': f'Bearer {self.zAPIKey}'
-        }
-
-        payload = {
-            "jsonrpc": "2.0",
-            "method": "host.get",
-            "params": {
-                "hostids": hostid,
-                "output": "extend"
-            },
-            "id": 1,
-            "auth": None  # Using token-based authentication
-        }
-        response = requests.post(self.zURL, headers=headers, data=json.dumps(payload))
-
-        if response.status_code == 200:
-            result = response.json()
-            if 'result' in result:
-                return result['result']
-            else:
-                raise ValueError("Invalid response from Zabbix API: 'result' not found")
-        else:
-            raise Exception(f"Failed to retrieve host groups: {response.status_code}, {response.text}")
+        return self.zabbixAPIResult('host.get', {
+            "hostids": hostid,
+            "output": "extend"
+        })
 
     def billingTagCounts(self):
-        headers = {'Content-Type': 'application/json'}
-        payload = {
-            "jsonrpc": "2.0",
-            "method": "host.get",
-            "params": {
-                "output": ["hostid"],
-                'selectTags': 'extend'
-            },
-            "auth": self.zAPIKey,
-            "id": 1
-        }
+        return self.zabbixAPIResult('host.get', {
+            "output": ["hostid"],
+            'selectTags': 'extend'
+        })
 
-        response = requests.post(self.zURL, headers=headers, data=json.dumps(payload))
-        response_json = response.json()
-
-        if 'error' in response_json:
-            raise Exception(f"Zabbix API error: {response_json['error']}")
+    def getHostIds(self):
+        """
+        :return: Sorted list of every host id, the only field fetched.
+        """
+        return sorted((host['hostid'] for host in self.zabbixAPIResult('host.get', {"output": ["hostid"]})), key=int)
 
-        return response_json['result']
+    def iterateHosts(self, params, chunkSize=1000):
+        """
+        Yields hosts in chunks of consecutive host ids, so a large host.get is never held in memory at once.
+        :param params: host.get parameters for each chunk, e.g. output and selectTags.
+        :param chunkSize: Number of hosts fetched per call.
+        :return: Generator of lists of host records.
+        """
+        hostIds = self.getHostIds()
+        for start in range(0, len(hostIds), chunkSize):
+            yield self.zabbixAPIResult('host.get', {**params, "hostids": hostIds[start:start + chunkSize]})
 
 
     def writeDebugLog(self, messageText):
-        if self.zDebug:
-            f = open('/tmp/zalert.txt', 'a')
-            f.write(f'{messageText}\n')
-            f.close()
+        zlog.debug(messageText)
 
 
     def rename_host_group(self, old_group_name, new_group_name):
@@ -769,88 +1106,48 @@ class JWZabbix:
         :param new_group_name: The new name for the host group
         :return: True if the renaming was successful, else False
         """
+        import requests
 
-        # Define the headers and the API endpoint
-        headers = {'Content-Type': 'application/json-rpc'}
-
-        # Step 1: Get the host group ID by the old name
-        get_group_payload = {
-            "jsonrpc": "2.0",
-            "method": "hostgroup.get",
-            "params": {
+        try:
+            # Step 1: Get the host group ID by the old name
+            result = self.zabbixAPIResult('hostgroup.get', {
                 "filter": {
                     "name": old_group_name
                 }
-            },
-            "auth": self.zAPIKey,
-            "id": 1
-        }
-
-        try:
-            response = requests.post(self.zURL, headers=headers, data=json.dumps(get_group_payload))
-            result = response.json()
-
-            if 'error' in result:
-                # Error fetching host group: {result['error']}
-                return False
+            })
 
             # Ensure that the host group exists
-            if len(result['result']) == 0:
+            if len(result) == 0:
                 # Host group '{old_group_name}' not found.
                 return False
 
             # Get the group ID of the old host group
-            group_id = result['result'][0]['groupid']
+            group_id = result[0]['groupid']
 
             # Step 2: Update the host group name
-            update_group_payload = {
-                "jsonrpc": "2.0",
-                "method": "hostgroup.update",
-                "params": {
-                    "groupid": group_id,
-                    "name": new_group_name
-                },
-                "auth": self.zAPIKey,
-                "id": 1
-            }
-
-            update_response = requests.post(self.zURL, headers=headers, data=json.dumps(update_group_payload))
-            update_result = update_response.json()
-
-            if 'error' in update_result:
-                # Error updating host group: {update_result['error']}
-                return False
+            self.zabbixAPIResult('hostgroup.update', {
+                "groupid": group_id,
+                "name": new_group_name
+            })
 
             # Host group '{old_group_name}' renamed to '{new_group_name}' successfully.
             return True
 
-        except requests.exceptions.RequestException:
-            # Request error: {e}
+        except (ZabbixAPIError, requests.exceptions.RequestException):
+            # Error fetching or updating host group
             return False
 
     def getHostTagsByHostId(self, host_id):
         # This function returns all host tags for a named host in Zabbix.
-        headers = {
-            'Content-Type': 'application/json-rpc',
-            'Authorization': f'Bearer {self.zAPIKey}'
-        }
-        tags_request_data = {
-            "jsonrpc": "2.0",
-            "method": "host.get",
-            "params": {
+        try:
+            result = self.zabbixAPIResult('host.get', {
                 "output": ["hostid"],
                 "selectTags": "extend",  # Get all tags for the host
                 "hostids": host_id
-            },
-            "auth": None,
-            "id": 2
-        }
-
-        response = requests.post(self.zURL, headers=headers, json=tags_request_data)
-
-        if response.status_code != 200:
+            })
+        except ZabbixAPIError:
             # "Error retrieving tags for host '{host_id}'.
             return []
         # Parse and return the tags
-        tags = response.json().get('result', [])[0].get('tags', [])
+        tags = result[0].get('tags', [])
         return tags
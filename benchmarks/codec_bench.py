@@ -0,0 +1,76 @@
+#! /usr/bin/env python3
+# Compares the zcodec JSON backend with the standard library on event.get payloads.
+#
+# Usage: python benchmarks/codec_bench.py [recorded.json ...]
+# Each recorded file is a raw event.get response body, e.g. saved from the Zabbix API with
+# curl. Without files a synthetic response shaped like the one getEventContext fetches is used.
+import os
+import sys
+import json
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import zcodec
+from apilib import EVENT_DETAIL
+
+
+def syntheticEventResponse(events=50, acknowledges=20, tags=15):
+    # event.get with selectHosts/select_acknowledges/selectTags/selectSuppressionData: extend.
+    result = []
+    for n in range(events):
+        eventid = str(1000000 + n)
+        result.append({
+            'eventid': eventid, 'source': '0', 'object': '0', 'objectid': str(20000 + n), 'clock': '1718000000', 'ns': '123456789',
+            'r_eventid': '0', 'r_clock': '0', 'r_ns': '0', 'correlationid': '0', 'userid': '0', 'name': f'High CPU utilization on host {n} (over 90% for 5m)',
+            'acknowledged': '1', 'severity': '4', 'suppressed': '0', 'opdata': '', 'urls': [], 'value': '1',
+            'hosts': [{'hostid': str(10500 + n), 'proxy_hostid': '0', 'host': f'web{n:03d}.example.net', 'status': '0', 'name': f'web{n:03d}',
+                       'description': 'Customer web server ' * 4, 'maintenance_status': '0', 'inventory_mode': '1', 'flags': '0'}],
+            'acknowledges': [{'acknowledgeid': str(500000 + n * acknowledges + a), 'userid': '1', 'eventid': eventid, 'clock': str(1718000000 + a),
+                              'message': f'Connectwise ticket created: {90000 + a} — ack note {a} with some operator text', 'action': '4',
+                              'old_severity': '0', 'new_severity': '0', 'suppress_until': '0', 'taskid': '0', 'username': 'Admin',
+                              'name': 'Zabbix', 'surname': 'Administrator'} for a in range(acknowledges)],
+            'tags': [{'tag': f'Tag{t}', 'value': f'value-{t}-{n}'} for t in range(tags)],
+            'suppression_data': [],
+        })
+    return json.dumps({'jsonrpc': '2.0', 'result': result, 'id': 1}).encode()
+
+
+def stdlibRequest(eventId):
+    return json.dumps({'jsonrpc': '2.0', 'method': 'event.get', 'params': {
+        "eventids": eventId,
+        "selectHosts": "extend",
+        "output": "extend",
+        "select_acknowledges": "extend",
+        "selectTags": "extend",
+        "selectSuppressionData": "extend"
+    }, 'id': 1})
+
+
+def codecRequest(eventId):
+    return zcodec.encodeRequest('event.get', EVENT_DETAIL.encode(eventids=eventId), 1)
+
+
+def bench(label, func, number):
+    seconds = min(timeit.repeat(func, number=number, repeat=5)) / number
+    print(f'  {label:<32} {seconds * 1e6:10.1f} us')
+    return seconds
+
+
+def main():
+    payloads = [(path, open(path, 'rb').read()) for path in sys.argv[1:]] or [('synthetic event.get', syntheticEventResponse())]
+    print(f'zcodec backend: {zcodec.BACKEND}')
+    for name, body in payloads:
+        print(f'{name}: {len(body) / 1024:.0f} KiB')
+        number = max(1, 2000000 // len(body))
+        stdlib = bench('decode json.loads', lambda: json.loads(body), number)
+        codec = bench(f'decode zcodec ({zcodec.BACKEND})', lambda: zcodec.loads(body), number)
+        print(f'  decode speedup {stdlib / codec:.1f}x')
+
+    print('event.get request:')
+    stdlib = bench('encode json.dumps dict', lambda: stdlibRequest('1000001'), 20000)
+    codec = bench('encode zcodec template', lambda: codecRequest('1000001'), 20000)
+    print(f'  encode speedup {stdlib / codec:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
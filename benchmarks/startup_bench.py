@@ -0,0 +1,157 @@
+#! /usr/bin/env python3
+# Measures zalert's cold start: import cost and time from process start to the first Zabbix request.
+#
+# Usage: python benchmarks/startup_bench.py [runs]
+# The scripts are copied to a scratch directory with a config that points Zabbix and ConnectWise
+# at a local stub server, so nothing real is contacted. Each run starts a fresh interpreter for
+# an event id and records when its first request reaches the stub. zalertc.py is timed with no
+# daemon listening, so it takes the in-process fallback, and again with zalert.py --daemon
+# running. The output is checked in as benchmarks/startup_report.txt.
+import os
+import sys
+import json
+import glob
+import shutil
+import tempfile
+import threading
+import subprocess
+import statistics
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+repoDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    firstRequest = None
+
+    def do_POST(self):
+        if StubHandler.firstRequest is None:
+            StubHandler.firstRequest = time.perf_counter()
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length)) if length else None
+        # Empty results for every call; the run ends with "no event" after its first request.
+        # ConnectWise GETs (e.g. the daemon's company sync) get an empty list.
+        if body is None:
+            reply = []
+        elif isinstance(body, list):
+            reply = [{'jsonrpc': '2.0', 'result': [], 'id': call['id']} for call in body]
+        else:
+            reply = {'jsonrpc': '2.0', 'result': [], 'id': body['id']}
+        data = json.dumps(reply).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = do_POST
+
+    def log_message(self, format, *args):
+        pass
+
+
+def scratchCopy(scratch, url):
+    for path in glob.glob(os.path.join(repoDir, '*.py')):
+        shutil.copy(path, scratch)
+    with open(os.path.join(repoDir, 'zapiconfig.json')) as cfgfile:
+        config = json.load(cfgfile)
+    for env in ('TestEnv', 'ProdEnv'):
+        config[env].update({'cwBaseurl': url, 'zDebug': 0})
+    config['Global'].update({
+        'zURL': url,
+        'zalertSocket': os.path.join(scratch, 'zalert.sock'),
+        'cwCatalogPath': os.path.join(scratch, 'catalog.db'),
+        'cwTicketIndexPath': os.path.join(scratch, 'tickets.db'),
+        'cwRateLimitPath': os.path.join(scratch, 'ratelimit.db'),
+        'cwOutboxPath': os.path.join(scratch, 'outbox.db'),
+        'companyResolverPath': os.path.join(scratch, 'companies.db'),
+        'cwCompanyDirectoryPath': os.path.join(scratch, 'cwcompanies.db'),
+        'logPath': os.path.join(scratch, 'zalert.jsonl'),
+        'tracePath': os.path.join(scratch, 'traces.jsonl'),
+    })
+    with open(os.path.join(scratch, 'zapiconfig.json'), 'w') as cfgfile:
+        json.dump(config, cfgfile)
+    # Compile once so every timed run loads cached bytecode, as an installed copy would.
+    subprocess.run([sys.executable, '-c', 'import zalert'], cwd=scratch, check=True)
+
+
+def wallTime(args, cwd, runs):
+    times = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        subprocess.run(args, cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append(time.perf_counter() - started)
+    return times
+
+
+def firstRequestTime(args, cwd, runs):
+    times = []
+    for _ in range(runs):
+        StubHandler.firstRequest = None
+        started = time.perf_counter()
+        subprocess.run(args, cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=60)
+        if StubHandler.firstRequest is not None:
+            times.append(StubHandler.firstRequest - started)
+    return times
+
+
+def startDaemon(scratch):
+    daemon = subprocess.Popen([sys.executable, 'zalert.py', '--daemon'], cwd=scratch, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    socketPath = os.path.join(scratch, 'zalert.sock')
+    deadline = time.monotonic() + 10
+    while not os.path.exists(socketPath):
+        if time.monotonic() > deadline:
+            daemon.kill()
+            raise RuntimeError('zalert daemon did not start')
+        time.sleep(0.05)
+    return daemon
+
+
+def report(label, times):
+    print(f'  {label:<40} min {min(times) * 1000:6.1f} ms   median {statistics.median(times) * 1000:6.1f} ms')
+
+
+def importReport(cwd, top=15):
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import zalert'], cwd=cwd, capture_output=True, text=True)
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        selfTime, cumulative, name = line[len('import time:'):].split('|')
+        rows.append((int(cumulative), int(selfTime), name.rstrip()))
+    print(f'-X importtime, import zalert (top {top} by cumulative us):')
+    for cumulative, selfTime, name in sorted(rows, reverse=True)[:top]:
+        print(f'  {cumulative:8d} {selfTime:8d}  {name}')
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_port}'
+    scratch = tempfile.mkdtemp(prefix='zalert_startup_')
+    try:
+        scratchCopy(scratch, url)
+        print(f'Python {sys.version.split()[0]}, {runs} runs each')
+        print('Process wall time:')
+        report('python -c pass', wallTime([sys.executable, '-c', 'pass'], scratch, runs))
+        report('python -c "import requests"', wallTime([sys.executable, '-c', 'import requests'], scratch, runs))
+        report('python -c "import zalert"', wallTime([sys.executable, '-c', 'import zalert'], scratch, runs))
+        print('Time to first Zabbix request:')
+        report('zalertc.py 1000001 (no daemon)', firstRequestTime([sys.executable, 'zalertc.py', '1000001'], scratch, runs))
+        report('zalert.py 1000001', firstRequestTime([sys.executable, 'zalert.py', '1000001'], scratch, runs))
+        daemon = startDaemon(scratch)
+        try:
+            report('zalertc.py 1000001 (daemon running)', firstRequestTime([sys.executable, 'zalertc.py', '1000001'], scratch, runs))
+        finally:
+            daemon.terminate()
+            daemon.wait()
+        importReport(scratch)
+    finally:
+        server.shutdown()
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
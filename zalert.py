@@ -1,54 +1,49 @@
 #!/usr/bin/python3
 # /usr/bin/env python3
 # Written by Joe Whipple <zalert@whipsys.com> 2024
-import os
 import re
 import sys
 import json
-import subprocess
-import traceback
-from apilib import ConnectWiseApi
-from apilib import JWZabbix
+import time
+import threading
+import zlog
+import zmetrics
+import ztrace
+from zconfig import ConfigWatcher, ConfigError, restartNeeded
+from zcontext import AlertContext
+from zpipeline import Pipeline, Stage
 from collections.abc import Sequence
 
 
-# Are we using test or prod Connectwise?
-configEnv = 'TestEnv'
-# configEnv = 'ProdEnv'
-
 # Test event ID to use (valid only if TestEnv is set).
 zabbixTestEventId = '83217509'
 
 # Classes
-class Config(dict):
-
-    # This is the class to load the config file for the API URL and key's
-    def __init__(self, *args, name='zapiconfig.json', **kwargs):
-        self.config = os.path.join(os.path.dirname(os.path.realpath(__file__)), name)
-        super(Config, self).__init__(*args, **kwargs)
+class Deferred:
 
-    def load(self):
-        """load a JSON config file from disk"""
-        try:
-            with open(self.config, 'r') as cfgfile:
-                self.update(json.load(cfgfile))
-        except Exception as e:
-            print(f'Error: {e}')
-            exit(0)
+    # Stands in for an API client or local store and builds it on first use, so a run only pays
+    # for the imports, sessions and database files it actually touches.
+    def __init__(self, factory):
+        object.__setattr__(self, '_deferredFactory', factory)
+        object.__setattr__(self, '_deferredLock', threading.Lock())
+        object.__setattr__(self, '_deferredInstance', None)
 
-    def save(self):
-        with open(self.config, 'w') as cfgfile:
-            cfgfile.write(json.dumps(self))
+    def _deferredResolve(self):
+        instance = self._deferredInstance
+        if instance is None:
+            # Pipeline stages run in threads; only one of them may build the object.
+            with self._deferredLock:
+                instance = self._deferredInstance
+                if instance is None:
+                    instance = self._deferredFactory()
+                    object.__setattr__(self, '_deferredInstance', instance)
+        return instance
 
-    def getValue(self, category, setting):
-        settingdict = self
-        if category:
-            if category in self:
-                settingdict = self[category]
-            else:
-                return None
+    def __getattr__(self, name):
+        return getattr(self._deferredResolve(), name)
 
-        return settingdict[setting] if setting in settingdict else None
+    def __setattr__(self, name, value):
+        setattr(self._deferredResolve(), name, value)
 
 
 def toCWDateTime(pythonDateTime):
@@ -56,41 +51,23 @@ def toCWDateTime(pythonDateTime):
     return pythonDateTime.strftime('%Y-%m-%dT%H:%M:%SZ')
 
 
-def getCompanyForTicket(zabbixEventRecord, companyTagName, companyNameFromHostGroups):
+def getCompanyForTicket(zabbixEventRecord, companyTagName, companyNamePrefixes):
     # Procedure to get company short name. This involves several API's so its placed here.
     # Determine company name to put in ticket:
-    # Try to get company name from the host tags first.
+    # Try to get company name from the event tags first; they come with the event, trigger tags included.
 
-    # cwapi.writeDebugLog(f'Trying to find company from tag name {companyTagName}...')
+    # zlog.debug(f'Trying to find company from tag name {companyTagName}...')
     for tag in zabbixEventRecord[0]['tags']:
         if str.lower(tag['tag']) == companyTagName:
-            cwapi.writeDebugLog(f'Got company from tag value: {tag["tag"]} - {zabbixCWCompany}')
+            zlog.debug(f'Got company from tag value: {tag["tag"]} - {tag["value"]}')
             return tag['value']
 
-    # If no tag, try using the host group
-    if not zabbixCWCompany:
-        # cwapi.writeDebugLog(f'Trying to find company from hostgroups with companyNameFromHostGroups ... in host group name')
-        hostgroups = jwzabbixapi.getGroupsForHost(zabbixEventRecord[0]['hosts'][0]['hostid'])['result'][0]['groups']
-
-        # Parse the string into a Python list
-        companyNamePrefixes = json.loads(
-            companyNameFromHostGroups.replace("'", '"'))  # Handle single quotes for JSON format
-
-        for group in hostgroups:
-            # Check if 'group["name"]' starts with any prefix in companyNamePrefixes
-            if any(group['name'].startswith(prefix) for prefix in companyNamePrefixes):
-                groupmatch = group['name'].split('/')
-                if len(groupmatch) > 1:
-                    cwapi.writeDebugLog(f'Got company from hostgroup: {group["name"]}')
-                    return str.lower(groupmatch[1])
-
-    if not zabbixCWCompany:
+    # If no tag, the resolver's host map has the answer from the host groups: one local lookup,
+    # Zabbix is only asked for a host missing from the map.
+    if not zabbixEventRecord[0].get('hosts'):
         # Company still not found, use hard coded one.
-        # cwapi.writeDebugLog(f'No company found from tag or hostgroup, using default: {defaultCompany}')
-        return defaultCompany
-
-    cwapi.writeDebugLog(f'Fell through company lookup!')
-    return None
+        return settings.defaultCompany
+    return resolver.hostCompany(zabbixEventRecord[0]['hosts'][0]['hostid'], companyTagName, companyNamePrefixes, settings.defaultCompany)
 
 
 def getTagValue(zabbixEventRecord, tagName):
@@ -98,7 +75,7 @@ def getTagValue(zabbixEventRecord, tagName):
     foundTagValue = ""
     for tag in zabbixEventRecord[0]['tags']:
         if tagName.lower() in tag['tag'].lower():
-            # cwapi.writeDebugLog(f"Found tag with a value of {TagName}: {tag['value']}")
+            # zlog.debug(f"Found tag with a value of {TagName}: {tag['value']}")
             foundTagValue = str(tag['value'])
 
     return foundTagValue
@@ -115,21 +92,26 @@ def check_for_ticket_created(ticketSubjectTemplate,eventData):
     for event in eventData:
         for ack in event.get('acknowledges', []):
             if re.search(pattern, ack.get('message', '')):
-                cwapi.writeDebugLog(f"Found match in Zabbix ack message: {ack.get('message', '')}")
+                zlog.debug(f"Found match in Zabbix ack message: {ack.get('message', '')}")
                 return True
     return False
 
 
-def zabbixErrorTicket(errorMsg, area, errorEventID, errorText = ""):
-    # Create a ticket if an error is thrown while the script runs.
-    zabbixErrorEventRecord = jwzabbixapi.getEventByEventId(errorEventID)
+def zabbixErrorTicket(errorMsg, area, errorEventID, errorText = "", alertContext=None):
+    # Create a ticket if an error is thrown while the script runs. Returns the CW ticket id, or None in TestEnv.
+    # This also runs in outbox handlers and the daemon, so it does not exit; the caller decides how to stop.
+    # Reuse anything this alert run already fetched.
+    if alertContext is None:
+        alertContext = AlertContext(errorEventID)
+    zabbixErrorEventRecord = alertContext.call(jwzabbixapi.getEventByEventId, errorEventID)
     zabbixErrorTriggerId = zabbixErrorEventRecord[0]['objectid']
-    errorCWCompanyName = config.getValue("Global", 'zTicketErrorCompany')
-    errorCWCompanyID = cwapi.getCompanyIDbyIdentifier(errorCWCompanyName)
-    errorCWBoardName = config.getValue("Global", 'zTicketErrorCWBoard')
-    errorCWBoardID = cwapi.getServiceTicketBoardIdFromName(errorCWBoardName).json()[0]['id']
-    zabbixCWNewTicketStatusId = cwapi.getServiceTicketBoardStatusDefaultStatus(errorCWBoardID, "Needs Assigned")
+    errorCWCompanyName = settings.zTicketErrorCompany
+    errorCWCompanyID = alertContext.call(cwapi.getCompanyIDbyIdentifier, errorCWCompanyName)
+    errorCWBoardName = settings.zTicketErrorCWBoard
+    errorCWBoardID = catalog.getBoardId(errorCWBoardName)
+    zabbixCWNewTicketStatusId = catalog.getStatusId(errorCWBoardID, "Needs Assigned")
     if errorMsg != "":
+        import traceback
         zabbixTraceback = traceback.extract_tb(errorMsg.__traceback__)
     else:
         zabbixTraceback = "API error"
@@ -153,30 +135,32 @@ def zabbixErrorTicket(errorMsg, area, errorEventID, errorText = ""):
             "id": errorCWCompanyID
         }
     }
-    if configEnv == 'ProdEnv':
-        ticketPost = cwapi.postServiceTicket(ticketErrorTemplate).json()
+    if settings.env == 'ProdEnv':
+        from zcodec import decodeResponse
+        ticketPost = decodeResponse(cwapi.postServiceTicket(ticketErrorTemplate))
         ticketID = ticketPost['id']
-        jwzabbixapi.writeDebugLog(f'**** Error generating CW ticket in zabbix. CW Ticket: {ticketID} created for this error')
+        zlog.error(f'**** Error generating CW ticket in zabbix. CW Ticket: {ticketID} created for this error')
         send_SMS(errorTicketInfo)
-    else:
-        jwzabbixapi.writeDebugLog(f'Testenv, no error ticket.')
-    exit(0)
+        return ticketID
+    zlog.debug(f'Testenv, no error ticket.')
+    return None
 
 def send_SMS(message):
-    smsAlertNumbers = config.getValue("Global", 'scriptErrorAlertSMS')
+    import subprocess
+    smsAlertNumbers = settings.scriptErrorAlertSMS
     if not smsAlertNumbers:
-        cwapi.writeDebugLog("No SMS alert numbers specified. Not sending any SMS text.")
+        zlog.debug("No SMS alert numbers specified. Not sending any SMS text.")
         return
 
     for smsAlertNumber in smsAlertNumbers:
         smsAlertNumber = str(smsAlertNumber)
         try:
             subprocess.run(['/usr/bin/python3', '/usr/lib/zabbix/alertscripts/zabbixsms.py', smsAlertNumber, message], check=True)
-            cwapi.writeDebugLog(f"SMS sent to {smsAlertNumber}")
+            zlog.debug(f"SMS sent to {smsAlertNumber}")
         except subprocess.CalledProcessError as e:
-            cwapi.writeDebugLog(f"Failed to send SMS to {smsAlertNumber}. Error: {e}")
+            zlog.error(f"Failed to send SMS to {smsAlertNumber}. Error: {e}")
         except FileNotFoundError:
-            cwapi.writeDebugLog(f"zabbixsms.py not found or not executable.")
+            zlog.error(f"zabbixsms.py not found or not executable.")
 
 # Return true if the variable has indices, some things like AlertMsgs can have them... or not.
 def has_indices(variable):
@@ -188,312 +172,728 @@ zabbixEventId = ""
 zabbixCWBoard = ""
 zabbixCWBoardId = ""
 
-# Load the API config json file
-config = Config(name='zapiconfig.json')
-config.load()
-
-# Assign variables to config entries for Connectwise API:
-cwbaseurl = config.getValue(configEnv, 'cwBaseurl')
-cwCompany = config.getValue(configEnv, 'cwCompany')
-clientid = config.getValue(configEnv, 'cwClientid')
-cwKey = config.getValue(configEnv, 'cwKey')
-cwSecret = config.getValue(configEnv, 'cwSecret')
-zDebug = config.getValue(configEnv, 'zDebug')
-
-zabbixTicketGenAckMsg = config.getValue(configEnv, 'zabbixTicketGenAckMsg')
-zabbixTicketCloseAckMsg = config.getValue(configEnv, 'zabbixTicketCloseAckMsg')
-
-
-# Grab Global variables from config file:
-zURL = config.getValue("Global", 'zURL')
-zAPIKey = config.getValue("Global", 'zAPIKey')
-defaultCompany = config.getValue("Global", 'companyDefaultValue')   # Default company for tickets
-defaultCWBoard = config.getValue("Global", 'defaultCWBoard')   # Default ticket board for CW tickets.
-companyTagName = str.lower(config.getValue("Global", 'companyTagName'))   # Tag that specifies company name
-companyNameFromHostGroups = config.getValue("Global", 'companyNameFromHostGroups')
-cwBoardTagName = str.lower(config.getValue("Global", 'cwBoardTagName'))   # Tag that specifies ticket board to assign tickets to for event.
-cwDisableTickets = str.lower(config.getValue("Global", 'cwDisableTickets'))
-
-
-# Initialize the API's
-jwzabbixapi = JWZabbix(zURL, zAPIKey, zDebug)
-cwapi = ConnectWiseApi(cwbaseurl, clientid, cwCompany, cwKey, cwSecret, zDebug)
-
-# Start of new instance log.
-cwapi.writeDebugLog(f'\r\n\r\n**************************************************')
-cwapi.writeDebugLog(f'Script execute started, zabbixEventId: {zabbixEventId}')
-
-
-# Pull in the arguments for the script. Check to see if we are missing any and if so put test values in.
-if len(sys.argv) > 1:
-    zabbixEventId = sys.argv[1]
-else:
-    # Only use the test event ID if we are in Test mode.
-    if configEnv == 'TestEnv':
-        zabbixEventId = zabbixTestEventId
-        cwapi.writeDebugLog(f'*** TestEnv enabled, using Event ID: {zabbixEventId} ***')
-    else:
-        # zabbixEventId = zabbixTestEventId  # Only if I super-duper wanna use a test event id in prod (also comment out the exit below)
-        exit(0)
-
-# Gather the details for the alert based off the Event ID. We search specifically for sendto==Connectwise items.
+# Load and compile the API config json file. Which environment (TestEnv or ProdEnv) is used is set by
+# configEnv in its Global section or the ZALERT_ENV environment variable. A broken config stops here,
+# before any alert is handled.
 try:
-    zabbixAlertRecord = jwzabbixapi.getAlertByEvent(zabbixEventId)
-    # print(f"zabbixAlertRecord:\r\n{zabbixAlertRecord}")
-except Exception as e:
-    cwapi.writeDebugLog(f'Exception Error  Failure to get Alert Record. {e}')
-    zabbixErrorTicket(e, "Retrieving zabbixAlertRecord", zabbixEventId, zabbixAlertRecord.text)
-    exit(0)
-
-for event in zabbixAlertRecord:
-    if event['eventid'] == zabbixEventId and event['sendto'] == 'Connectwise':
-        zabbixAlertRecord = event
-        # print(f"event:\r\n{zabbixAlertRecord}")
-
-zabbixEventRecord = jwzabbixapi.getEventByEventId(zabbixEventId)
-zabbixTriggerId = zabbixEventRecord[0]['objectid']
-zabbixHostName = zabbixEventRecord[0]['hosts'][0]['host']
-zabbixHostMacros = json.dumps(jwzabbixapi.getHostMacros(zabbixEventRecord[0]['hosts'][0]['hostid']))
-zabbixHostGroups = jwzabbixapi.getGroupsForHost(zabbixEventRecord[0]['hosts'][0]['hostid'])
-zabbixCWCompany = ""
-zabbixCWBoard = ""
-zabbixEventTags = zabbixEventRecord[0]['tags']
-zabbixTicketAdditionalMsg = ""  # This is a message to add to the ticket because there is an issue with something like the CSN or other field Zalert had problems with.
+    config = ConfigWatcher()
+except ConfigError as e:
+    print(f'Error: {e}')
+    sys.exit(0)
+settings = config.settings
+
 
+def configureLogging():
+    # Log settings apply straight away, including after a config reload.
+    zlog.configure(settings.logPath, settings.logLevel, settings.logMaxBytes, settings.logBackups)
 
-# Check to see if disable ticket tag is present for the host:
-ticketDisabled = any(item['value'] == '1' for item in zabbixEventTags if str.lower(item['tag']) == cwDisableTickets)
-if ticketDisabled:
-    cwapi.writeDebugLog(f'Ticket gen tag {cwDisableTickets} is set to disabled.')
-    jwzabbixapi.addMessageToProblem(zabbixEventId, 4, f"Ticket generation is disabled for this host or trigger! {cwDisableTickets} is set.")
-    cwapi.writeDebugLog(f'No IPP.NoTickets tag found, ticketing is enabled for this host!.')
-    sys.exit(1)
 
+configureLogging()
+# Counters from this process are added to the shared Prometheus textfile when it exits.
+metricsExporter = zmetrics.exportOnExit(settings.metricsTextfile) if settings.metricsTextfile else None
 
-# Ticket board search area
-# Check for tag overridden boards.
-zabbixCWBoard = getTagValue(zabbixEventRecord, cwBoardTagName)
-if len(zabbixCWBoard) > 0:
-    cwapi.writeDebugLog(f"Using tag for defaultCWBoard for ticket.")
-else:
-    # Use default ticket board.
-    zabbixCWBoard = defaultCWBoard
-    cwapi.writeDebugLog(f"Using defaultCWBoard for ticket.")
 
-zabbixCWBoardId = cwapi.getServiceTicketBoardIdFromName(zabbixCWBoard).json()[0]["id"]
+def reloadConfig():
+    # A resident daemon picks up edits to zapiconfig.json between alerts. The new settings replace
+    # the old ones in one assignment; a broken edit is logged and the last good config stays in use.
+    global settings
+    try:
+        changed = config.refresh()
+    except ConfigError as e:
+        zlog.error(f'Config reload failed, keeping the previous config: {e}')
+        return
+    if changed:
+        old, settings = changed
+        configureLogging()
+        zlog.info(f'Config reloaded from {config.path}')
+        stale = restartNeeded(old, settings)
+        if stale:
+            zlog.warning(f'Restart zalert to apply changes to: {", ".join(stale)}', restartFields=stale)
+
+
+def buildZabbixApi():
+    from apilib import JWZabbix
+    return JWZabbix(settings.zURL, settings.zAPIKey, settings.zDebug, settings.apiPoolSize, settings.apiTimeout, settings.apiRetries)
+
+
+def buildCWApi():
+    from apilib import ConnectWiseApi
+    from zratelimit import RateLimiter
+    from zcompanies import CompanyDirectory
+    cwLimiter = RateLimiter(settings.cwRateLimitPath, settings.cwRateLimit, settings.cwRateBurst, settings.cwRateReserve) if settings.cwRateLimit else None
+    api = ConnectWiseApi(settings.cwBaseurl, settings.cwClientid, settings.cwCompany, settings.cwKey, settings.cwSecret, settings.zDebug,
+                         settings.apiPoolSize, settings.apiTimeout, settings.apiRetries, cwLimiter)
+    api.companies = CompanyDirectory(api, settings.cwCompanyDirectoryPath, settings.cwCompanySyncInterval, settings.cwCompanyFullSyncInterval)
+    return api
+
+
+def buildCatalog():
+    from zcatalog import CWCatalog
+    return CWCatalog(cwapi, settings.cwCatalogPath, settings.cwCatalogTTL)
+
+
+def buildTicketIndex():
+    from zindex import TicketIndex
+    return TicketIndex(settings.cwTicketIndexPath)
+
+
+def buildResolver():
+    from zresolver import CompanyResolver
+    return CompanyResolver(cwapi, jwzabbixapi, settings.companyResolverPath, settings.companyResolverTTL,
+                           settings.companyResolverSyncInterval, settings.companyResolverFullSyncInterval)
+
+
+def buildOutbox():
+    from zoutbox import Outbox
+    return Outbox(settings.cwOutboxPath, settings.cwOutboxMaxAttempts, settings.cwOutboxRetryDelay)
+
+
+# Initialize the API's. Each is built on first use, so the first Zabbix request does not wait for
+# the CW session, the rate limiter or the SQLite stores.
+jwzabbixapi = Deferred(buildZabbixApi)
+cwapi = Deferred(buildCWApi)
+catalog = Deferred(buildCatalog)
+ticketIndex = Deferred(buildTicketIndex)
+outbox = Deferred(buildOutbox)
+resolver = Deferred(buildResolver)
+outboxBackground = False   # Set when the daemon's outbox worker sends queued writes.
+
+
+def processEvent(zabbixEventId):
+    # Handle one Zabbix event: create a CW ticket for a new problem or close the ticket for a resolved one.
+    # Returns the id of the CW ticket created, if any.
+    reloadConfig()
+    # Every record logged while handling the event carries its id, and every span joins its trace.
+    with zlog.context(event=zabbixEventId), ztrace.trace(zabbixEventId, settings.tracePath, settings.traceMaxBytes):
+        zlog.info('Event started')
+        started = time.monotonic()
+        outcome = 'error'
+        # API results are memoized for the life of this one event.
+        alertContext = AlertContext(zabbixEventId)
+        try:
+            ticketId = handleEvent(zabbixEventId, alertContext)
+            outcome = 'ticket' if ticketId else 'done'
+            return ticketId
+        except SystemExit as e:
+            # Alerts that need no ticket (acknowledged, disabled, already ticketed) end with sys.exit(0).
+            outcome = 'done' if not e.code else 'error'
+            raise
+        finally:
+            seconds = time.monotonic() - started
+            zmetrics.alertSeconds.observe(seconds, outcome)
+            if zlog.enabled(zlog.DEBUG):
+                zlog.debug('Event API stats', cache=alertContext.stats(), cw=cwapi.getConnectionStats(), zabbix=jwzabbixapi.getTransportStats())
+            zlog.info('Event finished', seconds=round(seconds, 3), outcome=outcome)
+
+
+# Ticket workflow stages. Each stage takes its inputs as keyword arguments and returns its
+# outputs; the pipeline runs independent stages in parallel and skips stages a path doesn't need.
+def stageEventContext(eventId, alertContext):
+    # Gather the details for the alert based off the Event ID. We search specifically for sendto==Connectwise items.
+    # Alerts and event are fetched in one JSON-RPC batch, then the host macros with usermacro.get.
+    try:
+        zabbixEventContext = jwzabbixapi.getEventContext(eventId)
+        zabbixAlertRecord = zabbixEventContext['alerts']
+        # print(f"zabbixAlertRecord:\r\n{zabbixAlertRecord}")
+    except Exception as e:
+        zlog.error(f'Exception Error  Failure to get Alert Record. {e}')
+        zabbixErrorTicket(e, "Retrieving zabbixAlertRecord", eventId, str(e), alertContext=alertContext)
+        sys.exit(0)
+
+    for event in zabbixAlertRecord or []:
+        if event['eventid'] == eventId and event['sendto'] == 'Connectwise':
+            zabbixAlertRecord = event
+            # print(f"event:\r\n{zabbixAlertRecord}")
+
+    alertContext.put(jwzabbixapi.getEventByEventId, zabbixEventContext['event'], eventId)
+    return {
+        'alertRecord': zabbixAlertRecord,
+        'eventRecord': zabbixEventContext['event'],
+        'hostMacros': json.dumps(zabbixEventContext['macros']),
+    }
 
-# Ticket company search area
-# Get company to assign in ticket by looking at tags->hostgroup->default value
-zabbixCWCompany = getCompanyForTicket(zabbixEventRecord, companyTagName, companyNameFromHostGroups)
 
-# Company ID lookup from name:
-# Certain values for company short name could be "CatchAll" which are not in MyACI so we search for them in CW to see if we can match.
-zabbixCWCompanyID = cwapi.getCompanyIDbyIdentifier(zabbixCWCompany)
-if not zabbixCWCompanyID:
-    # Assign company as ChangeMe (default CW company) for ticket.
-    zabbixCWCompanyID = cwapi.getCompanyIDbyIdentifier(defaultCompany)
-    cwapi.writeDebugLog(f'Using default value for CompanyID.')
-    zabbixTicketAdditionalMsg = zabbixTicketAdditionalMsg + "***NOTE:*** The specified company short name for this host " + zabbixCWCompany + " cannot be found.\r\n"
-else:
-    # My Adaptive Cloud company was found and mapped to Connectwise ID.
-    cwapi.writeDebugLog(f'Using company ID from MyACI.')
+def ticketsDisabled(eventRecord):
+    # Check to see if disable ticket tag is present for the host:
+    return any(item['value'] == '1' for item in eventRecord[0]['tags'] if str.lower(item['tag']) == settings.cwDisableTickets)
 
-    if cwapi.getCompanyDeletedStatusByID(zabbixCWCompanyID):
-        cwapi.writeDebugLog(f'Company has been deleted in CW so using default value for CompanyID.')
-        zabbixTicketAdditionalMsg = zabbixTicketAdditionalMsg + "***NOTE:*** The company short name found is deleted in CW so defaulting to " + defaultCompany + " for ticket creation.\r\n"
-        zabbixCWCompanyID = cwapi.getCompanyIDbyIdentifier(defaultCompany)
 
+def stageTicketsEnabled(eventId, eventRecord):
+    if ticketsDisabled(eventRecord):
+        zlog.debug(f'Ticket gen tag {settings.cwDisableTickets} is set to disabled.')
+        jwzabbixapi.addMessageToProblem(eventId, 4, f"Ticket generation is disabled for this host or trigger! {settings.cwDisableTickets} is set.")
+        sys.exit(1)
+    zlog.debug(f'No IPP.NoTickets tag found, ticketing is enabled for this host!.')
+    return True
 
 
-# Get the new ticket status ID in CW to assign this ticket in CW.
-zabbixCWNewTicketStatusId = cwapi.getServiceTicketBoardStatusDefaultStatus(f'{zabbixCWBoardId}', "Needs Assigned")
+def stageBoardName(eventRecord):
+    # Ticket board search area
+    # Check for tag overridden boards.
+    zabbixCWBoard = getTagValue(eventRecord, settings.cwBoardTagName)
+    if len(zabbixCWBoard) > 0:
+        zlog.debug(f"Using tag for defaultCWBoard for ticket.")
+    else:
+        # Use default ticket board.
+        zabbixCWBoard = settings.defaultCWBoard
+        zlog.debug(f"Using defaultCWBoard for ticket.")
+    return zabbixCWBoard
+
+
+def stageBoardId(cwBoard):
+    return catalog.getBoardId(cwBoard)
+
+
+def defaultCompanyId(alertContext=None):
+    # The CW id of the catch-all company, from the resolver's company map.
+    companyRecord = alertContext.call(resolver.company, settings.defaultCompany) if alertContext else resolver.company(settings.defaultCompany)
+    return companyRecord.id if companyRecord else None
+
+
+def stageCompany(eventRecord, alertContext):
+    # Ticket company search area
+    # Get company to assign in ticket by looking at tags->hostgroup->default value
+    zabbixCWCompany = getCompanyForTicket(eventRecord, settings.companyTagName, settings.companyPrefixes)
+    companyNote = ""
+
+    # Company ID lookup from name:
+    # Certain values for company short name could be "CatchAll" which are not in MyACI so we search for them in CW to see if we can match.
+    # The resolver's company map returns the id and the deleted flag together, and only asks CW on a miss.
+    companyRecord = alertContext.call(resolver.company, zabbixCWCompany)
+    zabbixCWCompanyID = companyRecord.id if companyRecord else None
+    if not zabbixCWCompanyID:
+        # Assign company as ChangeMe (default CW company) for ticket.
+        zabbixCWCompanyID = defaultCompanyId(alertContext)
+        zlog.debug(f'Using default value for CompanyID.')
+        companyNote = "***NOTE:*** The specified company short name for this host " + zabbixCWCompany + " cannot be found.\r\n"
+    else:
+        # My Adaptive Cloud company was found and mapped to Connectwise ID.
+        zlog.debug(f'Using company ID from MyACI.')
 
-# Get closed ticket status ID from CW.
-zabbixCWCloseStatusId = cwapi.getTicketBoardClosedStatusID(zabbixCWBoardId)
+        if companyRecord.deletedFlag:
+            zlog.debug(f'Company has been deleted in CW so using default value for CompanyID.')
+            companyNote = "***NOTE:*** The company short name found is deleted in CW so defaulting to " + settings.defaultCompany + " for ticket creation.\r\n"
+            zabbixCWCompanyID = defaultCompanyId(alertContext)
 
-# Pull severity level of problem
-zabbixSeverity = zabbixEventRecord[0]['severity']
+    return {'cwCompany': zabbixCWCompany, 'cwCompanyId': zabbixCWCompanyID, 'companyNote': companyNote}
+
+
+def stageNewStatus(cwBoardId):
+    # Get the new ticket status ID in CW to assign this ticket in CW.
+    return catalog.getStatusId(cwBoardId, "Needs Assigned")
+
+
+def stageCloseStatus(cwBoardId):
+    # Get closed ticket status ID from CW.
+    return catalog.getClosedStatusId(cwBoardId)
+
+
+def stageSubject(eventRecord):
+    hostNote = ""
+    # Get the hostname from Zabbix with the issue.
+    try:
+        hostName = eventRecord[0]['hosts'][0]['host']
+    except Exception as e:
+        zlog.error(f'Exception Error Cant get hostname from event!\r\n{e}')
+        hostNote = "Cannot determine hostname for this event!\r\n"
+        # zabbixErrorTicket("", "Cannot find hostname!", zabbixEventId, "Cannot determine hostname for this error from Zabbix.")
+        hostName = "Unknown"
+
+    # Set the ticket subject for Connectwise:
+    zabbixCWTicketSubject = "Host: " + hostName + " Problem: " + eventRecord[0]['eventid'] + " " + eventRecord[0]['name']
+    # Clean up the error message because quotes mess up the API.
+    zabbixCWTicketSubject = zabbixCWTicketSubject.replace('"', '').replace("'", '')
+    # Connectwise only allows 100 chars in subject, shorten if too long.
+    zabbixCWTicketSubject = jwzabbixapi.truncateStringMessage(zabbixCWTicketSubject)
+    return {'hostName': hostName, 'ticketSubject': zabbixCWTicketSubject, 'hostNote': hostNote}
 
-# Get the hostname from Zabbix with the issue.
-try:
-    hostName = zabbixEventRecord[0]['hosts'][0]['host']
-except Exception as e:
-    cwapi.writeDebugLog(f'Exception Error Cant get hostname from event!\r\n{e}')
-    zabbixTicketAdditionalMsg = zabbixTicketAdditionalMsg + "Cannot determine hostname for this event!\r\n"
-    # zabbixErrorTicket("", "Cannot find hostname!", zabbixEventId, "Cannot determine hostname for this error from Zabbix.")
-    hostName = "Unknown"
-
-# Set the ticket subject for Connectwise:
-zabbixCWTicketSubject = "Host: " + hostName + " Problem: " + zabbixEventRecord[0]['eventid'] + " " + zabbixEventRecord[0]['name']
-zabbixCWTicketSubject = zabbixCWTicketSubject.replace('"', '').replace("'", '')
-zabbixCWTicketSubject = jwzabbixapi.truncateStringMessage(zabbixCWTicketSubject)
-
-if has_indices(zabbixAlertRecord):
-    if zabbixAlertRecord:
-        zabbixTicketDetail = zabbixAlertRecord[0]['message'].replace('NOTE:', '***NOTE:***')
-    else:
-        zabbixTicketDetail = 'No alert record found. \r\n'
-else:
-    zabbixTicketDetail = zabbixAlertRecord['message'].replace('NOTE:', '***NOTE:***')
-zabbixEventLink = 'Zabbix Link: https://monitor.adaptivecloud.com/tr_events.php?triggerid=' + zabbixTriggerId + '&eventid=' + zabbixEventId + '\r\n'
-zabbixTicketDetail = zabbixTicketDetail + zabbixEventLink
-
-# Clean up the error message because quotes mess up the API.
-zabbixCWTicketSubject = zabbixCWTicketSubject.replace('"', '').replace("'", '')
-
-# Connectwise only allows 100 chars in subject, shorten if too long.
-zabbixCWTicketSubject = jwzabbixapi.truncateStringMessage(zabbixCWTicketSubject)
-
-# If there is no CW ticket board specified, do not generate a ticket, just exit.
-if not zabbixCWBoard:
-    cwapi.writeDebugLog('No CW board specified: Cannot/Will not generate a ticket.')
-    jwzabbixapi.addMessageToProblem(zabbixEventId, 4, f"No CW board specified: Cannot/Will not generate a ticket.")
-    exit(0)
-    # No ticket generation because no variables passed.
-
-cwapi.writeDebugLog(f'HOST: {zabbixHostName}  CWBOARD:{zabbixCWBoard} CWCOMPANY:{zabbixCWCompany}\r\nCWTICKETSUBJECT: {zabbixCWTicketSubject}')
-cwapi.writeDebugLog(f'{zabbixEventLink}')
-
-
-##### TICKET GENERATION / RESOLUTION BELOW! #####
-if zabbixEventRecord:
-    for event in zabbixEventRecord:
-        if event['r_eventid'] == "0":  # Only consider current problems
-            cwapi.writeDebugLog("This event is an active problem.")
-
-            # Check to see if Zalert generated a ticket for this by searching the acknowledges in the event.
-            result = check_for_ticket_created(zabbixTicketGenAckMsg, zabbixEventRecord)
-            if result:
-                cwapi.writeDebugLog("Ticket has already generated for this event.")
-
-            else:
-                # Check if problem is acknowledged, don't generate a ticket if it is.
-                if zabbixEventRecord[0]['acknowledged'] == '1':
-                    cwapi.writeDebugLog('Event has been acknowledged. We are not going to generate a ticket for this one.')
-                    jwzabbixapi.addMessageToProblem(zabbixEventId, 4, f'This issue has been acknowledged before ticket creation. No ticket generation will occur.')
-                    exit(0)
-
-                # Ticket does not exist, create one.
-                cwapi.writeDebugLog('No ticket for this event found, creating new ticket')
-                # Connectwise severity mappings to Zabbix:
-                match zabbixSeverity:
-                    case '0':
-                        cwImpact = 'Low'
-                        cwUrgency = 'Low'
-                    case '1':
-                        cwImpact = 'Low'
-                        cwUrgency = 'Low'
-                    case '2':
-                        cwImpact = 'Low'
-                        cwUrgency = 'Medium'
-                    case '3':
-                        cwImpact = 'Medium'
-                        cwUrgency = 'Medium'
-                    case '4':
-                        cwImpact = 'High'
-                        cwUrgency = 'Medium'
-                    case '5':
-                        cwImpact = 'High'
-                        cwUrgency = 'High'
-                    case _:
-                        cwImpact = 'Low'
-                        cwUrgency = 'Low'
-
-                ticketTemplate = {
-                    "summary": zabbixCWTicketSubject,
-                    "recordType": "ServiceTicket",
-                    "severity": cwUrgency,
-                    "impact": cwImpact,
-                    "initialDescription": zabbixTicketAdditionalMsg + zabbixTicketDetail,
-                    "board": {
-                        "id": zabbixCWBoardId,
-                    },
-                    "status": {
-                        "id": zabbixCWNewTicketStatusId,
-                    },
-                    "company": {
-                        "id": zabbixCWCompanyID
-                    }
-                }
-
-                # Ticket submission to CW:
-                try:
-                    # First attempt to create the ticket
-                    # Uncomment out below if you want to test up till it generates a ticket but not create one.
-                    # exit(0)
-                    ticket_response = cwapi.postServiceTicket(ticketTemplate)
-
-                    # Check to see we got a valid status code on the call to CW,
-                    # if it's not 201 then something went wrong.
-                    catchAllCompanyID = cwapi.getCompanyIDbyIdentifier(defaultCompany)
-                    if ticket_response.status_code != 201 and ticketTemplate['company']['id'] != catchAllCompanyID:
-                        # We have an error initially trying to post this ticket. We will try changing the company for the ticket to CatchAll as this is usually the cause of posting new tickets.
-                        cwapi.writeDebugLog(f"Posting this ticket generated an API error: {ticket_response.json()['message']}")
-                        cwapi.writeDebugLog(f"Trying with {defaultCompany} as the company..")
-                        ticketTemplate['company'] = {"id": catchAllCompanyID}
-                        zabbixTicketAdditionalMsg = zabbixTicketAdditionalMsg + "***NOTE*** Original company ID not accepted by CW, trying " + defaultCompany + " instead.\r\n"
-                        ticketTemplate['initialDescription'] = zabbixTicketAdditionalMsg + zabbixTicketDetail
-                        ticket_response = cwapi.postServiceTicket(ticketTemplate)
-                        if ticket_response.status_code != 201:
-                            zabbixErrorTicket("", "Ticket creation error!", zabbixEventId, ticket_response.json()['message'])
-                            exit(1)
-
-                    ticketID = ticket_response.json()['id']
-
-                    # Write a message in the Zabbix event record giving the details of the CW ticket created.
-                    if configEnv == 'TestEnv':
-                        if zabbixTicketAdditionalMsg:
-                            response = jwzabbixapi.addMessageToProblem(zabbixEventId, 4, zabbixTicketAdditionalMsg.replace('***NOTE:***', 'NOTE:'))
-
-                    else:
-                        if zabbixTicketAdditionalMsg:
-                            response = jwzabbixapi.addMessageToProblem(zabbixEventId, 4, zabbixTicketAdditionalMsg.replace('***NOTE:***', 'NOTE:'))
-
-                    # Add message in Zabbix event that we generated a ticket.
-                    cwapi.writeDebugLog(zabbixTicketGenAckMsg.format_map(ticket_response.json()))
-                    response = jwzabbixapi.addMessageToProblem(zabbixEventId, 4, zabbixTicketGenAckMsg.format_map(ticket_response.json()))
-
-                except Exception as e:
-                    cwapi.writeDebugLog(f'Failed to update Zabbix alert msg. Error: {e}')
-                    cwapi.writeDebugLog(f'JSON response: {ticket_response.text}')
-                    zabbixErrorTicket(e, "ticket form submission error", zabbixEventId, ticket_response.text)
 
+def stageDetail(eventId, alertRecord, eventRecord):
+    if has_indices(alertRecord):
+        if alertRecord:
+            zabbixTicketDetail = alertRecord[0]['message'].replace('NOTE:', '***NOTE:***')
+        else:
+            zabbixTicketDetail = 'No alert record found. \r\n'
+    else:
+        zabbixTicketDetail = alertRecord['message'].replace('NOTE:', '***NOTE:***')
+    zabbixEventLink = 'Zabbix Link: https://monitor.adaptivecloud.com/tr_events.php?triggerid=' + eventRecord[0]['objectid'] + '&eventid=' + eventId + '\r\n'
+    return {'ticketDetail': zabbixTicketDetail + zabbixEventLink, 'eventLink': zabbixEventLink}
+
+
+def createQueued(eventId):
+    # True while the ticket for this event is waiting in the outbox.
+    from zoutbox import PENDING, RUNNING
+    return outbox.state(f'createTicket:{eventId}') in (PENDING, RUNNING)
+
+
+def stageTicketCreated(eventId, eventRecord):
+    # The local ticket index answers without a scan; the acknowledges cover tickets created before it existed.
+    if ticketIndex.lookup(eventId):
+        return True
+    if createQueued(eventId):
+        # Without the daemon, Zabbix re-running the event is what replays its queued writes.
+        sendQueued(eventId, f'createTicket:{eventId}')
+        return True
+    return check_for_ticket_created(settings.zabbixTicketGenAckMsg, eventRecord)
+
+
+ticketStages = [
+    Stage('eventContext', stageEventContext, ['eventId', 'alertContext'], ['alertRecord', 'eventRecord', 'hostMacros']),
+    Stage('ticketsEnabled', stageTicketsEnabled, ['eventId', 'eventRecord'], ['ticketsEnabled']),
+    Stage('boardName', stageBoardName, ['eventRecord'], ['cwBoard']),
+    Stage('boardId', stageBoardId, ['cwBoard'], ['cwBoardId']),
+    Stage('company', stageCompany, ['eventRecord', 'alertContext'], ['cwCompany', 'cwCompanyId', 'companyNote']),
+    Stage('newStatus', stageNewStatus, ['cwBoardId'], ['newStatusId']),
+    Stage('closeStatus', stageCloseStatus, ['cwBoardId'], ['closeStatusId']),
+    Stage('subject', stageSubject, ['eventRecord'], ['hostName', 'ticketSubject', 'hostNote']),
+    Stage('detail', stageDetail, ['eventId', 'alertRecord', 'eventRecord'], ['ticketDetail', 'eventLink']),
+    Stage('ticketCreated', stageTicketCreated, ['eventId', 'eventRecord'], ['ticketCreated']),
+]
+
+
+def handleEvent(zabbixEventId, alertContext):
+    values = {'eventId': zabbixEventId, 'alertContext': alertContext}
+    pipeline = Pipeline(ticketStages, maxWorkers=settings.apiPoolSize)
+    try:
+        # The event decides which path we take, so fetch it and check the disabled tag first.
+        pipeline.run(values, ['eventRecord', 'ticketsEnabled', 'cwBoard'])
+
+        # If there is no CW ticket board specified, do not generate a ticket, just exit.
+        if not values['cwBoard']:
+            zlog.debug('No CW board specified: Cannot/Will not generate a ticket.')
+            jwzabbixapi.addMessageToProblem(zabbixEventId, 4, f"No CW board specified: Cannot/Will not generate a ticket.")
+            sys.exit(0)
+            # No ticket generation because no variables passed.
+
+        ##### TICKET GENERATION / RESOLUTION BELOW! #####
+        if not values['eventRecord']:
+            zlog.debug("No event details found.")
+        elif values['eventRecord'][0]['r_eventid'] == "0":  # Only consider current problems
+            return handleProblem(zabbixEventId, alertContext, pipeline, values)
         # Resolved problem, Zabbix will send a new alert on the resolved problems that got sent here, so we look for a ticket to close.
         else:
-            cwapi.writeDebugLog("The event corresponds to a resolved problem, checking to see if there is a ticket to close.")
-
-            # Check to see if Zalert generated a ticket for this by searching the acknowledges in the event.
-            result = check_for_ticket_created(zabbixTicketGenAckMsg, zabbixEventRecord)
-            # Result is True if there is a ticket note found in Zabbix.
-            if not result:
-                cwapi.writeDebugLog("No ticket generated for this event. Exiting.")
-                exit(0)
-
-            searchPattern = r"^.*Problem:\s*\d+"
-            subjectSearch = re.search(searchPattern, zabbixCWTicketSubject).group(0)
-            ticketToClose = cwapi.getOpenServiceTicketSearch(zabbixCWBoardId, subjectSearch)
-
-            # Make sure we actually found a ticket:
-            if not ticketToClose:
-                cwapi.writeDebugLog("No ticket found in CW to close!")
-                jwzabbixapi.addMessageToProblem(zabbixEventId, 4, f'No open ticket to close in CW for this problem.')
-                exit(0)
-            else:
-                # Add a new ticket note saying it has been resolved.
-                cwapi.writeDebugLog('Adding resolution message to ticket.')
-                ticketClosingNote = jwzabbixapi.getAlertByEvent(zabbixEventRecord[0]['r_eventid'])
-                cwapi.addNoteToTicket(ticketToClose[0]["id"], f"{ticketClosingNote[0]['message']}")
-
-                # Close the ticket in CW
-                cwapi.writeDebugLog(f'Trying to close Connectwise ticket: {ticketToClose[0]["id"]}')
-                response = cwapi.closeServiceTicketByID(ticketToClose[0]["id"], zabbixCWCloseStatusId)
-
-                if response.status_code == 200:
-                    jwzabbixapi.addMessageToProblem(zabbixEventId, 4, zabbixTicketCloseAckMsg.format_map(ticketToClose[0]))
-                    cwapi.writeDebugLog(zabbixTicketCloseAckMsg.format_map(ticketToClose[0]))
-                else:
-                    cwapi.writeDebugLog(f'CW Ticket failed to close!\r\nJSON Error:{response.text}')
-else:
-    cwapi.writeDebugLog("No event details found.")
-
-cwapi.writeDebugLog("\r\n")
+            handleResolved(zabbixEventId, alertContext, pipeline, values)
+    finally:
+        zlog.debug('Stage timings', timings=pipeline.timings)
+        eventRecord = values.get('eventRecord')
+        hosts = eventRecord[0].get('hosts') if eventRecord else None
+        ztrace.annotate(host=values.get('hostName') or (hosts[0].get('host') if hosts else None),
+                        board=values.get('cwBoard'), company=values.get('cwCompany'))
+
+
+def handleProblem(zabbixEventId, alertContext, pipeline, values):
+    zlog.debug("This event is an active problem.")
+    zabbixEventRecord = values['eventRecord']
+
+    # Check to see if Zalert generated a ticket for this by searching the acknowledges in the event.
+    pipeline.run(values, ['ticketCreated'])
+    if values['ticketCreated']:
+        zlog.debug("Ticket has already generated for this event.")
+        return
+
+    # Check if problem is acknowledged, don't generate a ticket if it is.
+    if zabbixEventRecord[0]['acknowledged'] == '1':
+        zlog.debug('Event has been acknowledged. We are not going to generate a ticket for this one.')
+        jwzabbixapi.addMessageToProblem(zabbixEventId, 4, f'This issue has been acknowledged before ticket creation. No ticket generation will occur.')
+        sys.exit(0)
+
+    # Board, company, status, subject and detail lookups are independent and run in parallel.
+    pipeline.run(values, ['cwBoardId', 'cwCompanyId', 'newStatusId', 'ticketSubject', 'ticketDetail'])
+    zabbixCWBoardId = values['cwBoardId']
+    zabbixCWCompanyID = values['cwCompanyId']
+    zabbixCWNewTicketStatusId = values['newStatusId']
+    zabbixCWTicketSubject = values['ticketSubject']
+    zabbixTicketDetail = values['ticketDetail']
+    zabbixTicketAdditionalMsg = values['companyNote'] + values['hostNote']  # This is a message to add to the ticket because there is an issue with something like the CSN or other field Zalert had problems with.
+
+    zlog.debug(f'HOST: {values["hostName"]}  CWBOARD:{values["cwBoard"]} CWCOMPANY:{values["cwCompany"]}\r\nCWTICKETSUBJECT: {zabbixCWTicketSubject}')
+    zlog.debug(f'{values["eventLink"]}')
+
+    # Ticket does not exist, create one.
+    zlog.debug('No ticket for this event found, creating new ticket')
+    # Connectwise severity mappings to Zabbix:
+    match zabbixEventRecord[0]['severity']:
+        case '0':
+            cwImpact = 'Low'
+            cwUrgency = 'Low'
+        case '1':
+            cwImpact = 'Low'
+            cwUrgency = 'Low'
+        case '2':
+            cwImpact = 'Low'
+            cwUrgency = 'Medium'
+        case '3':
+            cwImpact = 'Medium'
+            cwUrgency = 'Medium'
+        case '4':
+            cwImpact = 'High'
+            cwUrgency = 'Medium'
+        case '5':
+            cwImpact = 'High'
+            cwUrgency = 'High'
+        case _:
+            cwImpact = 'Low'
+            cwUrgency = 'Low'
+
+    ticketTemplate = {
+        "summary": zabbixCWTicketSubject,
+        "recordType": "ServiceTicket",
+        "severity": cwUrgency,
+        "impact": cwImpact,
+        "initialDescription": zabbixTicketAdditionalMsg + zabbixTicketDetail,
+        "board": {
+            "id": zabbixCWBoardId,
+        },
+        "status": {
+            "id": zabbixCWNewTicketStatusId,
+        },
+        "company": {
+            "id": zabbixCWCompanyID
+        }
+    }
+
+    # Ticket submission to CW goes through the outbox, so a CW outage leaves a queued write instead of a lost ticket.
+    createKey = f'createTicket:{zabbixEventId}'
+    outbox.add(zabbixEventId, 'createTicket', {
+        'ticket': ticketTemplate,
+        'note': zabbixTicketAdditionalMsg,
+        'detail': zabbixTicketDetail,
+    }, key=createKey)
+    return sendQueued(zabbixEventId, createKey)
+
+
+def sendQueued(zabbixEventId, key):
+    # Send this event's queued CW writes now, unless the daemon's outbox worker is sending them.
+    # Returns the result of the write with this key, or the key itself while it is still queued.
+    if outboxBackground:
+        return key
+    results = outboxWorker.drain(zabbixEventId)
+    if results.get(key) is None:
+        zlog.warning(f'CW write {key} is queued in the outbox for retry.')
+    return results.get(key)
+
+
+def applyCreateTicket(payload, action):
+    # Outbox handler: create the CW ticket for a problem event and acknowledge it in Zabbix.
+    zabbixEventId = action['eventId']
+    ticketTemplate = payload['ticket']
+    zabbixTicketAdditionalMsg = payload['note']
+    zabbixTicketDetail = payload['detail']
+
+    ticketID = None
+    if action['attempts']:
+        # An earlier attempt may have created the ticket before failing, so look for it before posting again.
+        indexed = ticketIndex.lookup(zabbixEventId)
+        if indexed:
+            ticketID = indexed['ticketId']
+        else:
+            subjectSearch = re.search(r"^.*Problem:\s*\d+", ticketTemplate['summary'])
+            existing = subjectSearch and cwapi.getOpenServiceTicketSearch(ticketTemplate['board']['id'], subjectSearch.group(0))
+            if existing:
+                ticketID = existing[0]['id']
+                zlog.debug(f'Found ticket {ticketID} from an earlier attempt, not posting again.')
+
+    if ticketID is None:
+        # Uncomment out below if you want to test up till it generates a ticket but not create one.
+        # sys.exit(0)
+        from zcodec import decodeResponse
+        ticket_response = cwapi.postServiceTicket(ticketTemplate)
+        if ticket_response.status_code == 429 or ticket_response.status_code >= 500:
+            raise RuntimeError(f'ConnectWise returned {ticket_response.status_code} creating the ticket')
+
+        # Check to see we got a valid status code on the call to CW,
+        # if it's not 201 then something went wrong.
+        if ticket_response.status_code != 201:
+            catchAllCompanyID = defaultCompanyId()
+            if ticketTemplate['company']['id'] != catchAllCompanyID:
+                # We have an error initially trying to post this ticket. We will try changing the company for the ticket to CatchAll as this is usually the cause of posting new tickets.
+                zlog.warning(f"Posting this ticket generated an API error: {decodeResponse(ticket_response)['message']}")
+                zlog.debug(f"Trying with {settings.defaultCompany} as the company..")
+                ticketTemplate['company'] = {"id": catchAllCompanyID}
+                zabbixTicketAdditionalMsg = zabbixTicketAdditionalMsg + "***NOTE*** Original company ID not accepted by CW, trying " + settings.defaultCompany + " instead.\r\n"
+                ticketTemplate['initialDescription'] = zabbixTicketAdditionalMsg + zabbixTicketDetail
+                ticket_response = cwapi.postServiceTicket(ticketTemplate)
+        if ticket_response.status_code != 201:
+            from zoutbox import ActionFailed
+            errorText = decodeResponse(ticket_response)['message']
+            zabbixErrorTicket("", "Ticket creation error!", zabbixEventId, errorText)
+            # Reported with the error ticket; retrying would post the same rejected ticket again.
+            raise ActionFailed(f'ConnectWise rejected the ticket: {errorText}')
+
+        ticketID = decodeResponse(ticket_response)['id']
+        zmetrics.tickets.inc('created')
+
+    try:
+        ticketIndex.record(zabbixEventId, ticketID, ticketTemplate['board']['id'], ticketTemplate['status']['id'])
+    except Exception as e:
+        # The acknowledge below still records the ticket, so recovery can fall back to the search.
+        zlog.warning(f'Failed to index ticket {ticketID}: {e}')
+
+    # Write a message in the Zabbix event record giving the details of the CW ticket created.
+    if zabbixTicketAdditionalMsg:
+        jwzabbixapi.addMessageToProblem(zabbixEventId, 4, zabbixTicketAdditionalMsg.replace('***NOTE:***', 'NOTE:'))
+
+    # Add message in Zabbix event that we generated a ticket.
+    zlog.info(settings.zabbixTicketGenAckMsg.format_map({'id': ticketID}))
+    jwzabbixapi.addMessageToProblem(zabbixEventId, 4, settings.zabbixTicketGenAckMsg.format_map({'id': ticketID}))
+    return ticketID
+
+
+def applyCloseTicket(payload, action):
+    # Outbox handler: add the resolution note to the CW ticket, close it and acknowledge it in Zabbix.
+    zabbixEventId = action['eventId']
+    ticket = payload['ticket']
+    if not ticket.get('id'):
+        # The close was queued behind the ticket creation, so the ticket id comes from the index now.
+        indexed = ticketIndex.lookup(zabbixEventId)
+        if not indexed:
+            zlog.debug("No ticket found in CW to close!")
+            jwzabbixapi.addMessageToProblem(zabbixEventId, 4, f'No open ticket to close in CW for this problem.')
+            return None
+        ticket['id'] = indexed['ticketId']
+
+    indexed = ticketIndex.lookup(zabbixEventId)
+    if not (indexed and indexed['closed']):
+        # Add a new ticket note saying it has been resolved.
+        zlog.debug('Adding resolution message to ticket.')
+        response = cwapi.addNoteToTicket(ticket["id"], payload['note'])
+        if response.status_code == 429 or response.status_code >= 500:
+            raise RuntimeError(f'ConnectWise returned {response.status_code} adding the resolution note')
+
+        # Close the ticket in CW
+        zlog.debug(f'Trying to close Connectwise ticket: {ticket["id"]}')
+        response = cwapi.closeServiceTicketByID(ticket["id"], payload['closeStatusId'])
+        if response.status_code == 429 or response.status_code >= 500:
+            raise RuntimeError(f'ConnectWise returned {response.status_code} closing the ticket')
+        if response.status_code != 200:
+            zlog.error(f'CW Ticket failed to close!\r\nJSON Error:{response.text}')
+            return None
+        ticketIndex.markClosed(zabbixEventId, payload['closeStatusId'])
+        zmetrics.tickets.inc('closed')
+
+    jwzabbixapi.addMessageToProblem(zabbixEventId, 4, settings.zabbixTicketCloseAckMsg.format_map(ticket))
+    zlog.info(settings.zabbixTicketCloseAckMsg.format_map(ticket))
+    return ticket['id']
+
+
+def outboxFailed(action, error):
+    # Called when a queued CW write has used all its attempts.
+    zabbixErrorTicket(error, f"queued {action['kind']} failed", action['eventId'], str(error))
+
+
+def handleResolved(zabbixEventId, alertContext, pipeline, values):
+    zlog.debug("The event corresponds to a resolved problem, checking to see if there is a ticket to close.")
+    zabbixEventRecord = values['eventRecord']
+
+    # Check to see if Zalert generated a ticket for this by searching the acknowledges in the event.
+    pipeline.run(values, ['ticketCreated'])
+    # Result is True if there is a ticket note found in Zabbix.
+    if not values['ticketCreated']:
+        zlog.debug("No ticket generated for this event. Exiting.")
+        sys.exit(0)
+
+    # Company and new-status lookups are not needed to close a ticket, so they are skipped here.
+    pipeline.run(values, ['cwBoardId', 'closeStatusId', 'ticketSubject'])
+    zabbixCWBoardId = values['cwBoardId']
+    zabbixCWCloseStatusId = values['closeStatusId']
+    zabbixCWTicketSubject = values['ticketSubject']
+
+    zlog.debug(f'HOST: {values["hostName"]}  CWBOARD:{values["cwBoard"]}\r\nCWTICKETSUBJECT: {zabbixCWTicketSubject}')
+
+    indexed = ticketIndex.lookup(zabbixEventId)
+    if indexed and indexed['closed']:
+        zlog.debug(f'Ticket {indexed["ticketId"]} for this event is already closed.')
+        sys.exit(0)
+    if indexed:
+        zlog.debug(f'Found ticket {indexed["ticketId"]} in the local ticket index.')
+        ticketToClose = [{'id': indexed['ticketId'], 'summary': zabbixCWTicketSubject, 'board': {'id': zabbixCWBoardId}}]
+    else:
+        searchPattern = r"^.*Problem:\s*\d+"
+        subjectSearch = re.search(searchPattern, zabbixCWTicketSubject).group(0)
+        ticketToClose = cwapi.getOpenServiceTicketSearch(zabbixCWBoardId, subjectSearch)
+
+    closeKey = f'closeTicket:{zabbixEventId}'
+    if not ticketToClose and createQueued(zabbixEventId):
+        # The ticket is still queued; the close is queued behind it and picks up its id when it is sent.
+        zlog.debug('Ticket creation for this event is still queued, queueing the close behind it.')
+        ticketToClose = [{'id': None, 'summary': zabbixCWTicketSubject}]
+
+    # Make sure we actually found a ticket:
+    if not ticketToClose:
+        zlog.debug("No ticket found in CW to close!")
+        jwzabbixapi.addMessageToProblem(zabbixEventId, 4, f'No open ticket to close in CW for this problem.')
+        sys.exit(0)
+    else:
+        ticketClosingNote = alertContext.call(jwzabbixapi.getAlertByEvent, zabbixEventRecord[0]['r_eventid'])
+        outbox.add(zabbixEventId, 'closeTicket', {
+            'ticket': ticketToClose[0],
+            'note': f"{ticketClosingNote[0]['message']}",
+            'closeStatusId': zabbixCWCloseStatusId,
+        }, key=closeKey)
+        sendQueued(zabbixEventId, closeKey)
+
+
+def stormKey(zabbixEventId):
+    # Grouping key for alert-storm coalescing, or None for events that must be handled on their own.
+    zabbixEventRecord = jwzabbixapi.getEventByEventId(zabbixEventId)
+    if not zabbixEventRecord or zabbixEventRecord[0]['r_eventid'] != "0":
+        return None
+    if zabbixEventRecord[0]['acknowledged'] == '1' or ticketsDisabled(zabbixEventRecord):
+        return None
+    if check_for_ticket_created(settings.zabbixTicketGenAckMsg, zabbixEventRecord):
+        return None
+
+    if settings.coalesceKey == 'company':
+        return 'company', getCompanyForTicket(zabbixEventRecord, settings.companyTagName, settings.companyPrefixes)
+    if settings.coalesceKey == 'trigger':
+        # Events whose triggers depend on the same upstream trigger (e.g. an uplink) belong together.
+        triggerId = zabbixEventRecord[0]['objectid']
+        dependencies = jwzabbixapi.getTriggerDependencies(triggerId)
+        return 'trigger', min(dependencies) if dependencies else triggerId
+    if not zabbixEventRecord[0]['hosts']:
+        return None
+    hostGroups = jwzabbixapi.getGroupsForHost(zabbixEventRecord[0]['hosts'][0]['hostid'])
+    groupNames = sorted(group['name'] for group in hostGroups['result'][0]['groups']) if hostGroups else []
+    return ('hostgroup', groupNames[0]) if groupNames else None
+
+
+def attachToParentTicket(parentEventId, ticketId, childEventIds):
+    # Add the rest of an alert storm to the parent ticket as one note and acknowledge them in one Zabbix call.
+    # Queued behind the parent's ticket creation, so ticketId may still be the outbox key of that write.
+    attachKey = f'attachEvents:{parentEventId}'
+    outbox.add(parentEventId, 'attachEvents', {
+        'ticketId': ticketId if isinstance(ticketId, int) else None,
+        'childEventIds': childEventIds,
+    }, key=attachKey)
+    sendQueued(parentEventId, attachKey)
+
+
+def applyAttachEvents(payload, action):
+    # Outbox handler for attachToParentTicket.
+    parentEventId = action['eventId']
+    childEventIds = payload['childEventIds']
+    ticketId = payload['ticketId']
+    if ticketId is None:
+        indexed = ticketIndex.lookup(parentEventId)
+        if not indexed:
+            raise RuntimeError(f'No ticket indexed for parent event {parentEventId}')
+        ticketId = indexed['ticketId']
+    childEvents = jwzabbixapi.zabbixAPIResult('event.get', {
+        "eventids": childEventIds,
+        "output": ["eventid", "name"],
+        "selectHosts": ["host"]
+    })
+    childLines = [f"Host: {event['hosts'][0]['host'] if event['hosts'] else 'Unknown'} Problem: {event['eventid']} {event['name']}" for event in childEvents]
+    ticketNote = f"Alert storm: {len(childEventIds)} related events grouped under this ticket (parent event {parentEventId}):\r\n" + "\r\n".join(childLines)
+    response = cwapi.addNoteToTicket(ticketId, ticketNote)
+    if response.status_code == 429 or response.status_code >= 500:
+        raise RuntimeError(f'ConnectWise returned {response.status_code} adding the storm note')
+    jwzabbixapi.addMessageToProblems(childEventIds, 4, f'Grouped into CW ticket {ticketId} with event {parentEventId} (alert storm).')
+    zlog.debug(f'Attached {len(childEventIds)} events to CW ticket {ticketId}')
+    return ticketId
+
+
+def buildOutboxWorker():
+    from zoutbox import OutboxWorker
+    return OutboxWorker(outbox, {
+        'createTicket': applyCreateTicket,
+        'closeTicket': applyCloseTicket,
+        'attachEvents': applyAttachEvents,
+    }, zlog.info, outboxFailed, maxWorkers=settings.apiPoolSize)
+
+
+outboxWorker = Deferred(buildOutboxWorker)
+
+
+def profileEvent(zabbixEventId):
+    # Handles one event (for real: tickets are created or closed as usual) under cProfile, then
+    # prints the trace as a waterfall and the functions that took the most time.
+    import cProfile
+    import pstats
+
+    # Pipeline stages and outbox sends run in worker threads; give each new thread its own profiler.
+    profilers = []
+
+    def profileThread(frame, event, arg):
+        profiler = cProfile.Profile()
+        profilers.append(profiler)
+        # Replaces this hook for the rest of the thread.
+        profiler.enable()
+
+    profiler = cProfile.Profile()
+    threading.setprofile(profileThread)
+    profiler.enable()
+    try:
+        processEvent(zabbixEventId)
+    except SystemExit:
+        pass
+    finally:
+        profiler.disable()
+        threading.setprofile(None)
+
+    records = ztrace.lastTrace.records()
+    print(f'Event {zabbixEventId}: {len(records)} spans')
+    print(ztrace.waterfall(records))
+    print()
+    print(f'cProfile, main thread and {len(profilers)} worker threads:')
+    pstats.Stats(profiler, *profilers).sort_stats('tottime').print_stats(25)
+
+
+def main():
+    # Pull in the arguments for the script. Check to see if we are missing any and if so put test values in.
+    if len(sys.argv) > 1 and sys.argv[1] == '--daemon':
+        from zdaemon import ZalertDaemon
+        global outboxBackground
+        # Alerts only queue their CW writes; the worker sends them and retries through CW outages.
+        outboxBackground = True
+        # A resident daemon builds its clients up front so the first alert does not pay for them.
+        for deferred in (jwzabbixapi, cwapi, catalog, ticketIndex, outbox, resolver):
+            deferred._deferredResolve()
+        outboxWorker.start()
+        if metricsExporter:
+            metricsExporter.start(settings.metricsInterval, zlog.warning)
+        if settings.metricsListen:
+            zmetrics.serve(settings.metricsListen, zlog.info)
+        # Keeps the host and company maps synced; config reloads change the rules it uses.
+        resolver.start(lambda: (settings.companyTagName, settings.companyPrefixes, settings.defaultCompany), zlog.info)
+        eventHandler = processEvent
+        if settings.coalesceWindow:
+            from zcoalesce import StormCoalescer
+            eventHandler = StormCoalescer(settings.coalesceWindow, settings.coalesceThreshold, stormKey, processEvent, attachToParentTicket, zlog.info).submit
+        ZalertDaemon(settings.zalertSocket, eventHandler, zlog.info).serve()
+        return
+
+    if len(sys.argv) > 1 and sys.argv[1] == '--profile':
+        # Usage: zalert.py --profile <event id>
+        if len(sys.argv) < 3:
+            print('Usage: zalert.py --profile <event id>')
+            sys.exit(1)
+        profileEvent(sys.argv[2])
+        return
+
+    if len(sys.argv) > 1 and sys.argv[1] == '--reconcile':
+        # Usage: zalert.py --reconcile [--dry-run] [board name ...]
+        from zreconcile import Reconciler
+        args = sys.argv[2:]
+        dryRun = '--dry-run' in args
+        boardNames = [arg for arg in args if arg != '--dry-run'] or settings.reconcileBoards
+        report = Reconciler(cwapi, jwzabbixapi, catalog, outbox, outboxWorker, zlog.info).run(boardNames, dryRun)
+        print(json.dumps(report, indent=2))
+        return
+
+    if len(sys.argv) > 1:
+        zabbixEventId = sys.argv[1]
+    else:
+        # Only use the test event ID if we are in Test mode.
+        if settings.env == 'TestEnv':
+            zabbixEventId = zabbixTestEventId
+            zlog.debug(f'*** TestEnv enabled, using Event ID: {zabbixEventId} ***')
+        else:
+            # zabbixEventId = zabbixTestEventId  # Only if I super-duper wanna use a test event id in prod (also comment out the exit below)
+            sys.exit(0)
+
+    processEvent(zabbixEventId)
+
+
+if __name__ == '__main__':
+    main()
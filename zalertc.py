@@ -0,0 +1,66 @@
+#!/usr/bin/python3
+# Thin Zabbix media type client for the resident zalert daemon (zalert.py --daemon).
+# Sends the event id over the daemon's Unix socket and exits with the daemon's result.
+# If the daemon is not running, falls back to running zalert.py for this event in this process.
+import os
+import sys
+import json
+import socket
+
+# Seconds to wait for the daemon to finish processing the event.
+clientTimeout = 120
+
+
+def getSocketPath():
+    # Read only the socket path from the config so the client stays cheap to start.
+    configFile = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'zapiconfig.json')
+    try:
+        with open(configFile, 'r') as cfgfile:
+            return json.load(cfgfile)['Global'].get('zalertSocket') or '/run/zalert/zalert.sock'
+    except (OSError, ValueError, KeyError):
+        return '/run/zalert/zalert.sock'
+
+
+def runLocally(args):
+    # Import zalert instead of exec'ing it: this skips a second interpreter start, and an imported
+    # module loads from cached bytecode where a script is compiled from source on every run.
+    scriptDir = os.path.dirname(os.path.realpath(__file__))
+    if scriptDir not in sys.path:
+        sys.path.insert(0, scriptDir)
+    sys.argv = [os.path.join(scriptDir, 'zalert.py')] + args
+    import zalert
+    zalert.main()
+    sys.exit(0)
+
+
+def main():
+    if len(sys.argv) < 2:
+        runLocally(sys.argv[1:])
+
+    zabbixEventId = sys.argv[1]
+    client = None
+    try:
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.settimeout(clientTimeout)
+        client.connect(getSocketPath())
+    except OSError:
+        # No daemon: close the socket before handling the event in this process.
+        if client is not None:
+            client.close()
+        runLocally(sys.argv[1:])
+
+    with client:
+        try:
+            client.sendall(f'{zabbixEventId}\n'.encode('utf-8'))
+            reply = client.makefile('r').readline().strip()
+        except OSError as e:
+            reply = f'ERR {e}'
+
+    if reply.startswith('OK'):
+        sys.exit(int(reply.split()[1]))
+    print(reply or 'No reply from zalert daemon')
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,686 @@
+#! /usr/bin/env python3
+# Asyncio counterparts of ConnectWiseApi and JWZabbix with the same method surface.
+# Both share one httpx.AsyncClient so the resident process and batch tools can run many
+# alerts and independent lookups concurrently on one core without threads.
+#
+# Needs the optional httpx package: pip install httpx
+import json
+import time
+import asyncio
+import zlog
+import zmetrics
+import ztrace
+from datetime import datetime
+from apilib import ZabbixAPIError, ZabbixBatch, pickClosedStatusID, CWCompany, CWTicket, COMPANY_FIELDS, TICKET_FIELDS
+from apilib import ALERT_DETAIL, EVENT_DETAIL
+from zcodec import decodeResponse, encodeRequest
+from zratelimit import PRIORITY_WRITE, PRIORITY_LOOKUP, retryAfterSeconds, backoffSeconds
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+
+def buildAsyncClient(poolSize=10, timeout=(5, 30), retries=3):
+    """
+    :param poolSize: Maximum number of keep-alive connections kept open.
+    :param timeout: Tuple of connect and read timeout in seconds.
+    :param retries: Number of retries when a connection cannot be established.
+    :return: An httpx.AsyncClient to share between AsyncConnectWiseApi and AsyncJWZabbix.
+    """
+    if httpx is None:
+        raise RuntimeError('The async API clients need the httpx package: pip install httpx')
+    return httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=poolSize, max_keepalive_connections=poolSize),
+        timeout=httpx.Timeout(timeout[1], connect=timeout[0]),
+        transport=httpx.AsyncHTTPTransport(retries=retries),
+    )
+
+
+
+def buildAsyncApis(settings, client=None, companies=None):
+    """
+    :param settings: A zconfig Settings, e.g. zalert.settings.
+    :param client: The httpx.AsyncClient to share; one is built from the settings if not given.
+    :param companies: Optional zcompanies.CompanyDirectory to answer company lookups from, e.g. zalert.cwapi.companies.
+    :return: Tuple of AsyncConnectWiseApi and AsyncJWZabbix. The ConnectWise client takes its tokens from the same
+             rate limit file as the blocking client, so both count against one budget.
+    """
+    from zratelimit import RateLimiter
+    if client is None:
+        client = buildAsyncClient(settings.apiPoolSize, settings.apiTimeout, settings.apiRetries)
+    cwLimiter = RateLimiter(settings.cwRateLimitPath, settings.cwRateLimit, settings.cwRateBurst, settings.cwRateReserve) if settings.cwRateLimit else None
+    cwapi = AsyncConnectWiseApi(settings.cwBaseurl, settings.cwClientid, settings.cwCompany, settings.cwKey, settings.cwSecret, settings.zDebug,
+                                client, cwLimiter, settings.apiRetries)
+    cwapi.companies = companies
+    zabbix = AsyncJWZabbix(settings.zURL, settings.zAPIKey, settings.zDebug, client, settings.apiRetries)
+    return cwapi, zabbix
+
+#######################################################################  CONNECTWISE API  ################################################
+class AsyncConnectWiseApi:
+
+    def __init__(self, baseurl, clientid, company, publickey, privatekey, zDebug, client, limiter=None, retries=3):
+        self.baseurl = baseurl
+        self.auth = (str(company) + '+' + str(publickey), str(privatekey))
+        self.headers = {'clientID': clientid}
+        self.agreementCache = {}
+        self.zDebug = zDebug
+        self.client = client
+        self.limiter = limiter
+        self.retries = retries
+        self.throttled = 0
+        # Optional zcompanies.CompanyDirectory; its lookups are blocking SQLite reads, so they run off the event loop.
+        self.companies = None
+
+    async def _request(self, method, url, **kwargs):
+        priority = PRIORITY_LOOKUP if method == 'GET' else PRIORITY_WRITE
+        endpointName = zmetrics.endpoint(url[len(self.baseurl):] if url.startswith(self.baseurl) else url)
+        attempt = 0
+        while True:
+            if self.limiter:
+                # The shared bucket is file based, so wait for it off the event loop.
+                await asyncio.to_thread(self.limiter.acquire, priority)
+            started = time.monotonic()
+            response = None
+            with ztrace.span(f'cw {method} {endpointName}') as span:
+                try:
+                    response = await self.client.request(method, url, headers=self.headers, auth=self.auth, **kwargs)
+                finally:
+                    zmetrics.observeRequest('cw', method, endpointName, time.monotonic() - started, response,
+                                            len(response.request.content) if response is not None else 0)
+                if span:
+                    span.set(status_code=response.status_code)
+            if response.status_code != 429 or attempt >= self.retries:
+                return response
+            delay = retryAfterSeconds(response) or backoffSeconds(attempt)
+            self.throttled += 1
+            zmetrics.apiRetries.inc('cw', endpointName, 'throttled')
+            zlog.warning(f'ConnectWise throttled {method} {url}, retrying in {delay:.1f}s')
+            if self.limiter:
+                await asyncio.to_thread(self.limiter.penalize, delay)
+            else:
+                await asyncio.sleep(delay)
+            attempt += 1
+
+    async def _get(self, url, params=None, fields=None):
+        if params is None:
+            params = {}
+        params.setdefault('pageSize', 1000)
+        if fields:
+            params['fields'] = fields if isinstance(fields, str) else ','.join(fields)
+        return await self._request('GET', url, params=params)
+
+    async def iterate(self, path, conditions=None, orderBy=None, pageSize=100, fields=None, limit=None):
+        # Async generator counterpart of ConnectWiseApi.iterate.
+        url = self.baseurl + path
+        params = {'pageSize': pageSize, 'page': 1}
+        if conditions:
+            params['conditions'] = conditions
+        if orderBy:
+            params['orderBy'] = orderBy
+        if fields:
+            params['fields'] = fields
+        count = 0
+        while True:
+            response = await self._get(url, params=dict(params))
+            if response.status_code != 200:
+                raise RuntimeError(f"Failed to get {path} page {params['page']}. HTTP Status Code: {response.status_code}")
+            records = decodeResponse(response)
+            for record in records:
+                yield record
+                count += 1
+                if limit is not None and count >= limit:
+                    return
+            if len(records) < pageSize:
+                return
+            params['page'] += 1
+
+    def getConnectionStats(self):
+        # The shared httpx client keeps no per-API connection counts, so only the throttling figures are reported.
+        return {'throttled': self.throttled, 'rateWait': round(self.limiter.waited, 3) if self.limiter else 0}
+
+    async def _put(self, url, **kwargs):
+        return await self._request('PUT', url, **kwargs)
+
+    async def _patch(self, url, **kwargs):
+        return await self._request('PATCH', url, **kwargs)
+
+    async def _post(self, url, **kwargs):
+        return await self._request('POST', url, **kwargs)
+
+    async def _delete(self, url, **kwargs):
+        return await self._request('DELETE', url, **kwargs)
+
+    async def getCompanyByIdentifier(self, identifier, **kwargs):
+        url = self.baseurl + '/company/companies'
+        params = {
+            'conditions': 'identifier=\"%s\"' % identifier,
+            **kwargs,
+        }
+        return await self._get(url, params=params)
+
+    async def getCompanyIDbyIdentifier(self, identifier):
+        if self.companies is not None:
+            company = await asyncio.to_thread(self.companies.lookup, identifier)
+            return company.id if company else None
+        url = self.baseurl + '/company/companies'
+        params = {
+            'conditions': f'identifier=\"{identifier}\" OR name=\"{identifier}\"',
+            'pageSize': 1
+        }
+        response = await self._get(url, params=params, fields='id')
+
+        if response.is_success:
+            try:
+                return decodeResponse(response)[0]['id']
+            except (KeyError, IndexError):
+                return None
+        else:
+            return None
+
+    async def getCompanyIdentifierByID(self, identifier):
+        if self.companies is not None:
+            company = await asyncio.to_thread(self.companies.lookupId, identifier)
+            if company is not None:
+                return company.identifier
+        url = self.baseurl + '/company/companies'
+        response = await self._get(url, params={'conditions': f'id={identifier}', 'pageSize': 1}, fields='identifier')
+        return decodeResponse(response)[0]['identifier']
+
+    async def getCompanyByID(self, identifier, fields=None):
+        url = self.baseurl + '/company/companies'
+        response = await self._get(url, params={'conditions': f'id={identifier}', 'pageSize': 1}, fields=fields)
+        return decodeResponse(response)[0]
+
+    async def getCompanyDeletedStatusByID(self, identifier):
+        if self.companies is not None:
+            company = await asyncio.to_thread(self.companies.lookupId, identifier)
+            if company is not None:
+                return company.deletedFlag
+        url = self.baseurl + '/company/companies'
+        response = await self._get(url, params={'conditions': f'id={identifier}', 'pageSize': 1}, fields='deletedFlag')
+        return decodeResponse(response)[0]['deletedFlag']
+
+    async def getCompanyRecord(self, identifier):
+        if self.companies is not None:
+            return await asyncio.to_thread(self.companies.lookup, identifier)
+        return await self.fetchCompanyRecord(identifier)
+
+    async def fetchCompanyRecord(self, identifier):
+        url = self.baseurl + '/company/companies'
+        params = {
+            'conditions': f'identifier=\"{identifier}\" OR name=\"{identifier}\"',
+            'pageSize': 1
+        }
+        response = await self._get(url, params=params, fields=COMPANY_FIELDS)
+        if not response.is_success:
+            return None
+        records = decodeResponse(response)
+        return CWCompany.fromJson(records[0]) if records else None
+
+    async def getCompanyRecordByID(self, identifier):
+        if self.companies is not None:
+            return await asyncio.to_thread(self.companies.lookupId, identifier)
+        return await self.fetchCompanyRecordByID(identifier)
+
+    async def fetchCompanyRecordByID(self, identifier):
+        url = self.baseurl + '/company/companies'
+        response = await self._get(url, params={'conditions': f'id={identifier}', 'pageSize': 1}, fields=COMPANY_FIELDS)
+        if not response.is_success:
+            return None
+        records = decodeResponse(response)
+        return CWCompany.fromJson(records[0]) if records else None
+
+    async def getServiceTicketBoardStatusDefaultStatus(self, boardId, statusName):
+        url = self.baseurl + '/service/boards/' + str(boardId) + '/statuses'
+        response = await self._get(url, params={'conditions': 'name="%s"' % statusName, 'pageSize': 1}, fields='id')
+
+        # Check if the HTTP response was successful
+        if response.status_code != 200:
+            raise RuntimeError(f"Failed to get service ticket board status. HTTP Status Code: {response.status_code}")
+
+        try:
+            jsonResponse = decodeResponse(response)
+            if not jsonResponse:
+                raise ValueError("Empty JSON response")
+            return jsonResponse[0]['id']
+        except ValueError as e:
+            raise RuntimeError(f"Failed to parse JSON response: {e}")
+        except (KeyError, IndexError) as e:
+            raise RuntimeError(f"Expected key not found in JSON response: {e}")
+
+    async def getServiceTicketBoardIdFromName(self, boardName, fields='id,name'):
+        url = self.baseurl + '/service/boards'
+        response = await self._get(url, params={'conditions': f'name="{boardName}"', 'pageSize': 1}, fields=fields)
+        if response.is_success:
+            return response
+        else:
+            return None
+
+    async def getServiceTicketBoardIDStatuses(self, boardID, fields='id,name'):
+        url = self.baseurl + '/service/boards/%d/statuses' % boardID
+        try:
+            return await self._get(url, fields=fields)
+        except Exception as e:
+            # The blocking client exits here; in a shared event loop we only fail this lookup.
+            zlog.error(f'getServiceTicketBoardsStatuses error {e}')
+            raise
+
+    async def getTicketBoardClosedStatusID(self, boardID):
+        ticketStatuses = await self.getServiceTicketBoardIDStatuses(boardID)
+        return pickClosedStatusID(decodeResponse(ticketStatuses))
+
+    async def getTicketBoardStatusFromID(self, boardID, statusID):
+        url = self.baseurl + '/service/boards/' + str(boardID) + '/statuses'
+        response = await self._get(url, params={'conditions': 'id=%s' % statusID, 'pageSize': 1}, fields='name')
+
+        # Check if the HTTP response was successful
+        if response.status_code != 200:
+            raise RuntimeError(
+                f"Failed to get service ticket board status. HTTP Status Code: {response.status_code}")
+
+        try:
+            jsonResponse = decodeResponse(response)
+            if not jsonResponse:
+                raise ValueError("Empty JSON response")
+            return jsonResponse[0]['name']
+        except ValueError as e:
+            raise RuntimeError(f"Failed to parse JSON response: {e}")
+        except (KeyError, IndexError) as e:
+            raise RuntimeError(f"Expected key not found in JSON response: {e}")
+
+    async def postServiceTicket(self, ticketSummary):
+        url = self.baseurl + '/service/tickets'
+        return await self._post(url, json=ticketSummary)
+
+    async def getServiceTicketId(self, ticketid, fields=None):
+        url = self.baseurl + '/service/tickets/%d' % ticketid
+        return await self._get(url, fields=fields)
+
+    async def getOpenServiceTicketSearch(self, boardID, messageText, fields=TICKET_FIELDS):
+        url = self.baseurl + '/service/tickets'
+        params = {
+            'conditions': f'board/id = {boardID} AND summary like "{messageText}%" AND status/name not like ">Closed%"'
+        }
+        ticketsFound = decodeResponse(await self._get(url, params=params, fields=fields))
+
+        if ticketsFound:
+            return ticketsFound
+        else:
+            return
+
+    async def getOpenServiceTicketRecords(self, boardID, messageText):
+        return [CWTicket.fromJson(ticket) for ticket in await self.getOpenServiceTicketSearch(boardID, messageText) or []]
+
+    async def closeServiceTicketByID(self, ticketID, ticketClosedStatusId):
+        ticketPatch = [{
+            'op': 'replace',
+            'path': 'status/id',
+            'value': ticketClosedStatusId,
+        }]
+        url = self.baseurl + '/service/tickets/%d' % ticketID
+        return await self._patch(url, json=ticketPatch)
+
+    async def addNoteToTicket(self, ticketId, ticketNote, internalFlag=True):
+        url = f'{self.baseurl}/service/tickets/{ticketId}/notes'
+
+        payload = {
+            "text": ticketNote,
+            "ticketId": ticketId,
+            "internalFlag": internalFlag,
+            "detailDescriptionFlag": True,
+            "internalAnalysisFlag": False,
+            "resolutionFlag": False,
+            "issueFlag": False,
+            "dateCreated": datetime.now().isoformat(),
+            "createdBy": "zabbix"
+        }
+        return await self._post(url, json=payload)
+
+    def writeDebugLog(self, messageText):
+        zlog.debug(messageText)
+
+
+#######################################################################  ZABBIX API #######################################################################
+class AsyncZabbixBatch(ZabbixBatch):
+
+    async def execute(self):
+        """
+        Sends all queued calls as one JSON-RPC batch request and stores the responses by id.
+        :return: Dictionary of request id to response envelope.
+        """
+        if not self.calls:
+            return self.responses
+        label, body = self.encode()
+        return self.decode(label, await self.zabbix._post(label, body))
+
+
+class AsyncJWZabbix:
+
+    def __init__(self, zURL, zAPIKey, zDebug, client, retries=3):
+        self.zURL = zURL
+        self.zAPIKey = zAPIKey
+        self.agreementCache = {}
+        self.zDebug = zDebug
+        self.client = client
+        self.retries = retries
+        self.requestId = 0
+        self.callCount = 0
+        self.callSeconds = 0.0
+        self.headers = {
+            'Content-Type': 'application/json-rpc',
+            'Authorization': f'Bearer {self.zAPIKey}'  # Use the API token for authentication
+        }
+
+    def nextRequestId(self):
+        self.requestId += 1
+        return self.requestId
+
+    async def _post(self, method, body):
+        # Read-only methods are safe to resend if the connection drops; writes are sent once.
+        attempts = self.retries + 1 if method.endswith('.get') else 1
+        started = time.monotonic()
+        try:
+            for attempt in range(attempts):
+                sent = time.monotonic()
+                response = None
+                try:
+                    with ztrace.span(f'zabbix {method}'):
+                        response = await self.client.post(self.zURL, content=body, headers=self.headers)
+                    return response
+                except httpx.TransportError:
+                    if attempt == attempts - 1:
+                        raise
+                    zmetrics.apiRetries.inc('zabbix', method, 'connection')
+                finally:
+                    zmetrics.observeRequest('zabbix', 'POST', method, time.monotonic() - sent, response, len(body))
+        finally:
+            self.callCount += 1
+            self.callSeconds += time.monotonic() - started
+
+    def batch(self):
+        return AsyncZabbixBatch(self)
+
+    async def zabbixAPIRequest(self, method, params):
+        response = await self._post(method, encodeRequest(method, params, self.nextRequestId()))
+        if response.status_code != 200:
+            raise ZabbixAPIError(method, {'code': response.status_code, 'message': 'HTTP error', 'data': response.text})
+        return decodeResponse(response)
+
+    async def zabbixAPIResult(self, method, params):
+        response = await self.zabbixAPIRequest(method, params)
+        if 'error' in response:
+            raise ZabbixAPIError(method, response['error'])
+        return response['result']
+
+    def getTransportStats(self):
+        return {'calls': self.callCount, 'seconds': round(self.callSeconds, 3)}
+
+    async def getEventContext(self, event_id):
+        batch = self.batch()
+        alertCall = batch.add('alert.get', ALERT_DETAIL.encode(eventids=event_id))
+        eventCall = batch.add('event.get', EVENT_DETAIL.encode(eventids=event_id))
+        await batch.execute()
+
+        try:
+            alerts = batch.result(alertCall)
+        except ZabbixAPIError as e:
+            zlog.error(f'Error: {e}')
+            alerts = None
+        context = {'alerts': alerts, 'event': batch.result(eventCall), 'macros': []}
+
+        # Macros need the host id from the event. The host's company comes from the resolver's host map, not its groups.
+        if context['event'] and context['event'][0]['hosts']:
+            context['macros'] = await self.zabbixAPIResult('usermacro.get', {"hostids": context['event'][0]['hosts'][0]['hostid']})
+        return context
+
+    def truncateStringMessage(self, s, max_length=100):
+
+        if len(s.encode('utf-8')) <= max_length:
+            return s
+        else:
+            return s[:70] + "..."  # Add an ellipsis to indicate truncation
+
+    async def getNonActiveEventsById(self, event_id):
+        return await self.zabbixAPIRequest('event.get', {
+            "eventids": event_id,
+            "output": "extend",
+            "value": 1  # 1 indicates resolved events, 0 indicates active events
+        })
+
+    async def getEventByEventId(self, event_id):
+        return await self.zabbixAPIResult('event.get', EVENT_DETAIL.encode(eventids=event_id))
+
+    async def getEventsByIds(self, event_ids, output=("eventid", "r_eventid", "clock", "name")):
+        return await self.zabbixAPIResult('event.get', {
+            "eventids": list(event_ids),
+            "output": list(output)
+        })
+
+    async def getAlertsByEvents(self, event_ids):
+        return await self.zabbixAPIResult('alert.get', {
+            "eventids": list(event_ids),
+            "output": ["alertid", "eventid", "message"]
+        })
+
+    async def getAcknowledgedProblems(self, time_from):
+        return await self.zabbixAPIResult('event.get', {
+            "source": 0,
+            "object": 0,
+            "value": 1,
+            "acknowledged": True,
+            "time_from": time_from,
+            "output": ["eventid", "r_eventid", "clock"],
+            "select_acknowledges": ["clock", "message"]
+        })
+
+    async def addMessageToProblem(self, event_id, action, message):
+        message = self.truncateStringMessage(message, 1000)
+        return await self.zabbixAPIRequest('event.acknowledge', {
+            'eventids': [event_id],
+            'message': message,
+            'action': action
+        })
+
+    async def addMessageToProblems(self, event_ids, action, message):
+        message = self.truncateStringMessage(message, 1000)
+        return await self.zabbixAPIRequest('event.acknowledge', {
+            'eventids': list(event_ids),
+            'message': message,
+            'action': action
+        })
+
+    async def getGlobalMacro(self, macro_id):
+        result = await self.zabbixAPIResult('usermacro.get', {
+            "globalmacro": True,  # to get global macros
+        })
+        for item in result:
+            if item['macro'] == macro_id:
+                return item['value']
+        return None
+
+    async def getHostMacros(self, host_id):
+        return await self.zabbixAPIResult('usermacro.get', {
+            "hostids": host_id
+        })
+
+    def getMacroValue(self, json_data, macro_name):
+        json_data = json.loads(json_data)
+
+        for item in json_data:
+            if item.get('macro') == macro_name:
+                return item['value']
+        return None
+
+    async def getAlertByEvent(self, event_id):
+        try:
+            return await self.zabbixAPIResult('alert.get', ALERT_DETAIL.encode(eventids=event_id))
+        except ZabbixAPIError as e:
+            zlog.error(f'Error: {e}')
+            return None
+
+    async def getAlertMessageByEvent(self, event_id):
+        alert_data = await self.zabbixAPIResult('alert.get', {
+            "eventids": event_id,
+            "output": "extend",
+            "selectMediatypes": "extend"
+        })
+
+        if alert_data:
+            return json.dumps(alert_data[0]['message'])
+        else:
+            return None
+
+    async def getAlertById(self, alert_id):
+        try:
+            return await self.getAlertDetails(alert_id)
+        except ZabbixAPIError as e:
+            zlog.error(f'Error: {e}')
+            return None
+
+    async def getAlertDetails(self, alertid):
+        return await self.zabbixAPIResult('alert.get', {
+            "alertids": alertid,
+            "output": "extend",
+            "selectHosts": "extend",
+            "selectTriggers": "extend",
+            "selectEvents": "extend"
+        })
+
+    async def getHostCountForGroup(self, groupID):
+        return await self.zabbixAPIRequest('host.get', {
+            "output": ["hostid"],
+            "groupids": groupID,
+            "countOutput": True
+        })
+
+    async def getTriggerDependencies(self, triggerid):
+        result = await self.zabbixAPIResult('trigger.get', {
+            "triggerids": triggerid,
+            "output": ["triggerid"],
+            "selectDependencies": ["triggerid"]
+        })
+        if not result:
+            return []
+        return [dependency['triggerid'] for dependency in result[0].get('dependencies', [])]
+
+    async def getGroupsForHost(self, hostid):
+        data = await self.zabbixAPIRequest('host.get', {
+            "output": ["hostid"],
+            "selectGroups": ["groupid", "name"],
+            "filter": {
+                "hostid": [
+                    hostid
+                ]
+            }
+        })
+
+        # Same shape as the blocking client: the full envelope, or None if no groups were found.
+        if data.get('result'):
+            return data
+        return
+
+    async def getAllHostGroups(self):
+        return await self.zabbixAPIResult('hostgroup.get', {
+            "output": "extend"
+        })
+
+    async def getHostGroupHostCounts(self):
+        return await self.zabbixAPIResult('hostgroup.get', {
+            "output": ["groupid", "name"],
+            "selectHosts": "count"
+        })
+
+    async def getHostGroupMembers(self):
+        return await self.zabbixAPIResult('hostgroup.get', {
+            "output": ["groupid", "name"],
+            "selectHosts": ["hostid"]
+        })
+
+    async def getHost(self, hostid):
+        return await self.zabbixAPIResult('host.get', {
+            "hostids": hostid,
+            "output": "extend"
+        })
+
+    async def billingTagCounts(self):
+        return await self.zabbixAPIResult('host.get', {
+            "output": ["hostid"],
+            'selectTags': 'extend'
+        })
+
+    async def getHostIds(self):
+        return sorted((host['hostid'] for host in await self.zabbixAPIResult('host.get', {"output": ["hostid"]})), key=int)
+
+    async def iterateHosts(self, params, chunkSize=1000):
+        # Async generator counterpart of JWZabbix.iterateHosts.
+        hostIds = await self.getHostIds()
+        for start in range(0, len(hostIds), chunkSize):
+            yield await self.zabbixAPIResult('host.get', {**params, "hostids": hostIds[start:start + chunkSize]})
+
+    def writeDebugLog(self, messageText):
+        zlog.debug(messageText)
+
+    async def rename_host_group(self, old_group_name, new_group_name):
+        try:
+            result = await self.zabbixAPIResult('hostgroup.get', {
+                "filter": {
+                    "name": old_group_name
+                }
+            })
+            if len(result) == 0:
+                return False
+
+            await self.zabbixAPIResult('hostgroup.update', {
+                "groupid": result[0]['groupid'],
+                "name": new_group_name
+            })
+            return True
+
+        except (ZabbixAPIError, httpx.HTTPError):
+            return False
+
+    async def getHostTagsByHostId(self, host_id):
+        try:
+            result = await self.zabbixAPIResult('host.get', {
+                "output": ["hostid"],
+                "selectTags": "extend",  # Get all tags for the host
+                "hostids": host_id
+            })
+        except ZabbixAPIError:
+            return []
+        return result[0].get('tags', [])
+
+
+async def gatherTicketLookups(cwapi, boardName, companyIdentifier, statusName="Needs Assigned"):
+    """
+    Runs the independent ConnectWise lookups a new ticket needs at the same time.
+    :param cwapi: An AsyncConnectWiseApi client.
+    :param boardName: The name of the service ticket board.
+    :param companyIdentifier: The company identifier or name.
+    :param statusName: The status new tickets are created with.
+    :return: Dictionary with boardId, companyId, companyDeleted, newStatusId and closedStatusId.
+    """
+    async def board():
+        response = await cwapi.getServiceTicketBoardIdFromName(boardName)
+        boardId = decodeResponse(response)[0]['id']
+        newStatusId, closedStatusId = await asyncio.gather(
+            cwapi.getServiceTicketBoardStatusDefaultStatus(boardId, statusName),
+            cwapi.getTicketBoardClosedStatusID(boardId),
+        )
+        return boardId, newStatusId, closedStatusId
+
+    async def company():
+        companyId = await cwapi.getCompanyIDbyIdentifier(companyIdentifier)
+        deleted = await cwapi.getCompanyDeletedStatusByID(companyId) if companyId else None
+        return companyId, deleted
+
+    (boardId, newStatusId, closedStatusId), (companyId, deleted) = await asyncio.gather(board(), company())
+    return {
+        'boardId': boardId,
+        'companyId': companyId,
+        'companyDeleted': deleted,
+        'newStatusId': newStatusId,
+        'closedStatusId': closedStatusId,
+    }
@@ -0,0 +1,162 @@
+#! /usr/bin/env python3
+# Local catalog of ConnectWise service boards and board statuses.
+# Boards and statuses change rarely, so they are kept in a SQLite file shared by all zalert
+# processes and only re-fetched from ConnectWise when older than the TTL or on explicit refresh.
+#
+# Usage: zcatalog.py warm [board name ...] | refresh | invalidate | show
+import sys
+import time
+import sqlite3
+from contextlib import contextmanager
+from apilib import pickClosedStatusID
+from zcodec import decodeResponse
+
+
+class CWCatalog:
+
+    def __init__(self, cwapi, path='/tmp/zalert_catalog.db', ttl=86400):
+        """
+        :param cwapi: ConnectWiseApi client used to fill the catalog.
+        :param path: Path of the SQLite catalog file.
+        :param ttl: Seconds before a cached board or status list is re-fetched.
+        """
+        self.cwapi = cwapi
+        self.path = path
+        self.ttl = ttl
+        with self._connect() as db:
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('CREATE TABLE IF NOT EXISTS boards (name TEXT PRIMARY KEY COLLATE NOCASE, id INTEGER, fetched REAL)')
+            db.execute('CREATE TABLE IF NOT EXISTS statuses (boardId INTEGER, id INTEGER, name TEXT, PRIMARY KEY (boardId, id))')
+            db.execute('CREATE TABLE IF NOT EXISTS statusLists (boardId INTEGER PRIMARY KEY, fetched REAL)')
+
+    @contextmanager
+    def _connect(self):
+        # A short-lived connection per operation keeps this safe across daemon threads and processes.
+        db = sqlite3.connect(self.path, timeout=10)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def _fresh(self, fetched):
+        return fetched is not None and time.time() - fetched < self.ttl
+
+    def getBoardId(self, boardName, refresh=False):
+        """
+        :param boardName: The name of the service ticket board.
+        :param refresh: Re-fetch from ConnectWise even if the cached entry is fresh.
+        :return: The ID of the service ticket board. Raises RuntimeError if ConnectWise has no such board.
+        """
+        if not refresh:
+            with self._connect() as db:
+                row = db.execute('SELECT id, fetched FROM boards WHERE name = ?', (boardName,)).fetchone()
+            if row and self._fresh(row[1]):
+                return row[0]
+
+        response = self.cwapi.getServiceTicketBoardIdFromName(boardName)
+        boards = decodeResponse(response) if response else []
+        if not boards:
+            raise RuntimeError(f'Service ticket board "{boardName}" not found in ConnectWise')
+        boardId = boards[0]['id']
+        with self._connect() as db:
+            db.execute('INSERT OR REPLACE INTO boards (name, id, fetched) VALUES (?, ?, ?)', (boardName, boardId, time.time()))
+        return boardId
+
+    def getStatuses(self, boardId, refresh=False):
+        """
+        :param boardId: The ID of the service ticket board.
+        :param refresh: Re-fetch from ConnectWise even if the cached list is fresh.
+        :return: List of {'id', 'name'} status records for the board.
+        """
+        boardId = int(boardId)
+        if not refresh:
+            with self._connect() as db:
+                row = db.execute('SELECT fetched FROM statusLists WHERE boardId = ?', (boardId,)).fetchone()
+                if row and self._fresh(row[0]):
+                    rows = db.execute('SELECT id, name FROM statuses WHERE boardId = ? ORDER BY rowid', (boardId,)).fetchall()
+                    return [{'id': statusId, 'name': name} for statusId, name in rows]
+
+        response = self.cwapi.getServiceTicketBoardIDStatuses(boardId)
+        if response.status_code != 200:
+            raise RuntimeError(f"Failed to get service ticket board statuses. HTTP Status Code: {response.status_code}")
+        statuses = [{'id': item['id'], 'name': item['name']} for item in decodeResponse(response)]
+        with self._connect() as db:
+            db.execute('DELETE FROM statuses WHERE boardId = ?', (boardId,))
+            db.executemany('INSERT INTO statuses (boardId, id, name) VALUES (?, ?, ?)',
+                           [(boardId, item['id'], item['name']) for item in statuses])
+            db.execute('INSERT OR REPLACE INTO statusLists (boardId, fetched) VALUES (?, ?)', (boardId, time.time()))
+        return statuses
+
+    def getStatusId(self, boardId, statusName):
+        """
+        :param boardId: The ID of the service ticket board.
+        :param statusName: The name of the status, e.g. "Needs Assigned".
+        :return: The ID of the status. Raises RuntimeError if the board has no such status.
+        """
+        statuses = self.getStatuses(boardId)
+        for item in statuses:
+            if item['name'].lower() == statusName.lower():
+                return item['id']
+        raise RuntimeError(f'Status "{statusName}" not found on service ticket board {boardId}')
+
+    def getClosedStatusId(self, boardId):
+        """
+        :param boardId: The ID of the service ticket board.
+        :return: The ID of the closed status for the board.
+        """
+        return pickClosedStatusID(self.getStatuses(boardId))
+
+    def refresh(self):
+        """Re-fetch every board and status list currently in the catalog."""
+        with self._connect() as db:
+            boardNames = [row[0] for row in db.execute('SELECT name FROM boards')]
+            boardIds = [row[0] for row in db.execute('SELECT boardId FROM statusLists')]
+        for boardName in boardNames:
+            boardIds.append(self.getBoardId(boardName, refresh=True))
+        for boardId in set(boardIds):
+            self.getStatuses(boardId, refresh=True)
+
+    def warm(self, boardNames):
+        """
+        :param boardNames: Board names to load, along with their status lists.
+        """
+        for boardName in boardNames:
+            self.getStatuses(self.getBoardId(boardName, refresh=True), refresh=True)
+
+    def invalidate(self):
+        """Drop all cached boards and statuses so the next lookup goes to ConnectWise."""
+        with self._connect() as db:
+            db.execute('DELETE FROM boards')
+            db.execute('DELETE FROM statuses')
+            db.execute('DELETE FROM statusLists')
+
+    def show(self):
+        """
+        :return: List of (board name, board id, status id, status name) rows in the catalog.
+        """
+        with self._connect() as db:
+            return db.execute('SELECT b.name, b.id, s.id, s.name FROM boards b LEFT JOIN statuses s ON s.boardId = b.id ORDER BY b.name, s.rowid').fetchall()
+
+
+def main():
+    import zalert
+
+    command = sys.argv[1] if len(sys.argv) > 1 else 'show'
+    if command == 'warm':
+        boardNames = sys.argv[2:] or [zalert.settings.defaultCWBoard, zalert.settings.zTicketErrorCWBoard]
+        zalert.catalog.warm([name for name in boardNames if name])
+    elif command == 'refresh':
+        zalert.catalog.refresh()
+    elif command == 'invalidate':
+        zalert.catalog.invalidate()
+    elif command == 'show':
+        for row in zalert.catalog.show():
+            print('\t'.join(str(value) for value in row))
+    else:
+        print('Usage: zcatalog.py warm [board name ...] | refresh | invalidate | show')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
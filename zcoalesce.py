@@ -0,0 +1,95 @@
+#! /usr/bin/env python3
+# Alert-storm coalescing for the resident daemon.
+# New problem events are held for a short window and grouped by a key (host group, company or
+# upstream trigger). A group that reaches the threshold gets one parent ticket; the other events
+# are attached to it as one note and acknowledged in Zabbix with a single call.
+import threading
+from concurrent.futures import Future
+
+
+class StormGroup:
+
+    def __init__(self, key):
+        self.key = key
+        self.members = []
+
+
+class StormCoalescer:
+
+    def __init__(self, window, threshold, keyFunc, processFunc, attachFunc, debugLog):
+        """
+        :param window: Seconds to hold the first event of a group while more events arrive.
+        :param threshold: Minimum number of events in a group before they are coalesced.
+        :param keyFunc: Callable(eventId) returning the grouping key, or None to process the event on its own.
+        :param processFunc: Callable(eventId) that handles one event and returns the CW ticket id it created, or the
+                            outbox key of the queued ticket creation.
+        :param attachFunc: Callable(parentEventId, ticketId, childEventIds) that attaches events to the parent ticket.
+        :param debugLog: Callable used to write debug messages.
+        """
+        self.window = window
+        self.threshold = threshold
+        self.keyFunc = keyFunc
+        self.processFunc = processFunc
+        self.attachFunc = attachFunc
+        self.debugLog = debugLog
+        self.groups = {}
+        self.lock = threading.Lock()
+
+    def submit(self, eventId):
+        """
+        :param eventId: The Zabbix event id to handle.
+        :return: The result of processing the event. Blocks until the event's group has been flushed.
+        """
+        key = self.keyFunc(eventId)
+        if key is None:
+            return self.processFunc(eventId)
+
+        future = Future()
+        with self.lock:
+            group = self.groups.get(key)
+            if group is None:
+                group = self.groups[key] = StormGroup(key)
+                timer = threading.Timer(self.window, self.flush, args=(key,))
+                timer.daemon = True
+                timer.start()
+            group.members.append((eventId, future))
+        return future.result()
+
+    def flush(self, key):
+        with self.lock:
+            group = self.groups.pop(key, None)
+        if group is None:
+            return
+
+        if len(group.members) < self.threshold:
+            for eventId, future in group.members:
+                threading.Thread(target=self._run, args=(eventId, future), daemon=True).start()
+            return
+
+        (parentEventId, parentFuture), children = group.members[0], group.members[1:]
+        self.debugLog(f'Alert storm on {key}: {len(group.members)} events, parent event {parentEventId}')
+        ticketId = self._run(parentEventId, parentFuture)
+        if not ticketId:
+            # No parent ticket was created (already ticketed, acknowledged, error), so handle each event on its own.
+            for eventId, future in children:
+                threading.Thread(target=self._run, args=(eventId, future), daemon=True).start()
+            return
+
+        try:
+            self.attachFunc(parentEventId, ticketId, [eventId for eventId, future in children])
+        except BaseException as e:
+            for eventId, future in children:
+                future.set_exception(e)
+            return
+        for eventId, future in children:
+            future.set_result(None)
+
+    def _run(self, eventId, future):
+        try:
+            result = self.processFunc(eventId)
+        except BaseException as e:
+            # SystemExit included: the daemon turns it into the exit code for this event's client.
+            future.set_exception(e)
+            return None
+        future.set_result(result)
+        return result
@@ -0,0 +1,104 @@
+#! /usr/bin/env python3
+# JSON codec shared by the API clients.
+# Uses orjson when it is installed and the standard library otherwise. Both paths produce
+# compact UTF-8 bytes. Template pre-encodes the constant part of a request's params once,
+# so each call only encodes the values that change.
+#
+# Optional: pip install orjson
+import json
+from functools import lru_cache
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+if orjson is not None:
+    BACKEND = 'orjson'
+
+    def dumps(obj):
+        """
+        :param obj: Value to encode.
+        :return: Compact JSON as UTF-8 bytes.
+        """
+        return orjson.dumps(obj)
+
+    def loads(data):
+        """
+        :param data: JSON text as bytes or str.
+        :return: The decoded value.
+        """
+        return orjson.loads(data)
+else:
+    BACKEND = 'json'
+    _encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+
+    def dumps(obj):
+        """
+        :param obj: Value to encode.
+        :return: Compact JSON as UTF-8 bytes.
+        """
+        return _encoder.encode(obj).encode('utf-8')
+
+    def loads(data):
+        """
+        :param data: JSON text as bytes or str.
+        :return: The decoded value.
+        """
+        return json.loads(data)
+
+
+def decodeResponse(response):
+    """
+    :param response: A requests or httpx response.
+    :return: The decoded JSON body.
+    """
+    return loads(response.content)
+
+
+@lru_cache(maxsize=256)
+def _requestPrefix(method):
+    return b'{"jsonrpc":"2.0","method":' + dumps(method) + b',"params":'
+
+
+def encodeRequest(method, params, requestId):
+    """
+    :param method: The Zabbix API method name.
+    :param params: The params as a value to encode, or bytes already encoded (e.g. from Template.encode).
+    :param requestId: The JSON-RPC request id.
+    :return: The JSON-RPC request as bytes.
+    """
+    if not isinstance(params, bytes):
+        params = dumps(params)
+    return b''.join((_requestPrefix(method), params, b',"id":', str(requestId).encode(), b'}'))
+
+
+def encodeBatch(requests):
+    """
+    :param requests: Encoded JSON-RPC requests from encodeRequest.
+    :return: The JSON-RPC batch as bytes.
+    """
+    return b'[' + b','.join(requests) + b']'
+
+
+class Template:
+
+    def __init__(self, params):
+        """
+        :param params: The params that are the same on every call, encoded once here.
+        """
+        self.params = params
+        self.constant = dumps(params)
+
+    def encode(self, **values):
+        """
+        :param values: The params that change per call. They must not repeat a key from the constant params.
+        :return: The full params object as bytes.
+        """
+        if not values:
+            return self.constant
+        variable = b','.join(dumps(key) + b':' + dumps(value) for key, value in values.items())
+        if self.constant == b'{}':
+            return b'{' + variable + b'}'
+        return b'{' + variable + b',' + self.constant[1:]
@@ -0,0 +1,237 @@
+#! /usr/bin/env python3
+# Local directory of ConnectWise companies.
+# One paged full sync copies every company's id, identifier, name and deleted flag into a SQLite
+# file shared by all zalert processes. After that, delta syncs fetch only the companies changed
+# since the last one, using a lastUpdated condition. Identifier and name lookups are answered
+# locally and ignore case, as ConnectWise does. ConnectWiseApi uses the directory as the backend
+# for its company getters when one is attached to its companies attribute.
+# Full syncs only run from the daemon's sync thread and `zcompanies.py sync`; until one has run,
+# lookups go to ConnectWise one company at a time. A lookup may run a short delta sync when the
+# directory is stale, but only in the one process holding the sync lock, and not for a while
+# after a sync failed.
+#
+# Usage: zcompanies.py sync [--full] | show | lookup <identifier or name>
+import sys
+import time
+import sqlite3
+from contextlib import contextmanager
+from apilib import CWCompany, COMPANY_FIELDS
+
+# lastUpdated is fetched too; the newest value seen is where the next delta sync starts.
+SYNC_FIELDS = COMPANY_FIELDS + ',_info/lastUpdated'
+# Most companies a delta sync run from a lookup fetches. More changes than that are left to the daemon.
+LOOKUP_SYNC_LIMIT = 1000
+
+
+class CompanyDirectory:
+
+    def __init__(self, cwapi, path='/tmp/zalert_cwcompanies.db', interval=300, fullInterval=86400):
+        """
+        :param cwapi: ConnectWiseApi client used for the syncs and for companies missing from the directory.
+        :param path: Path of the SQLite directory file.
+        :param interval: Seconds after a sync before it is due again; also how long lookups wait after a failed sync before trying one.
+        :param fullInterval: Seconds after a full sync before sync() does another full one, which also drops companies removed from ConnectWise.
+        """
+        self.cwapi = cwapi
+        self.path = path
+        self.interval = interval
+        self.fullInterval = fullInterval
+        with self._connect() as db:
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('CREATE TABLE IF NOT EXISTS companies (id INTEGER PRIMARY KEY, identifier TEXT COLLATE NOCASE, name TEXT COLLATE NOCASE, '
+                       'deletedFlag INTEGER, lastUpdated TEXT)')
+            db.execute('CREATE INDEX IF NOT EXISTS companiesIdentifier ON companies (identifier)')
+            db.execute('CREATE INDEX IF NOT EXISTS companiesName ON companies (name)')
+            db.execute('CREATE TABLE IF NOT EXISTS syncs (kind TEXT PRIMARY KEY, finished REAL, mark TEXT)')
+
+    @contextmanager
+    def _connect(self):
+        # A short-lived connection per operation keeps this safe across daemon threads and processes.
+        db = sqlite3.connect(self.path, timeout=10)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def _store(self, db, records):
+        rows = [(record['id'], record.get('identifier', ''), record.get('name', ''), int(bool(record.get('deletedFlag'))),
+                 (record.get('_info') or {}).get('lastUpdated')) for record in records]
+        db.executemany('INSERT OR REPLACE INTO companies (id, identifier, name, deletedFlag, lastUpdated) VALUES (?, ?, ?, ?, ?)', rows)
+
+    def _syncs(self):
+        # kind -> (finished, mark) for the 'full' and 'delta' syncs, and 'failed' with when a sync last failed or a lookup's was cut short.
+        with self._connect() as db:
+            return {kind: (finished, mark) for kind, finished, mark in db.execute('SELECT kind, finished, mark FROM syncs')}
+
+    def _lastSync(self, syncs):
+        return max((syncs[kind][0] for kind in ('full', 'delta') if kind in syncs), default=None)
+
+    def _mark(self, syncs):
+        return max((syncs[kind][1] or '' for kind in ('full', 'delta') if kind in syncs), default='')
+
+    @contextmanager
+    def _lock(self, wait=True):
+        # Serializes syncs across processes. Yields False when wait is off and another process holds the lock.
+        import fcntl
+
+        with open(self.path + '.lock', 'a') as lockFile:
+            try:
+                fcntl.flock(lockFile, fcntl.LOCK_EX if wait else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            yield True
+
+    def sync(self, full=False):
+        """
+        Runs a delta sync, or a full sync if none has run, the last is older than fullInterval, or full is set.
+        For the daemon's sync thread and `zcompanies.py sync`; lookups never start a full sync.
+        :return: Dictionary with the kind of sync and the number of companies fetched.
+        """
+        with self._lock():
+            syncs = self._syncs()
+            fullSync = syncs.get('full')
+            try:
+                if full or fullSync is None or time.time() - fullSync[0] >= self.fullInterval:
+                    return self._fullSync()
+                return self._deltaSync(self._mark(syncs))
+            except Exception:
+                self._failed()
+                raise
+
+    def _fullSync(self):
+        records = list(self.cwapi.iterate('/company/companies', orderBy='id asc', pageSize=1000, fields=SYNC_FIELDS))
+        mark = max(((record.get('_info') or {}).get('lastUpdated') or '' for record in records), default='')
+        with self._connect() as db:
+            db.execute('DELETE FROM companies')
+            self._store(db, records)
+            db.execute('INSERT OR REPLACE INTO syncs (kind, finished, mark) VALUES (?, ?, ?)', ('full', time.time(), mark))
+            db.execute("DELETE FROM syncs WHERE kind IN ('delta', 'failed')")
+        return {'sync': 'full', 'companies': len(records)}
+
+    def _deltaSync(self, mark, limit=None):
+        # >= rather than >: companies updated in the same second as the mark are fetched again instead of missed.
+        conditions = f'lastUpdated >= [{mark}]' if mark else None
+        records = list(self.cwapi.iterate('/company/companies', conditions=conditions, orderBy='id asc', pageSize=1000, fields=SYNC_FIELDS, limit=limit))
+        if limit is not None and len(records) >= limit:
+            # Cut short, so companies past the limit are missing: store what came, but leave the sync to the daemon.
+            with self._connect() as db:
+                self._store(db, records)
+            return {'sync': 'partial', 'companies': len(records)}
+        mark = max([(record.get('_info') or {}).get('lastUpdated') or '' for record in records] + [mark])
+        with self._connect() as db:
+            self._store(db, records)
+            db.execute('INSERT OR REPLACE INTO syncs (kind, finished, mark) VALUES (?, ?, ?)', ('delta', time.time(), mark))
+            db.execute('DELETE FROM syncs WHERE kind = ?', ('failed',))
+        return {'sync': 'delta', 'companies': len(records)}
+
+    def _failed(self):
+        with self._connect() as db:
+            db.execute('INSERT OR REPLACE INTO syncs (kind, finished, mark) VALUES (?, ?, NULL)', ('failed', time.time()))
+
+    def ready(self):
+        """
+        :return: True once a full sync has run, so the directory holds every company.
+        """
+        return 'full' in self._syncs()
+
+    def due(self):
+        """
+        :return: True if a full sync has run and the last sync is older than interval.
+        """
+        syncs = self._syncs()
+        return 'full' in syncs and time.time() - self._lastSync(syncs) >= self.interval
+
+    def _refresh(self):
+        # Returns False until a full sync has filled the directory; lookups go to ConnectWise until then.
+        syncs = self._syncs()
+        if 'full' not in syncs:
+            return False
+        now = time.time()
+        if now - self._lastSync(syncs) < self.interval or ('failed' in syncs and now - syncs['failed'][0] < self.interval):
+            return True
+        # A stale directory is still a good answer, so a lookup never waits for another process's sync.
+        with self._lock(wait=False) as locked:
+            if locked:
+                syncs = self._syncs()
+                if time.time() - self._lastSync(syncs) >= self.interval:
+                    try:
+                        if self._deltaSync(self._mark(syncs), LOOKUP_SYNC_LIMIT)['sync'] == 'partial':
+                            self._failed()
+                    except Exception:
+                        # The last good directory stays in place; lookups back off for interval before trying again.
+                        self._failed()
+        return True
+
+    def _row(self, query, args):
+        with self._connect() as db:
+            row = db.execute(query, args).fetchone()
+        return CWCompany(row[0], row[1], row[2], bool(row[3])) if row else None
+
+    def lookup(self, identifier):
+        """
+        :param identifier: The company identifier or name, matched without regard to case.
+        :return: The CWCompany, or None if ConnectWise has no such company.
+        """
+        if not self._refresh():
+            return self.cwapi.fetchCompanyRecord(identifier)
+        # An identifier match wins over a name match, as a company's name may equal another's identifier.
+        company = self._row('SELECT id, identifier, name, deletedFlag FROM companies WHERE identifier = ? OR name = ? '
+                            'ORDER BY identifier = ? DESC LIMIT 1', (identifier, identifier, identifier))
+        if company is None:
+            # Not synced yet, e.g. created since the last delta. A company that really does not exist costs one query, as before.
+            company = self.cwapi.fetchCompanyRecord(identifier)
+            if company is not None:
+                self.add(company)
+        return company
+
+    def lookupId(self, companyId):
+        """
+        :param companyId: The ConnectWise company id.
+        :return: The CWCompany, or None if ConnectWise has no such company.
+        """
+        if not self._refresh():
+            return self.cwapi.fetchCompanyRecordByID(companyId)
+        company = self._row('SELECT id, identifier, name, deletedFlag FROM companies WHERE id = ?', (int(companyId),))
+        if company is None:
+            company = self.cwapi.fetchCompanyRecordByID(companyId)
+            if company is not None:
+                self.add(company)
+        return company
+
+    def add(self, company):
+        """
+        :param company: A CWCompany fetched outside a sync. The next delta sync brings it up to date.
+        """
+        with self._connect() as db:
+            db.execute('INSERT OR REPLACE INTO companies (id, identifier, name, deletedFlag, lastUpdated) VALUES (?, ?, ?, ?, NULL)',
+                       (company.id, company.identifier, company.name, int(bool(company.deletedFlag))))
+
+    def show(self):
+        """
+        :return: List of (id, identifier, name, deleted flag, last updated) rows.
+        """
+        with self._connect() as db:
+            return db.execute('SELECT id, identifier, name, deletedFlag, lastUpdated FROM companies ORDER BY identifier').fetchall()
+
+
+def main():
+    import zalert
+
+    directory = zalert.cwapi.companies
+    command = sys.argv[1] if len(sys.argv) > 1 else 'show'
+    if command == 'sync':
+        print(directory.sync(full='--full' in sys.argv[2:]))
+    elif command == 'show':
+        for row in directory.show():
+            print('\t'.join(str(value) for value in row))
+    elif command == 'lookup' and len(sys.argv) > 2:
+        print(directory.lookup(sys.argv[2]))
+    else:
+        print('Usage: zcompanies.py sync [--full] | show | lookup <identifier or name>')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,316 @@
+#! /usr/bin/env python3
+# Compiled zalert configuration.
+# zapiconfig.json is validated and compiled once into an immutable Settings record: defaults
+# filled in, tag names lower-cased, the host group prefix list parsed. A ConfigWatcher lets the
+# resident daemon pick up edits to the file without a restart; a broken edit is reported and the
+# last good settings stay in use.
+#
+# Usage: zconfig.py [check | show]
+import os
+import re
+import sys
+import json
+import time
+import threading
+from collections import namedtuple
+
+ENVIRONMENTS = ('TestEnv', 'ProdEnv')
+COALESCE_KEYS = ('hostgroup', 'company', 'trigger')
+LOG_LEVELS = ('debug', 'info', 'warning', 'error')
+
+# Settings that the API clients, stores, daemon socket and storm coalescer are built from. They are read once per
+# process, so a change only takes effect after a restart.
+RESTART_FIELDS = ('cwBaseurl', 'cwCompany', 'cwClientid', 'cwKey', 'cwSecret', 'zURL', 'zAPIKey', 'zDebug',
+                  'apiPoolSize', 'apiTimeout', 'apiRetries', 'zalertSocket', 'cwCatalogPath', 'cwCatalogTTL',
+                  'cwTicketIndexPath', 'cwRateLimit', 'cwRateBurst', 'cwRateReserve', 'cwRateLimitPath',
+                  'cwOutboxPath', 'cwOutboxMaxAttempts', 'cwOutboxRetryDelay', 'companyResolverPath', 'companyResolverTTL',
+                  'companyResolverSyncInterval', 'companyResolverFullSyncInterval', 'cwCompanyDirectoryPath', 'cwCompanySyncInterval', 'cwCompanyFullSyncInterval', 'coalesceWindow', 'coalesceThreshold',
+                  'metricsTextfile', 'metricsListen', 'metricsInterval')
+
+Settings = namedtuple('Settings', (
+    'env',
+    # From the TestEnv or ProdEnv section.
+    'cwBaseurl', 'cwCompany', 'cwClientid', 'cwKey', 'cwSecret', 'zDebug', 'zabbixTicketGenAckMsg', 'zabbixTicketCloseAckMsg',
+    # From the Global section.
+    'zURL', 'zAPIKey', 'defaultCompany', 'defaultCWBoard', 'companyTagName', 'companyPrefixes', 'cwBoardTagName',
+    'cwDisableTickets', 'apiPoolSize', 'apiTimeout', 'apiRetries', 'zalertSocket', 'cwCatalogPath', 'cwCatalogTTL',
+    'cwTicketIndexPath', 'cwRateLimit', 'cwRateBurst', 'cwRateReserve', 'cwRateLimitPath', 'cwOutboxPath',
+    'cwOutboxMaxAttempts', 'cwOutboxRetryDelay', 'companyResolverPath', 'companyResolverTTL', 'companyResolverSyncInterval',
+    'companyResolverFullSyncInterval', 'cwCompanyDirectoryPath', 'cwCompanySyncInterval', 'cwCompanyFullSyncInterval', 'reconcileBoards', 'coalesceWindow', 'coalesceThreshold', 'coalesceKey',
+    'logPath', 'logLevel', 'logMaxBytes', 'logBackups', 'metricsTextfile', 'metricsListen', 'metricsInterval', 'tracePath', 'traceMaxBytes', 'zTicketErrorCWBoard', 'zTicketErrorCompany', 'scriptErrorAlertSMS',
+))
+
+
+class ConfigError(Exception):
+
+    def __init__(self, path, problems):
+        """
+        :param path: The config file that failed to load.
+        :param problems: List of messages, one per invalid or missing setting.
+        """
+        self.path = path
+        self.problems = problems
+        super().__init__(f'{path}: ' + '; '.join(problems))
+
+
+def defaultConfigPath():
+    return os.path.join(os.path.dirname(os.path.realpath(__file__)), 'zapiconfig.json')
+
+
+def parsePrefixes(value):
+    """
+    :param value: A list of host group prefixes, or the same list as a string such as "['M/','A/']".
+    :return: Tuple of prefixes.
+    """
+    if isinstance(value, str):
+        # The string form may use single quotes.
+        value = json.loads(value.replace("'", '"'))
+    if not isinstance(value, list) or not all(isinstance(prefix, str) for prefix in value):
+        raise ValueError('must be a list of host group prefixes')
+    return tuple(value)
+
+
+def compileConfig(raw, env=None, path='zapiconfig.json'):
+    """
+    :param raw: The parsed zapiconfig.json.
+    :param env: TestEnv or ProdEnv. Defaults to ZALERT_ENV, then configEnv in the Global section, then TestEnv.
+    :param path: The config file name used in error messages.
+    :return: The compiled Settings.
+    :raises ConfigError: Listing every missing or invalid setting.
+    """
+    problems = []
+    if not isinstance(raw, dict):
+        raise ConfigError(path, ['the config must be a JSON object'])
+    globalSection = raw.get('Global')
+    if not isinstance(globalSection, dict):
+        raise ConfigError(path, ['missing Global section'])
+    env = env or os.environ.get('ZALERT_ENV') or globalSection.get('configEnv') or 'TestEnv'
+    if env not in ENVIRONMENTS:
+        raise ConfigError(path, [f'configEnv must be one of {", ".join(ENVIRONMENTS)}, not {env!r}'])
+    section = raw.get(env)
+    if not isinstance(section, dict):
+        raise ConfigError(path, [f'missing {env} section'])
+
+    def text(source, sectionName, key, lower=False, default=None):
+        value = source.get(key)
+        if value in (None, ''):
+            if default is None:
+                problems.append(f'{sectionName}.{key} is required')
+            return default
+        if not isinstance(value, str):
+            problems.append(f'{sectionName}.{key} must be a string')
+            return default
+        return value.lower() if lower else value
+
+    def number(key, default, minimum=0, integer=True):
+        value = globalSection.get(key)
+        if value in (None, ''):
+            return default
+        if isinstance(value, bool) or not isinstance(value, int if integer else (int, float)) or value < minimum:
+            problems.append(f'Global.{key} must be {"an integer" if integer else "a number"} of at least {minimum}')
+            return default
+        return value
+
+    def ackMessage(key):
+        value = text(section, env, key)
+        if value and '{id}' not in value:
+            problems.append(f'{env}.{key} must contain {{id}} for the ticket number')
+        return value
+
+    try:
+        companyPrefixes = parsePrefixes(globalSection.get('companyNameFromHostGroups') or [])
+    except ValueError as e:
+        problems.append(f'Global.companyNameFromHostGroups {e}')
+        companyPrefixes = ()
+
+    apiTimeout = globalSection.get('apiTimeout') or [5, 30]
+    if isinstance(apiTimeout, (int, float)) and not isinstance(apiTimeout, bool):
+        apiTimeout = [apiTimeout, apiTimeout]
+    if not (isinstance(apiTimeout, list) and len(apiTimeout) == 2 and all(isinstance(t, (int, float)) and t > 0 for t in apiTimeout)):
+        problems.append('Global.apiTimeout must be [connect, read] seconds')
+        apiTimeout = [5, 30]
+
+    logLevel = text(globalSection, 'Global', 'logLevel', lower=True, default='warning')
+    if logLevel not in LOG_LEVELS:
+        problems.append(f'Global.logLevel must be one of {", ".join(LOG_LEVELS)}')
+        logLevel = 'warning'
+
+    metricsListen = text(globalSection, 'Global', 'metricsListen', default='')
+    if metricsListen and not re.fullmatch(r'.+:\d+', metricsListen):
+        problems.append('Global.metricsListen must be host:port')
+
+    coalesceKey = text(globalSection, 'Global', 'coalesceKey', lower=True, default='hostgroup')
+    if coalesceKey not in COALESCE_KEYS:
+        problems.append(f'Global.coalesceKey must be one of {", ".join(COALESCE_KEYS)}')
+
+    defaultCWBoard = text(globalSection, 'Global', 'defaultCWBoard')
+    reconcileBoards = globalSection.get('reconcileBoards') or [defaultCWBoard]
+    if not isinstance(reconcileBoards, list):
+        problems.append('Global.reconcileBoards must be a list of board names')
+        reconcileBoards = [defaultCWBoard]
+
+    smsNumbers = globalSection.get('scriptErrorAlertSMS') or []
+    if not isinstance(smsNumbers, list):
+        smsNumbers = [smsNumbers]
+
+    settings = Settings(
+        env=env,
+        cwBaseurl=text(section, env, 'cwBaseurl'),
+        cwCompany=text(section, env, 'cwCompany'),
+        cwClientid=text(section, env, 'cwClientid'),
+        cwKey=text(section, env, 'cwKey'),
+        cwSecret=text(section, env, 'cwSecret'),
+        zDebug=bool(section.get('zDebug')),
+        zabbixTicketGenAckMsg=ackMessage('zabbixTicketGenAckMsg'),
+        zabbixTicketCloseAckMsg=ackMessage('zabbixTicketCloseAckMsg'),
+        zURL=text(globalSection, 'Global', 'zURL'),
+        zAPIKey=text(globalSection, 'Global', 'zAPIKey'),
+        defaultCompany=text(globalSection, 'Global', 'companyDefaultValue'),
+        defaultCWBoard=defaultCWBoard,
+        companyTagName=text(globalSection, 'Global', 'companyTagName', lower=True),
+        companyPrefixes=companyPrefixes,
+        cwBoardTagName=text(globalSection, 'Global', 'cwBoardTagName', lower=True),
+        cwDisableTickets=text(globalSection, 'Global', 'cwDisableTickets', lower=True),
+        apiPoolSize=number('apiPoolSize', 10, minimum=1),
+        apiTimeout=tuple(apiTimeout),
+        apiRetries=number('apiRetries', 3),
+        zalertSocket=text(globalSection, 'Global', 'zalertSocket', default='/run/zalert/zalert.sock'),
+        cwCatalogPath=text(globalSection, 'Global', 'cwCatalogPath', default='/tmp/zalert_catalog.db'),
+        cwCatalogTTL=number('cwCatalogTTL', 86400),
+        cwTicketIndexPath=text(globalSection, 'Global', 'cwTicketIndexPath', default='/tmp/zalert_tickets.db'),
+        cwRateLimit=number('cwRateLimit', 0, integer=False),
+        cwRateBurst=number('cwRateBurst', 20, minimum=1),
+        cwRateReserve=number('cwRateReserve', 5),
+        cwRateLimitPath=text(globalSection, 'Global', 'cwRateLimitPath', default='/tmp/zalert_ratelimit.db'),
+        cwOutboxPath=text(globalSection, 'Global', 'cwOutboxPath', default='/tmp/zalert_outbox.db'),
+        cwOutboxMaxAttempts=number('cwOutboxMaxAttempts', 20, minimum=1),
+        cwOutboxRetryDelay=number('cwOutboxRetryDelay', 30, integer=False),
+        companyResolverPath=text(globalSection, 'Global', 'companyResolverPath', default='/tmp/zalert_companies.db'),
+        companyResolverTTL=number('companyResolverTTL', 3600, minimum=60),
+        companyResolverSyncInterval=number('companyResolverSyncInterval', 300, minimum=10),
+        companyResolverFullSyncInterval=number('companyResolverFullSyncInterval', 86400, minimum=600),
+        cwCompanyDirectoryPath=text(globalSection, 'Global', 'cwCompanyDirectoryPath', default='/tmp/zalert_cwcompanies.db'),
+        cwCompanySyncInterval=number('cwCompanySyncInterval', 300, minimum=10),
+        cwCompanyFullSyncInterval=number('cwCompanyFullSyncInterval', 86400, minimum=600),
+        reconcileBoards=tuple(reconcileBoards),
+        coalesceWindow=number('coalesceWindow', 0, integer=False),
+        coalesceThreshold=number('coalesceThreshold', 3, minimum=2),
+        coalesceKey=coalesceKey,
+        logPath=text(globalSection, 'Global', 'logPath', default='/tmp/zalert.jsonl'),
+        # zDebug turns on debug records whatever logLevel says.
+        logLevel='debug' if section.get('zDebug') else logLevel,
+        logMaxBytes=number('logMaxBytes', 10485760),
+        logBackups=number('logBackups', 5),
+        metricsTextfile=text(globalSection, 'Global', 'metricsTextfile', default=''),
+        metricsListen=metricsListen,
+        metricsInterval=number('metricsInterval', 15, minimum=1),
+        tracePath=text(globalSection, 'Global', 'tracePath', default=''),
+        traceMaxBytes=number('traceMaxBytes', 10485760),
+        zTicketErrorCWBoard=text(globalSection, 'Global', 'zTicketErrorCWBoard', default=''),
+        zTicketErrorCompany=text(globalSection, 'Global', 'zTicketErrorCompany', default=''),
+        scriptErrorAlertSMS=tuple(str(smsNumber) for smsNumber in smsNumbers),
+    )
+    if settings.cwRateLimit and settings.cwRateReserve >= settings.cwRateBurst:
+        problems.append('Global.cwRateReserve must be smaller than cwRateBurst')
+    if problems:
+        raise ConfigError(path, problems)
+    return settings
+
+
+def loadConfig(path=None, env=None):
+    """
+    :param path: Path of zapiconfig.json. Defaults to the one next to this script.
+    :param env: TestEnv or ProdEnv, see compileConfig.
+    :return: The compiled Settings.
+    :raises ConfigError: If the file cannot be read or is invalid.
+    """
+    path = path or defaultConfigPath()
+    try:
+        with open(path, 'r') as cfgfile:
+            raw = json.load(cfgfile)
+    except (OSError, ValueError) as e:
+        raise ConfigError(path, [str(e)])
+    return compileConfig(raw, env, path)
+
+
+class ConfigWatcher:
+
+    def __init__(self, path=None, env=None, interval=2.0):
+        """
+        Loads the config now, so a broken config stops the process before it handles any alert.
+        :param path: Path of zapiconfig.json. Defaults to the one next to this script.
+        :param env: TestEnv or ProdEnv, see compileConfig.
+        :param interval: Minimum seconds between checks of the file for changes.
+        :raises ConfigError: If the config cannot be loaded.
+        """
+        self.path = path or defaultConfigPath()
+        self.env = env
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.stamp = self._stamp()
+        self.settings = loadConfig(self.path, env)
+        self.checked = time.monotonic()
+        self.error = None
+
+    def _stamp(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+    def refresh(self):
+        """
+        Reloads the config if the file has changed since it was last loaded. Settings are swapped in
+        whole, so a reader sees either the old or the new config and never a mix.
+        :return: Tuple of (old settings, new settings) if a new config was loaded, otherwise None.
+        :raises ConfigError: If the changed file is invalid. The previous settings stay in use.
+        """
+        now = time.monotonic()
+        if now - self.checked < self.interval:
+            return None
+        with self.lock:
+            self.checked = now
+            stamp = self._stamp()
+            if stamp == self.stamp:
+                return None
+            # Remember the stamp even if the load fails, so a broken file is reported once, not on every check.
+            self.stamp = stamp
+            try:
+                settings = loadConfig(self.path, self.env)
+            except ConfigError as e:
+                self.error = e
+                raise
+            old, self.settings, self.error = self.settings, settings, None
+        return old, settings
+
+
+def restartNeeded(old, new):
+    """
+    :return: Names of the changed settings that only take effect after a restart.
+    """
+    return [field for field in RESTART_FIELDS if getattr(old, field) != getattr(new, field)]
+
+
+def main():
+    command = sys.argv[1] if len(sys.argv) > 1 else 'check'
+    try:
+        settings = loadConfig(sys.argv[2] if len(sys.argv) > 2 else None)
+    except ConfigError as e:
+        print(f'Config error in {e.path}:')
+        for problem in e.problems:
+            print(f'  {problem}')
+        sys.exit(1)
+    if command == 'check':
+        print(f'Config OK, environment {settings.env}')
+    elif command == 'show':
+        secrets = ('cwKey', 'cwSecret', 'zAPIKey')
+        for field, value in settings._asdict().items():
+            print(f'{field}\t{"***" if field in secrets else value}')
+    else:
+        print('Usage: zconfig.py [check | show] [config path]')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
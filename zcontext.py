@@ -0,0 +1,64 @@
+#! /usr/bin/env python3
+# Request-scoped memoization for one alert run. API results are cached by method and
+# arguments for the life of one event so repeated lookups don't go back over the WAN.
+import threading
+from collections import Counter
+
+
+class AlertContext:
+
+    def __init__(self, eventId):
+        """
+        :param eventId: The Zabbix event id this context belongs to.
+        """
+        self.eventId = eventId
+        self.results = {}
+        self.hits = Counter()
+        self.misses = Counter()
+        self.lock = threading.Lock()
+
+    def _key(self, func, args, kwargs):
+        name = getattr(func, '__qualname__', repr(func))
+        return name, (name, args, tuple(sorted(kwargs.items())))
+
+    def call(self, func, *args, **kwargs):
+        """
+        :param func: The API method to call, e.g. cwapi.getCompanyIDbyIdentifier.
+        :param args: Positional arguments for the method.
+        :param kwargs: Keyword arguments for the method.
+        :return: The cached result for these arguments, or the result of calling func once.
+        """
+        name, key = self._key(func, args, kwargs)
+        with self.lock:
+            if key in self.results:
+                self.hits[name] += 1
+                return self.results[key]
+            self.misses[name] += 1
+        # Exceptions are not cached, so a failed call is retried the next time it is asked for.
+        result = func(*args, **kwargs)
+        with self.lock:
+            self.results[key] = result
+        return result
+
+    def put(self, func, result, *args, **kwargs):
+        """
+        Seeds the cache with a result we already hold, e.g. an event fetched as part of a batch.
+        :param func: The API method the result would have come from.
+        :param result: The result to cache.
+        :param args: Positional arguments the method would have been called with.
+        :param kwargs: Keyword arguments the method would have been called with.
+        """
+        name, key = self._key(func, args, kwargs)
+        with self.lock:
+            self.results[key] = result
+
+    def stats(self):
+        """
+        :return: Dictionary with total hits and misses plus per-method hit counts.
+        """
+        with self.lock:
+            return {
+                'hits': sum(self.hits.values()),
+                'misses': sum(self.misses.values()),
+                'byMethod': dict(self.hits),
+            }
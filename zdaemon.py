@@ -0,0 +1,77 @@
+#! /usr/bin/env python3
+# Resident zalert process. Keeps the API clients, their sessions and caches warm and
+# takes Zabbix event ids over a Unix socket from the zalertc.py media type client.
+import os
+import signal
+import socketserver
+import traceback
+
+
+class ZalertRequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        # Protocol: the client sends one event id per line and gets back "OK <exit code>" or "ERR <reason>".
+        line = self.rfile.readline(256).decode('utf-8', 'replace').strip()
+        if not line.isdigit():
+            self.wfile.write(b'ERR invalid event id\n')
+            return
+        exitCode = self.server.runEvent(line)
+        self.wfile.write(f'OK {exitCode}\n'.encode('utf-8'))
+
+
+class ZalertDaemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socketPath, eventHandler, debugLog):
+        """
+        :param socketPath: Path of the Unix socket to listen on.
+        :param eventHandler: Callable that processes one event id (zalert.processEvent).
+        :param debugLog: Callable used to write debug messages.
+        """
+        self.socketPath = socketPath
+        self.eventHandler = eventHandler
+        self.debugLog = debugLog
+
+        # Remove a stale socket left behind by a previous run.
+        if os.path.exists(socketPath):
+            os.unlink(socketPath)
+        socketDir = os.path.dirname(socketPath)
+        if socketDir:
+            os.makedirs(socketDir, exist_ok=True)
+        super().__init__(socketPath, ZalertRequestHandler)
+        # Let the zabbix group (which runs the media type client) connect.
+        os.chmod(socketPath, 0o660)
+
+    def runEvent(self, eventId):
+        """
+        :param eventId: The Zabbix event id to process.
+        :return: The exit code the per-process zalert.py would have returned for this event.
+        """
+        try:
+            self.eventHandler(eventId)
+            return 0
+        except SystemExit as e:
+            # processEvent stops early with sys.exit(); in the daemon that only ends this event.
+            if isinstance(e.code, int):
+                return e.code
+            return 0 if e.code is None else 1
+        except Exception as e:
+            self.debugLog(f'Daemon failed processing event {eventId}: {e}\r\n{traceback.format_exc()}')
+            return 1
+
+    def serve(self):
+        """Serve requests until SIGTERM or SIGINT, then remove the socket."""
+        def stop(signum, frame):
+            raise KeyboardInterrupt
+
+        signal.signal(signal.SIGTERM, stop)
+        self.debugLog(f'zalert daemon listening on {self.socketPath}')
+        try:
+            self.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.server_close()
+            if os.path.exists(self.socketPath):
+                os.unlink(self.socketPath)
+            self.debugLog('zalert daemon stopped')
@@ -0,0 +1,145 @@
+#! /usr/bin/env python3
+# Local index of Zabbix problem event id to the ConnectWise ticket zalert created for it.
+# Recovery handling looks the ticket up here instead of running a summary search across the
+# whole board. The index can be rebuilt from the "ticket created" acknowledges in Zabbix.
+#
+# Usage: zindex.py rebuild [days] | show | forget <eventid ...>
+import re
+import sys
+import time
+import string
+import sqlite3
+from contextlib import contextmanager
+
+
+def ackPattern(template):
+    """
+    :param template: Acknowledge message template, e.g. "Connectwise ticket created: {id}".
+    :return: Compiled regex matching messages built from the template, with the ticket id in group 'id'.
+    """
+    pattern = ''
+    for literal, field, spec, conversion in string.Formatter().parse(template):
+        pattern += re.escape(literal)
+        if field == 'id':
+            pattern += r'(?P<id>\d+)'
+        elif field is not None:
+            pattern += r'.*?'
+    return re.compile(pattern)
+
+
+class TicketIndex:
+
+    def __init__(self, path='/tmp/zalert_tickets.db'):
+        """
+        :param path: Path of the SQLite index file.
+        """
+        self.path = path
+        with self._connect() as db:
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('CREATE TABLE IF NOT EXISTS tickets (eventId TEXT PRIMARY KEY, ticketId INTEGER, boardId INTEGER, statusId INTEGER, created REAL, closed REAL)')
+
+    @contextmanager
+    def _connect(self):
+        # A short-lived connection per operation keeps this safe across daemon threads and processes.
+        db = sqlite3.connect(self.path, timeout=10)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def record(self, eventId, ticketId, boardId=None, statusId=None):
+        """
+        :param eventId: The Zabbix problem event id.
+        :param ticketId: The ConnectWise ticket created for the event.
+        :param boardId: The board the ticket was created on.
+        :param statusId: The status the ticket was created with.
+        """
+        with self._connect() as db:
+            db.execute('INSERT OR REPLACE INTO tickets (eventId, ticketId, boardId, statusId, created, closed) VALUES (?, ?, ?, ?, ?, NULL)',
+                       (str(eventId), int(ticketId), boardId, statusId, time.time()))
+
+    def lookup(self, eventId):
+        """
+        :param eventId: The Zabbix problem event id.
+        :return: Dictionary with ticketId, boardId, statusId and closed for the event, or None if it is not indexed.
+        """
+        with self._connect() as db:
+            row = db.execute('SELECT ticketId, boardId, statusId, closed FROM tickets WHERE eventId = ?', (str(eventId),)).fetchone()
+        if row is None:
+            return None
+        return {'ticketId': row[0], 'boardId': row[1], 'statusId': row[2], 'closed': row[3]}
+
+    def markClosed(self, eventId, statusId=None):
+        """
+        :param eventId: The Zabbix problem event id whose ticket was closed.
+        :param statusId: The closed status the ticket was given.
+        """
+        with self._connect() as db:
+            db.execute('UPDATE tickets SET closed = ?, statusId = COALESCE(?, statusId) WHERE eventId = ?', (time.time(), statusId, str(eventId)))
+
+    def forget(self, eventIds):
+        """
+        :param eventIds: Event ids to drop from the index.
+        """
+        with self._connect() as db:
+            db.executemany('DELETE FROM tickets WHERE eventId = ?', [(str(eventId),) for eventId in eventIds])
+
+    def rebuild(self, events, genAckMsg, closeAckMsg):
+        """
+        Re-creates index entries from the acknowledges zalert wrote on each event.
+        Board and status are not in the acknowledges, so rebuilt entries leave them empty.
+        :param events: Zabbix problem events with their acknowledges.
+        :param genAckMsg: The "ticket created" acknowledge template.
+        :param closeAckMsg: The "ticket closed" acknowledge template.
+        :return: Number of events indexed.
+        """
+        genPattern = ackPattern(genAckMsg)
+        closePattern = ackPattern(closeAckMsg)
+        rows = []
+        for event in events:
+            ticketId = None
+            closed = None
+            for ack in sorted(event.get('acknowledges', []), key=lambda ack: int(ack.get('clock', 0))):
+                message = ack.get('message', '')
+                match = genPattern.search(message)
+                if match:
+                    ticketId = int(match.group('id'))
+                    closed = None
+                elif ticketId and closePattern.search(message):
+                    closed = float(ack.get('clock', time.time()))
+            if ticketId:
+                rows.append((str(event['eventid']), ticketId, time.time(), closed))
+        with self._connect() as db:
+            db.executemany('INSERT OR REPLACE INTO tickets (eventId, ticketId, boardId, statusId, created, closed) VALUES (?, ?, NULL, NULL, ?, ?)', rows)
+        return len(rows)
+
+    def show(self):
+        """
+        :return: List of (event id, ticket id, board id, status id, closed) rows in the index.
+        """
+        with self._connect() as db:
+            return db.execute('SELECT eventId, ticketId, boardId, statusId, closed FROM tickets ORDER BY created').fetchall()
+
+
+def main():
+    import zalert
+
+    command = sys.argv[1] if len(sys.argv) > 1 else 'show'
+    if command == 'rebuild':
+        days = int(sys.argv[2]) if len(sys.argv) > 2 else 30
+        events = zalert.jwzabbixapi.getAcknowledgedProblems(int(time.time()) - days * 86400)
+        count = zalert.ticketIndex.rebuild(events, zalert.settings.zabbixTicketGenAckMsg, zalert.settings.zabbixTicketCloseAckMsg)
+        print(f'Indexed {count} tickets from {len(events)} events')
+    elif command == 'show':
+        for row in zalert.ticketIndex.show():
+            print('\t'.join(str(value) for value in row))
+    elif command == 'forget':
+        zalert.ticketIndex.forget(sys.argv[2:])
+    else:
+        print('Usage: zindex.py rebuild [days] | show | forget <eventid ...>')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
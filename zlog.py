@@ -0,0 +1,275 @@
+#! /usr/bin/env python3
+# Buffered, structured logging for zalert.
+# Callers only build a record and put it on an in-memory queue. A background thread writes the
+# records to a JSON-lines file in batches, so an alert never waits on the disk. Each record
+# carries the time, level, process and thread, plus the Zabbix event id and pipeline stage it
+# was logged under (see context()). Each batch goes out in one append, so lines from concurrent
+# alert processes never interleave. The file is rotated by size to <path>.1 ... <path>.<backups>.
+#
+# Usage: zlog.py tail [path] [--event <id>] [--level <level>]
+import os
+import sys
+import json
+import time
+import queue
+import atexit
+import threading
+import contextvars
+from contextlib import contextmanager
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+LEVELS = {'debug': DEBUG, 'info': INFO, 'warning': WARNING, 'error': ERROR}
+LEVEL_NAMES = {number: name for name, number in LEVELS.items()}
+
+# The event and stage being handled. Context variables follow each daemon thread and asyncio task.
+currentEvent = contextvars.ContextVar('zlogEvent', default=None)
+currentStage = contextvars.ContextVar('zlogStage', default=None)
+
+
+class Logger:
+
+    def __init__(self, path='/tmp/zalert.jsonl', level=WARNING, maxBytes=10485760, backups=5, queueSize=10000):
+        """
+        :param path: Path of the JSON-lines log file.
+        :param level: Lowest level written; records below it are dropped before they are built.
+        :param maxBytes: Size at which the file is rotated. 0 disables rotation.
+        :param backups: Number of rotated files kept.
+        :param queueSize: Records buffered before new ones are dropped rather than blocking the caller.
+        """
+        self.path = path
+        self.level = level
+        self.maxBytes = maxBytes
+        self.backups = backups
+        self.queue = queue.Queue(queueSize)
+        self.dropped = 0
+        self.thread = None
+        self.lock = threading.Lock()
+        self.file = None
+
+    def configure(self, path=None, level=None, maxBytes=None, backups=None):
+        """
+        Changes the settings of a running logger. A new path is opened by the writer before its next batch.
+        """
+        if path is not None:
+            self.path = path
+        if level is not None:
+            self.level = level
+        if maxBytes is not None:
+            self.maxBytes = maxBytes
+        if backups is not None:
+            self.backups = backups
+
+    def enabled(self, level):
+        return level >= self.level
+
+    def log(self, level, message, **fields):
+        """
+        :param level: One of DEBUG, INFO, WARNING or ERROR.
+        :param message: The message text.
+        :param fields: Extra JSON fields for the record, e.g. timings or counts.
+        """
+        if level < self.level:
+            return
+        record = {'ts': round(time.time(), 6), 'level': LEVEL_NAMES.get(level, level), 'pid': os.getpid(),
+                  'thread': threading.current_thread().name, 'event': currentEvent.get(), 'stage': currentStage.get(), 'msg': message}
+        if fields:
+            record.update(fields)
+        if self.thread is None:
+            self._start()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='zlog', daemon=True)
+                self.thread.start()
+                # Short-lived zalert processes exit right after the alert; write what is queued first.
+                atexit.register(self.close)
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            try:
+                while len(batch) < 500:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+            records = [record for record in batch if isinstance(record, dict)]
+            if self.dropped:
+                dropped, self.dropped = self.dropped, 0
+                records.append({'ts': round(time.time(), 6), 'level': 'warning', 'pid': os.getpid(), 'thread': 'zlog',
+                                'event': None, 'stage': None, 'msg': f'Log queue full, dropped {dropped} records'})
+            if records:
+                try:
+                    self._write(''.join(json.dumps(record, default=str) + '\n' for record in records).encode())
+                except OSError:
+                    # Logging must never take zalert down; the batch is lost.
+                    pass
+            for marker in batch:
+                if isinstance(marker, threading.Event):
+                    marker.set()
+            if None in batch:
+                return
+
+    def _write(self, data):
+        if self.file is not None and self.file.name != self.path:
+            self.file.close()
+            self.file = None
+        if self.file is not None:
+            try:
+                # Another process may have rotated the file; follow the name, not the old inode.
+                if os.stat(self.path).st_ino != os.fstat(self.file.fileno()).st_ino:
+                    self.file.close()
+                    self.file = None
+            except FileNotFoundError:
+                self.file.close()
+                self.file = None
+        if self.file is None:
+            self.file = open(self.path, 'ab', buffering=0)
+        if self.maxBytes and os.fstat(self.file.fileno()).st_size + len(data) > self.maxBytes:
+            self._rotate()
+        self.file.write(data)
+
+    def _rotate(self):
+        import fcntl
+
+        with open(self.path + '.lock', 'a') as lockFile:
+            fcntl.flock(lockFile, fcntl.LOCK_EX)
+            # Only rotate the file this process has open; if another process got there first, just reopen.
+            try:
+                current = os.stat(self.path).st_ino == os.fstat(self.file.fileno()).st_ino
+            except FileNotFoundError:
+                current = False
+            if current:
+                for n in range(self.backups - 1, 0, -1):
+                    if os.path.exists(f'{self.path}.{n}'):
+                        os.replace(f'{self.path}.{n}', f'{self.path}.{n + 1}')
+                if self.backups:
+                    os.replace(self.path, f'{self.path}.1')
+                else:
+                    os.unlink(self.path)
+        self.file.close()
+        self.file = open(self.path, 'ab', buffering=0)
+
+    def flush(self, timeout=5):
+        """
+        Waits until every record queued so far is written.
+        :return: True if the writer caught up within the timeout.
+        """
+        if self.thread is None or not self.thread.is_alive():
+            return True
+        marker = threading.Event()
+        try:
+            self.queue.put(marker, timeout=timeout)
+        except queue.Full:
+            return False
+        return marker.wait(timeout)
+
+    def close(self, timeout=5):
+        """Writes the queued records and stops the writer thread."""
+        if self.thread is None or not self.thread.is_alive():
+            return
+        try:
+            self.queue.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        self.thread.join(timeout)
+        with self.lock:
+            self.thread = None
+
+
+logger = Logger()
+
+
+def configure(path=None, level=None, maxBytes=None, backups=None):
+    """
+    Configures the shared logger. level may be a number or a level name such as 'debug'.
+    """
+    if isinstance(level, str):
+        level = LEVELS[level.lower()]
+    logger.configure(path, level, maxBytes, backups)
+
+
+def enabled(level):
+    """
+    :return: True if records at this level are written. Use it to skip building costly messages.
+    """
+    return logger.enabled(level)
+
+
+def log(level, message, **fields):
+    logger.log(level, message, **fields)
+
+
+def debug(message, **fields):
+    logger.log(DEBUG, message, **fields)
+
+
+def info(message, **fields):
+    logger.log(INFO, message, **fields)
+
+
+def warning(message, **fields):
+    logger.log(WARNING, message, **fields)
+
+
+def error(message, **fields):
+    logger.log(ERROR, message, **fields)
+
+
+def flush(timeout=5):
+    return logger.flush(timeout)
+
+
+@contextmanager
+def context(event=None, stage=None):
+    """
+    Tags the records logged inside the block with an event id and/or pipeline stage.
+    """
+    tokens = []
+    if event is not None:
+        tokens.append((currentEvent, currentEvent.set(str(event))))
+    if stage is not None:
+        tokens.append((currentStage, currentStage.set(stage)))
+    try:
+        yield
+    finally:
+        for variable, token in reversed(tokens):
+            variable.reset(token)
+
+
+def main():
+    args = sys.argv[1:]
+    if not args or args[0] != 'tail':
+        print('Usage: zlog.py tail [path] [--event <id>] [--level <level>]')
+        sys.exit(1)
+    args = args[1:]
+    filters = {}
+    for option in ('--event', '--level'):
+        if option in args:
+            index = args.index(option)
+            filters[option] = args[index + 1]
+            del args[index:index + 2]
+    path = args[0] if args else logger.path
+    minimum = LEVELS[filters.get('--level', 'debug').lower()]
+    with open(path) as logFile:
+        for line in logFile:
+            record = json.loads(line)
+            if '--event' in filters and record.get('event') != filters['--event']:
+                continue
+            if LEVELS.get(record.get('level'), ERROR) < minimum:
+                continue
+            stage = f' [{record["stage"]}]' if record.get('stage') else ''
+            moment = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(record['ts']))
+            extra = {key: value for key, value in record.items() if key not in ('ts', 'level', 'pid', 'thread', 'event', 'stage', 'msg')}
+            print(f'{moment} {record["level"]:<7} {record.get("event") or "-"}{stage} {record["msg"]}' + (f' {json.dumps(extra)}' if extra else ''))
+
+
+if __name__ == '__main__':
+    main()
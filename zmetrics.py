@@ -0,0 +1,301 @@
+#! /usr/bin/env python3
+# In-process metrics for zalert, exported in the Prometheus text format.
+# Both API clients time every HTTP request and count its status code, retries and bytes. zalert
+# records the end-to-end time of each alert and the tickets it creates and closes. Counters and
+# histogram buckets only ever add up, so a process merges what it recorded into a shared textfile
+# (for node_exporter's textfile collector) by adding it to the values already there. A short-lived
+# zalert process merges on exit; the resident daemon merges every metricsInterval seconds and can
+# also serve /metrics over HTTP.
+#
+# Usage: zmetrics.py show [textfile]
+import os
+import re
+import sys
+import atexit
+import threading
+
+# Seconds. API calls are mostly well under a second; a whole alert takes a handful of calls.
+API_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+ALERT_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+
+
+def _labelText(names, values):
+    return ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _number(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+class Counter:
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.type = 'counter'
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *labelValues, amount=1):
+        with self.lock:
+            self.values[labelValues] = self.values.get(labelValues, 0) + amount
+
+    def samples(self):
+        """
+        :return: List of (series, value) pairs, e.g. ('zalert_tickets_total{action="created"}', 3).
+        """
+        with self.lock:
+            items = list(self.values.items())
+        return [(f'{self.name}{{{_labelText(self.labels, labelValues)}}}' if self.labels else self.name, value) for labelValues, value in items]
+
+
+class Histogram:
+
+    def __init__(self, name, help, labels=(), buckets=API_BUCKETS):
+        self.name = name
+        self.help = help
+        self.type = 'histogram'
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # Per label set: a count per bucket (not cumulative), then the sum and the total count.
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *labelValues):
+        with self.lock:
+            counts = self.values.get(labelValues)
+            if counts is None:
+                counts = self.values[labelValues] = [0] * (len(self.buckets) + 2)
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            counts[-2] += value
+            counts[-1] += 1
+
+    def samples(self):
+        with self.lock:
+            items = [(labelValues, list(counts)) for labelValues, counts in self.values.items()]
+        samples = []
+        for labelValues, counts in items:
+            labels = _labelText(self.labels, labelValues)
+            prefix = labels + ',' if labels else ''
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                samples.append((f'{self.name}_bucket{{{prefix}le="{bound}"}}', cumulative))
+            samples.append((f'{self.name}_bucket{{{prefix}le="+Inf"}}', counts[-1]))
+            samples.append((f'{self.name}_sum{{{labels}}}' if labels else f'{self.name}_sum', round(counts[-2], 6)))
+            samples.append((f'{self.name}_count{{{labels}}}' if labels else f'{self.name}_count', counts[-1]))
+        return samples
+
+
+apiSeconds = Histogram('zalert_api_request_seconds', 'Time taken by each API HTTP request.', ('api', 'method', 'endpoint'))
+apiResponses = Counter('zalert_api_responses_total', 'API HTTP responses by status code; "error" when no response arrived.',
+                       ('api', 'method', 'endpoint', 'status'))
+apiRetries = Counter('zalert_api_retries_total', 'API requests sent again by the client.', ('api', 'endpoint', 'reason'))
+apiBytesSent = Counter('zalert_api_sent_bytes_total', 'Request body bytes sent to the API.', ('api',))
+apiBytesReceived = Counter('zalert_api_received_bytes_total', 'Response body bytes received from the API.', ('api',))
+alertSeconds = Histogram('zalert_alert_seconds', 'End-to-end time to handle one Zabbix event.', ('outcome',), ALERT_BUCKETS)
+tickets = Counter('zalert_tickets_total', 'ConnectWise tickets created and closed.', ('action',))
+
+METRICS = (apiSeconds, apiResponses, apiRetries, apiBytesSent, apiBytesReceived, alertSeconds, tickets)
+
+_idPattern = re.compile(r'/\d+(?=/|$)')
+
+
+def endpoint(path):
+    """
+    :param path: A ConnectWise URL path, e.g. '/service/tickets/123/notes'.
+    :return: The path with ids replaced, e.g. '/service/tickets/{id}/notes', so each endpoint is one series.
+    """
+    return _idPattern.sub('/{id}', path)
+
+
+def observeRequest(api, method, endpointName, seconds, response=None, sent=0):
+    """
+    Records one HTTP request.
+    :param api: 'cw' or 'zabbix'.
+    :param method: HTTP method for ConnectWise; JSON-RPC method (or batch label) for Zabbix.
+    :param endpointName: The endpoint label.
+    :param seconds: Time taken by the request.
+    :param response: The response, or None if the request raised.
+    :param sent: Request body size in bytes.
+    """
+    apiSeconds.observe(seconds, api, method, endpointName)
+    apiResponses.inc(api, method, endpointName, response.status_code if response is not None else 'error')
+    if sent:
+        apiBytesSent.inc(api, amount=sent)
+    if response is not None:
+        apiBytesReceived.inc(api, amount=len(response.content))
+
+
+def samples():
+    """
+    :return: List of (metric, [(series, value), ...]) for every metric in this process.
+    """
+    return [(metric, metric.samples()) for metric in METRICS]
+
+
+def render(families=None):
+    """
+    :param families: Output of samples() or of merging into a textfile; defaults to this process's values.
+    :return: The metrics in the Prometheus text format.
+    """
+    lines = []
+    for metric, series in families if families is not None else samples():
+        if not series:
+            continue
+        lines.append(f'# HELP {metric.name} {metric.help}')
+        lines.append(f'# TYPE {metric.name} {metric.type}')
+        lines.extend(f'{name} {_number(value)}' for name, value in series)
+    return '\n'.join(lines) + '\n' if lines else ''
+
+
+def parseTextfile(text):
+    """
+    :return: Dictionary of series to value from a textfile written by render().
+    """
+    values = {}
+    for line in text.splitlines():
+        if line and not line.startswith('#'):
+            series, value = line.rsplit(' ', 1)
+            values[series] = float(value)
+    return values
+
+
+class TextfileExporter:
+
+    def __init__(self, path):
+        """
+        :param path: The .prom file read by node_exporter's textfile collector.
+        """
+        self.path = path
+        # What this process has already added to the file, so each merge only adds the increase.
+        self.merged = {}
+        self.lock = threading.Lock()
+
+    def merge(self):
+        """Adds what this process recorded since the last merge to the values in the textfile."""
+        import fcntl
+
+        with self.lock:
+            current = samples()
+            with open(self.path + '.lock', 'a') as lockFile:
+                fcntl.flock(lockFile, fcntl.LOCK_EX)
+                try:
+                    with open(self.path) as promFile:
+                        existing = parseTextfile(promFile.read())
+                except FileNotFoundError:
+                    existing = {}
+                families = []
+                for metric, series in current:
+                    merged = []
+                    seen = set()
+                    # Keep the file's order and add series seen for the first time at the end of their family.
+                    for name in existing:
+                        if name.split('{')[0] in (metric.name, metric.name + '_bucket', metric.name + '_sum', metric.name + '_count'):
+                            merged.append([name, existing[name]])
+                            seen.add(name)
+                    positions = {name: index for index, (name, value) in enumerate(merged)}
+                    for name, value in series:
+                        delta = value - self.merged.get(name, 0)
+                        if name in positions:
+                            merged[positions[name]][1] += delta
+                        else:
+                            positions[name] = len(merged)
+                            merged.append([name, delta])
+                    families.append((metric, [(name, round(value, 6)) for name, value in merged]))
+                temporary = f'{self.path}.{os.getpid()}.tmp'
+                with open(temporary, 'w') as promFile:
+                    promFile.write(render(families))
+                # node_exporter must never read a half-written file.
+                os.replace(temporary, self.path)
+                self.merged = {name: value for metric, series in current for name, value in series}
+
+    def start(self, interval, debugLog):
+        """
+        Merges from a background thread every interval seconds, for the resident daemon.
+        """
+        def loop():
+            while not stopped.wait(interval):
+                try:
+                    self.merge()
+                except OSError as e:
+                    debugLog(f'Metrics textfile write failed: {e}')
+
+        stopped = threading.Event()
+        threading.Thread(target=loop, name='metrics', daemon=True).start()
+
+
+def exportOnExit(path):
+    """
+    Merges this process's metrics into the textfile when it exits. Used by the per-alert zalert process.
+    """
+    exporter = TextfileExporter(path)
+
+    def merge():
+        try:
+            exporter.merge()
+        except OSError:
+            pass
+
+    atexit.register(merge)
+    return exporter
+
+
+def serve(listen, debugLog):
+    """
+    Serves GET /metrics with this process's values from a background thread.
+    :param listen: 'host:port' to listen on.
+    """
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    host, port = listen.rsplit(':', 1)
+    server = ThreadingHTTPServer((host, int(port)), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+    debugLog(f'Serving metrics on http://{listen}/metrics')
+    return server
+
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] != 'show':
+        print('Usage: zmetrics.py show [textfile]')
+        sys.exit(1)
+    if len(sys.argv) > 2:
+        path = sys.argv[2]
+    else:
+        import zalert
+        path = zalert.settings.metricsTextfile
+    if not path:
+        print('No metrics textfile configured (metricsTextfile).')
+        sys.exit(1)
+    with open(path) as promFile:
+        print(promFile.read(), end='')
+
+
+if __name__ == '__main__':
+    main()
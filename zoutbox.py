@@ -0,0 +1,254 @@
+#! /usr/bin/env python3
+# Durable outbox for ConnectWise writes.
+# Ticket creation, notes and closes are recorded in a SQLite journal before they are sent. A
+# worker sends them in order per event, retries failures with backoff and skips duplicates by
+# idempotency key, so a ConnectWise outage leaves a backlog instead of lost tickets.
+#
+# Usage: zoutbox.py drain | show | retry-failed
+import sys
+import json
+import time
+import random
+import sqlite3
+import threading
+import contextvars
+import zlog
+import ztrace
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+# Raised by an outbox handler for a write that must not be retried, e.g. one ConnectWise rejected.
+# The handler has already reported it (with an error ticket), so the action is only marked failed.
+class ActionFailed(Exception):
+    pass
+
+
+class Outbox:
+
+    def __init__(self, path='/tmp/zalert_outbox.db', maxAttempts=20, retryDelay=30, lease=300):
+        """
+        :param path: Path of the SQLite outbox file.
+        :param maxAttempts: Attempts before an action is marked failed.
+        :param retryDelay: Base delay in seconds between attempts, doubled on each failure up to 15 minutes.
+        :param lease: Seconds before an action claimed by a process that died is handed out again.
+        """
+        self.path = path
+        self.maxAttempts = maxAttempts
+        self.retryDelay = retryDelay
+        self.lease = lease
+        with self._connect() as db:
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('CREATE TABLE IF NOT EXISTS actions (seq INTEGER PRIMARY KEY AUTOINCREMENT, key TEXT UNIQUE, eventId TEXT, kind TEXT, '
+                       'payload TEXT, state TEXT, attempts INTEGER DEFAULT 0, nextAttempt REAL, result TEXT, error TEXT, created REAL)')
+            db.execute('CREATE INDEX IF NOT EXISTS actionsDue ON actions (state, nextAttempt)')
+            db.execute('CREATE INDEX IF NOT EXISTS actionsEvent ON actions (eventId, seq)')
+
+    @contextmanager
+    def _connect(self):
+        # A short-lived connection per operation keeps this safe across daemon threads and processes.
+        db = sqlite3.connect(self.path, timeout=10)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def add(self, eventId, kind, payload, key=None):
+        """
+        :param eventId: The Zabbix event the write belongs to. Writes for one event are sent in the order added.
+        :param kind: The action name, used to pick the handler.
+        :param payload: JSON-serializable arguments for the handler.
+        :param key: Idempotency key. An action with a key already in the outbox is not added again.
+        :return: The sequence number of the new action, or None if the key was already present.
+        """
+        with self._connect() as db:
+            cursor = db.execute('INSERT OR IGNORE INTO actions (key, eventId, kind, payload, state, nextAttempt, created) VALUES (?, ?, ?, ?, ?, 0, ?)',
+                                (key, str(eventId), kind, json.dumps(payload), PENDING, time.time()))
+            return cursor.lastrowid if cursor.rowcount else None
+
+    def state(self, key):
+        """
+        :param key: Idempotency key of an action.
+        :return: The action's state, or None if there is no such action.
+        """
+        with self._connect() as db:
+            row = db.execute('SELECT state FROM actions WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def claim(self, limit=10, eventId=None, eventIds=None):
+        """
+        Claims due actions for sending. Only the oldest unfinished action of each event is returned,
+        so an event's writes go out in order and several events can be sent in parallel.
+        :param limit: Maximum number of actions to claim.
+        :param eventId: Only claim actions for this event.
+        :param eventIds: Only claim actions for these events.
+        :return: List of action dictionaries with seq, key, eventId, kind, payload and attempts.
+        """
+        now = time.time()
+        query = ('SELECT seq, key, eventId, kind, payload, attempts FROM actions a '
+                 'WHERE (state = ? AND nextAttempt <= ? OR state = ? AND nextAttempt <= ?) '
+                 'AND NOT EXISTS (SELECT 1 FROM actions b WHERE b.eventId = a.eventId AND b.seq < a.seq AND b.state IN (?, ?)) ')
+        args = [PENDING, now, RUNNING, now, PENDING, RUNNING]
+        if eventId is not None:
+            query += 'AND eventId = ? '
+            args.append(str(eventId))
+        if eventIds is not None:
+            query += 'AND eventId IN (SELECT value FROM json_each(?)) '
+            args.append(json.dumps([str(event) for event in eventIds]))
+        query += 'ORDER BY seq LIMIT ?'
+        args.append(limit)
+        with self._connect() as db:
+            db.execute('BEGIN IMMEDIATE')
+            rows = db.execute(query, args).fetchall()
+            db.executemany('UPDATE actions SET state = ?, nextAttempt = ? WHERE seq = ?', [(RUNNING, now + self.lease, row[0]) for row in rows])
+        return [{'seq': seq, 'key': key, 'eventId': eventId, 'kind': kind, 'payload': json.loads(payload), 'attempts': attempts}
+                for seq, key, eventId, kind, payload, attempts in rows]
+
+    def complete(self, seq, result=None):
+        with self._connect() as db:
+            db.execute('UPDATE actions SET state = ?, result = ?, error = NULL WHERE seq = ?', (DONE, json.dumps(result), seq))
+
+    def fail(self, seq, error):
+        with self._connect() as db:
+            db.execute('UPDATE actions SET state = ?, error = ? WHERE seq = ?', (FAILED, str(error), seq))
+
+    def retry(self, seq, error):
+        """
+        Puts an action back for another attempt after a backoff delay.
+        :return: False if the action has used all its attempts and was marked failed instead.
+        """
+        with self._connect() as db:
+            attempts = db.execute('UPDATE actions SET attempts = attempts + 1 WHERE seq = ? RETURNING attempts', (seq,)).fetchone()[0]
+            if attempts >= self.maxAttempts:
+                db.execute('UPDATE actions SET state = ?, error = ? WHERE seq = ?', (FAILED, str(error), seq))
+                return False
+            delay = min(self.retryDelay * 2 ** (attempts - 1), 900) * random.uniform(0.8, 1.2)
+            db.execute('UPDATE actions SET state = ?, error = ?, nextAttempt = ? WHERE seq = ?', (PENDING, str(error), time.time() + delay, seq))
+        return True
+
+    def retryFailed(self):
+        """Puts every failed action back in the queue with its attempts reset."""
+        with self._connect() as db:
+            return db.execute('UPDATE actions SET state = ?, attempts = 0, nextAttempt = 0 WHERE state = ?', (PENDING, FAILED)).rowcount
+
+    def counts(self):
+        """
+        :return: Dictionary of action state to number of actions.
+        """
+        with self._connect() as db:
+            return dict(db.execute('SELECT state, COUNT(*) FROM actions GROUP BY state').fetchall())
+
+    def show(self, states=(PENDING, RUNNING, FAILED)):
+        """
+        :return: List of (seq, event id, kind, state, attempts, error) rows for unfinished actions.
+        """
+        with self._connect() as db:
+            return db.execute(f'SELECT seq, eventId, kind, state, attempts, error FROM actions WHERE state IN ({",".join("?" * len(states))}) ORDER BY seq',
+                              states).fetchall()
+
+
+class OutboxWorker:
+
+    def __init__(self, outbox, handlers, debugLog, onFailed=None, maxWorkers=4, interval=1.0):
+        """
+        :param outbox: The Outbox to drain.
+        :param handlers: Dictionary of action kind to callable(payload, action) that performs the write.
+                         Raising an exception schedules a retry; ActionFailed marks the action failed without retrying.
+        :param debugLog: Callable used to write debug messages.
+        :param onFailed: Callable(action, error) run when an action has used all its attempts.
+        :param maxWorkers: Maximum number of events sent at the same time.
+        :param interval: Seconds between polls of the outbox when running in the background.
+        """
+        self.outbox = outbox
+        self.handlers = handlers
+        self.debugLog = debugLog
+        self.onFailed = onFailed
+        self.maxWorkers = maxWorkers
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def process(self, action):
+        handler = self.handlers[action['kind']]
+        try:
+            with zlog.context(event=action['eventId']), ztrace.span(f'outbox {action["kind"]}', attempt=action['attempts'] + 1):
+                result = handler(action['payload'], action)
+        except ActionFailed as e:
+            # The handler already reported the failure (e.g. with an error ticket).
+            self.outbox.fail(action['seq'], e)
+            return None
+        except Exception as e:
+            self.debugLog(f'Outbox {action["kind"]} for event {action["eventId"]} failed (attempt {action["attempts"] + 1}): {e}')
+            if not self.outbox.retry(action['seq'], e) and self.onFailed:
+                try:
+                    self.onFailed(action, e)
+                except Exception as e:
+                    self.debugLog(f'Outbox failure report for event {action["eventId"]} failed: {e}')
+            return None
+        self.outbox.complete(action['seq'], result)
+        return result
+
+    def drain(self, eventId=None, limit=50, eventIds=None):
+        """
+        Sends due actions until none are left. A failed action is rescheduled, and the later
+        actions of its event wait for it.
+        :param eventId: Only send actions for this event.
+        :param eventIds: Only send actions for these events, in parallel across events.
+        :param limit: Maximum number of actions claimed per round.
+        :return: Dictionary of action key to handler result for every action attempted.
+        """
+        results = {}
+        with ThreadPoolExecutor(max_workers=self.maxWorkers) as executor:
+            while True:
+                actions = self.outbox.claim(limit, eventId, eventIds)
+                if not actions:
+                    return results
+                # Each action runs in a copy of the caller's context, so an inline drain keeps the alert's trace.
+                futures = [executor.submit(contextvars.copy_context().run, self.process, action) for action in actions]
+                for action, future in zip(actions, futures):
+                    results[action['key']] = future.result()
+
+    def start(self):
+        """Drains the outbox from a background thread until stop() is called."""
+        self.thread = threading.Thread(target=self._loop, name='outbox', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join(timeout=10)
+
+    def _loop(self):
+        while not self.stopped.is_set():
+            try:
+                self.drain()
+            except Exception as e:
+                self.debugLog(f'Outbox worker error: {e}')
+            self.stopped.wait(self.interval)
+
+
+def main():
+    import zalert
+
+    command = sys.argv[1] if len(sys.argv) > 1 else 'show'
+    if command == 'drain':
+        results = zalert.outboxWorker.drain()
+        print(f'Sent {len(results)} actions, outbox now {zalert.outbox.counts()}')
+    elif command == 'show':
+        for row in zalert.outbox.show():
+            print('\t'.join(str(value) for value in row))
+    elif command == 'retry-failed':
+        print(f'Requeued {zalert.outbox.retryFailed()} actions')
+    else:
+        print('Usage: zoutbox.py drain | show | retry-failed')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
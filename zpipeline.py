@@ -0,0 +1,109 @@
+#! /usr/bin/env python3
+# Small dependency-graph executor for the zalert ticket workflow.
+# Each stage declares the values it needs and the values it produces. A run only executes
+# the stages needed for the requested outputs, starts every stage as soon as its inputs are
+# ready (independent stages run in parallel) and records how long each stage took.
+import time
+import contextvars
+import zlog
+import ztrace
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+
+class Stage:
+
+    def __init__(self, name, func, inputs=(), outputs=()):
+        """
+        :param name: Stage name used in timings and errors.
+        :param func: Callable taking the inputs as keyword arguments. Returns the value for a single
+                     output, or a dictionary of output name to value for several outputs.
+        :param inputs: Names of the values the stage needs.
+        :param outputs: Names of the values the stage produces.
+        """
+        self.name = name
+        self.func = func
+        self.inputs = tuple(inputs)
+        self.outputs = tuple(outputs)
+
+    def run(self, values):
+        result = self.func(**{name: values[name] for name in self.inputs})
+        if len(self.outputs) == 1:
+            return {self.outputs[0]: result}
+        return {name: result[name] for name in self.outputs}
+
+
+class Pipeline:
+
+    def __init__(self, stages, maxWorkers=4):
+        """
+        :param stages: List of Stage objects. Each output name must be produced by only one stage.
+        :param maxWorkers: Maximum number of stages run at the same time.
+        """
+        self.stages = stages
+        self.maxWorkers = maxWorkers
+        self.producers = {}
+        for stage in stages:
+            for output in stage.outputs:
+                if output in self.producers:
+                    raise ValueError(f'Output {output} is produced by both {self.producers[output].name} and {stage.name}')
+                self.producers[output] = stage
+        self.timings = {}
+
+    def plan(self, values, wanted):
+        """
+        :param values: Values already available.
+        :param wanted: Names of the values the caller needs.
+        :return: List of the stages that must run to produce the wanted values.
+        """
+        needed = []
+        pending = [name for name in wanted if name not in values]
+        while pending:
+            name = pending.pop()
+            stage = self.producers.get(name)
+            if stage is None:
+                raise KeyError(f'No stage produces {name}')
+            if stage in needed:
+                continue
+            needed.append(stage)
+            pending.extend(input for input in stage.inputs if input not in values)
+        return needed
+
+    def run(self, values, wanted):
+        """
+        Runs the stages needed for the wanted values, adding every produced value to values.
+        The first stage to raise (including SystemExit) stops the run and the exception is re-raised.
+        :param values: Dictionary of available values. Updated in place.
+        :param wanted: Names of the values the caller needs.
+        :return: The updated values dictionary.
+        """
+        remaining = self.plan(values, wanted)
+        if not remaining:
+            return values
+
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.maxWorkers) as executor:
+            try:
+                while remaining or running:
+                    for stage in [stage for stage in remaining if all(name in values for name in stage.inputs)]:
+                        remaining.remove(stage)
+                        # Each stage runs in a copy of the caller's context, so its log records keep the event id.
+                        running[executor.submit(contextvars.copy_context().run, self._timed, stage, values)] = stage
+                    if not running:
+                        raise RuntimeError(f'Stages cannot run, missing inputs: {[stage.name for stage in remaining]}')
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        running.pop(future)
+                        values.update(future.result())
+            finally:
+                for future in running:
+                    future.cancel()
+        return values
+
+    def _timed(self, stage, values):
+        started = time.monotonic()
+        with zlog.context(stage=stage.name), ztrace.span(f'stage {stage.name}'):
+            try:
+                return stage.run(values)
+            finally:
+                self.timings[stage.name] = round(time.monotonic() - started, 3)
+                zlog.debug('Stage finished', seconds=self.timings[stage.name])
@@ -0,0 +1,130 @@
+#! /usr/bin/env python3
+# Token-bucket rate limiter shared by every zalert process and daemon thread.
+# The bucket lives in a small SQLite file so concurrent alert runs draw from one request budget.
+# Lookups leave a reserve of tokens for writes, so ticket creation still gets through when
+# lookups have used up the budget. A 429 pauses the whole bucket for the Retry-After time.
+import time
+import random
+import sqlite3
+from contextlib import contextmanager
+
+# Request priorities. Writes (ticket creation, notes, closing) may use the reserved tokens.
+PRIORITY_WRITE = 0
+PRIORITY_LOOKUP = 1
+
+
+def retryAfterSeconds(response, default=None):
+    """
+    :param response: HTTP response from a throttled request.
+    :param default: Value returned when the response has no usable Retry-After header.
+    :return: Seconds to wait before the next request, from a Retry-After header in seconds or HTTP-date form.
+    """
+    value = response.headers.get('Retry-After')
+    if not value:
+        return default
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        from email.utils import parsedate_to_datetime
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return default
+
+
+def backoffSeconds(attempt, backoff=0.5, cap=30):
+    """
+    :param attempt: Zero-based retry attempt.
+    :param backoff: Base delay in seconds.
+    :param cap: Maximum delay in seconds.
+    :return: Exponential backoff with full jitter, so throttled processes don't retry in lockstep.
+    """
+    return random.uniform(0, min(cap, backoff * 2 ** attempt))
+
+
+class RateLimiter:
+
+    def __init__(self, path='/tmp/zalert_ratelimit.db', rate=10, burst=20, reserve=5, name='connectwise'):
+        """
+        :param path: Path of the SQLite file holding the shared bucket.
+        :param rate: Requests per second added to the bucket.
+        :param burst: Maximum number of tokens the bucket holds.
+        :param reserve: Tokens lookups must leave in the bucket for writes.
+        :param name: Bucket name, so several APIs can share one file.
+        """
+        self.path = path
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.reserve = min(float(reserve), self.burst - 1)
+        self.name = name
+        self.waited = 0.0
+        db = sqlite3.connect(self.path, timeout=10)
+        try:
+            # WAL mode can't be switched on inside the transaction _connect opens.
+            db.execute('PRAGMA journal_mode=WAL')
+        finally:
+            db.close()
+        with self._connect() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS buckets (name TEXT PRIMARY KEY, tokens REAL, updated REAL, blockedUntil REAL)')
+            db.execute('INSERT OR IGNORE INTO buckets (name, tokens, updated, blockedUntil) VALUES (?, ?, ?, 0)', (name, self.burst, time.time()))
+
+    @contextmanager
+    def _connect(self):
+        # A short-lived connection per operation keeps this safe across daemon threads and processes.
+        db = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+        try:
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                yield db
+            except BaseException:
+                db.execute('ROLLBACK')
+                raise
+            db.execute('COMMIT')
+        finally:
+            db.close()
+
+    def _take(self, priority):
+        # Returns 0 when a token was taken, otherwise the seconds to wait before trying again.
+        floor = 0.0 if priority == PRIORITY_WRITE else self.reserve
+        with self._connect() as db:
+            tokens, updated, blockedUntil = db.execute('SELECT tokens, updated, blockedUntil FROM buckets WHERE name = ?', (self.name,)).fetchone()
+            now = time.time()
+            tokens = min(self.burst, tokens + max(now - updated, 0) * self.rate)
+            if now < blockedUntil:
+                # Paused after a 429; leave the bucket alone until the pause is over.
+                return blockedUntil - now
+            if tokens - 1 >= floor:
+                tokens -= 1
+                wait = 0.0
+            else:
+                wait = (floor + 1 - tokens) / self.rate
+            db.execute('UPDATE buckets SET tokens = ?, updated = ? WHERE name = ?', (tokens, now, self.name))
+        return wait
+
+    def acquire(self, priority=PRIORITY_LOOKUP):
+        """
+        Blocks until the bucket has a token for a request of this priority.
+        :param priority: PRIORITY_WRITE or PRIORITY_LOOKUP.
+        :return: Seconds spent waiting.
+        """
+        started = time.monotonic()
+        while True:
+            wait = self._take(priority)
+            if not wait:
+                break
+            # A little jitter keeps waiting processes from all waking at the same moment.
+            time.sleep(wait + random.uniform(0, 0.05))
+        waited = time.monotonic() - started
+        self.waited += waited
+        return waited
+
+    def penalize(self, seconds):
+        """
+        Pauses the bucket for every process, e.g. for the Retry-After time of a 429 response.
+        :param seconds: Seconds from now before the next request may be sent.
+        """
+        with self._connect() as db:
+            # The bucket starts refilling from empty once the pause is over.
+            db.execute('UPDATE buckets SET blockedUntil = MAX(blockedUntil, ?), tokens = 0, updated = MAX(blockedUntil, ?) WHERE name = ?',
+                       (time.time() + seconds, time.time() + seconds, self.name))
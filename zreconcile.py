@@ -0,0 +1,121 @@
+#! /usr/bin/env python3
+# Bulk reconciliation between open zalert tickets in ConnectWise and Zabbix problems.
+# Pages every open zalert ticket on the given boards, looks up all their problem events in one
+# event.get, and queues closes for the problems Zabbix has resolved. Closes go through the
+# outbox, so they are sent in parallel with the same retries as normal recovery handling.
+import re
+import time
+
+# zalert ticket summaries look like "Host: <host> Problem: <eventid> <name>".
+SUMMARY_EVENT = re.compile(r'Problem:\s*(\d+)')
+
+
+class Reconciler:
+
+    def __init__(self, cwapi, jwzabbixapi, catalog, outbox, outboxWorker, debugLog, chunkSize=500):
+        """
+        :param cwapi: ConnectWiseApi client used to page open tickets.
+        :param jwzabbixapi: JWZabbix client used for the bulk event and alert lookups.
+        :param catalog: CWCatalog for board and closed status ids.
+        :param outbox: Outbox the closes are queued in.
+        :param outboxWorker: OutboxWorker that sends the queued closes.
+        :param debugLog: Callable used to write debug messages.
+        :param chunkSize: Maximum number of event ids sent in one Zabbix call.
+        """
+        self.cwapi = cwapi
+        self.jwzabbixapi = jwzabbixapi
+        self.catalog = catalog
+        self.outbox = outbox
+        self.outboxWorker = outboxWorker
+        self.debugLog = debugLog
+        self.chunkSize = chunkSize
+
+    def openTickets(self, boardId):
+        """
+        :param boardId: The ID of the service ticket board.
+        :return: Generator of open zalert tickets on the board, with id, summary, board and status.
+        """
+        return self.cwapi.iterate('/service/tickets', conditions=f'board/id = {boardId} AND closedFlag = false AND summary like "Host:%Problem:%"',
+                                  orderBy='id asc', pageSize=1000, fields='id,summary,board,status')
+
+    def _chunks(self, ids):
+        ids = list(ids)
+        for start in range(0, len(ids), self.chunkSize):
+            yield ids[start:start + self.chunkSize]
+
+    def run(self, boardNames, dryRun=False):
+        """
+        :param boardNames: Names of the boards to reconcile.
+        :param dryRun: Only report what would be closed.
+        :return: Report dictionary with counts of open and resolved tickets, the ids of the tickets closed
+                 (or queued for retry), the ids still open in Zabbix and the orphaned tickets.
+        """
+        started = time.monotonic()
+        openCount = 0
+        tickets = {}
+        orphans = []
+        closeStatusIds = {}
+        for boardName in boardNames:
+            boardId = self.catalog.getBoardId(boardName)
+            closeStatusIds[boardId] = self.catalog.getClosedStatusId(boardId)
+            for ticket in self.openTickets(boardId):
+                openCount += 1
+                match = SUMMARY_EVENT.search(ticket.get('summary', ''))
+                if match:
+                    tickets[match.group(1)] = ticket
+                else:
+                    orphans.append({'ticketId': ticket['id'], 'summary': ticket.get('summary'), 'reason': 'no event id in summary'})
+
+        events = {}
+        for chunk in self._chunks(tickets):
+            for event in self.jwzabbixapi.getEventsByIds(chunk):
+                events[event['eventid']] = event
+
+        resolved = {}
+        stillOpen = []
+        for eventId, ticket in tickets.items():
+            event = events.get(eventId)
+            if event is None:
+                orphans.append({'ticketId': ticket['id'], 'summary': ticket.get('summary'), 'reason': f'event {eventId} not found in Zabbix'})
+            elif event['r_eventid'] != '0':
+                resolved[eventId] = event
+            else:
+                stillOpen.append(ticket['id'])
+
+        notes = {}
+        for chunk in self._chunks(event['r_eventid'] for event in resolved.values()):
+            for alert in self.jwzabbixapi.getAlertsByEvents(chunk):
+                notes.setdefault(alert['eventid'], alert['message'])
+
+        queued = []
+        queuedEvents = []
+        for eventId, event in resolved.items():
+            ticket = tickets[eventId]
+            if dryRun:
+                queued.append(ticket['id'])
+                continue
+            note = notes.get(event['r_eventid']) or f'Problem {eventId} was resolved in Zabbix; closed by zalert reconcile.'
+            if self.outbox.add(eventId, 'closeTicket', {
+                'ticket': ticket,
+                'note': note,
+                'closeStatusId': closeStatusIds[ticket['board']['id']],
+            }, key=f'reconcile:{eventId}:{ticket["id"]}'):
+                queued.append(ticket['id'])
+                queuedEvents.append(eventId)
+
+        if queued and not dryRun:
+            self.debugLog(f'Reconcile: closing {len(queued)} tickets')
+            # Only this run's events: other events' queued writes are left to their alert or the outbox worker.
+            self.outboxWorker.drain(eventIds=queuedEvents)
+
+        report = {
+            'open': openCount,
+            'resolved': len(resolved),
+            'closing': queued,
+            'stillOpen': stillOpen,
+            'orphans': orphans,
+            'seconds': round(time.monotonic() - started, 3),
+        }
+        if not dryRun:
+            report['outbox'] = self.outbox.counts()
+        return report
@@ -0,0 +1,169 @@
+#! /usr/bin/env python3
+# Zabbix inventory reports.
+# The billing report pages through hosts in chunks and keeps only running counts, so memory
+# stays bounded no matter how many hosts Zabbix has.
+#
+# Usage: zreports.py billing [--csv | --json] [tag name ...]
+#        zreports.py groups [--csv | --json]
+import sys
+import csv
+import json
+from collections import Counter
+from zresolver import companyForGroup, companyForHost
+
+
+class BillingReport:
+
+    def __init__(self, jwzabbixapi, companyTagName, companyPrefixes, defaultCompany='unknown', tags=None, chunkSize=1000):
+        """
+        :param jwzabbixapi: JWZabbix client.
+        :param companyTagName: Lower-case name of the company tag.
+        :param companyPrefixes: Host group name prefixes that carry the company name.
+        :param defaultCompany: Company used for hosts with no company tag or group.
+        :param tags: Only count these tag names (case-insensitive). All tags are counted when empty.
+        :param chunkSize: Number of hosts fetched per call.
+        """
+        self.jwzabbixapi = jwzabbixapi
+        self.companyTagName = companyTagName
+        self.companyPrefixes = companyPrefixes
+        self.defaultCompany = defaultCompany
+        self.tags = {tag.lower() for tag in tags} if tags else None
+        self.chunkSize = chunkSize
+        self.hosts = 0
+        self.companyCounts = Counter()
+        self.tagCounts = Counter()
+        self.companyTagCounts = Counter()
+
+    def add(self, hosts):
+        """
+        Adds one chunk of hosts to the running counts. A host is counted once per tag and value.
+        :param hosts: Host records with 'tags' and 'groups'.
+        """
+        companies = []
+        keys = []
+        for host in hosts:
+            company = companyForHost(host, self.companyTagName, self.companyPrefixes, self.defaultCompany)
+            companies.append(company)
+            for tag, value in {(tag['tag'], tag['value']) for tag in host.get('tags', [])}:
+                if self.tags is None or tag.lower() in self.tags:
+                    keys.append((company, tag, value))
+        # Counter.update counts a whole chunk in one C-level pass.
+        self.hosts += len(hosts)
+        self.companyCounts.update(companies)
+        self.companyTagCounts.update(keys)
+        self.tagCounts.update((tag, value) for company, tag, value in keys)
+
+    def run(self):
+        """
+        :return: The report, after counting every host in Zabbix.
+        """
+        for hosts in self.jwzabbixapi.iterateHosts({
+            "output": ["hostid"],
+            "selectTags": ["tag", "value"],
+            "selectGroups": ["name"]
+        }, self.chunkSize):
+            self.add(hosts)
+        return self
+
+    def rows(self):
+        """
+        :return: Sorted list of (company, tag, value, hosts) rows.
+        """
+        return sorted((company, tag, value, count) for (company, tag, value), count in self.companyTagCounts.items())
+
+    def summary(self):
+        """
+        :return: Dictionary with the total hosts, hosts per company, hosts per tag and value, and the per-company rows.
+        """
+        tags = {}
+        for (tag, value), count in sorted(self.tagCounts.items()):
+            tags.setdefault(tag, {})[value] = count
+        return {
+            'hosts': self.hosts,
+            'companies': dict(sorted(self.companyCounts.items())),
+            'tags': tags,
+            'rows': [{'company': company, 'tag': tag, 'value': value, 'hosts': count} for company, tag, value, count in self.rows()],
+        }
+
+    def writeCsv(self, out):
+        writer = csv.writer(out)
+        writer.writerow(['company', 'tag', 'value', 'hosts'])
+        writer.writerows(self.rows())
+
+    def writeJson(self, out):
+        json.dump(self.summary(), out, indent=2)
+        out.write('\n')
+
+
+class GroupCountReport:
+
+    def __init__(self, jwzabbixapi, companyPrefixes):
+        """
+        :param jwzabbixapi: JWZabbix client.
+        :param companyPrefixes: Host group name prefixes that carry the company name.
+        """
+        self.jwzabbixapi = jwzabbixapi
+        self.companyPrefixes = companyPrefixes
+        self.groupCounts = {}
+        self.companyCounts = {}
+
+    def run(self):
+        """
+        Gets every group's members in one hostgroup.get and counts them locally. A host in several
+        groups of the same company is counted once for that company.
+        :return: The report.
+        """
+        companyHosts = {}
+        for group in self.jwzabbixapi.getHostGroupMembers():
+            hostIds = [host['hostid'] for host in group.get('hosts', [])]
+            self.groupCounts[group['name']] = len(hostIds)
+            company = companyForGroup(group['name'], self.companyPrefixes)
+            if company:
+                companyHosts.setdefault(company, set()).update(hostIds)
+        self.companyCounts = {company: len(hostIds) for company, hostIds in sorted(companyHosts.items())}
+        return self
+
+    def rows(self):
+        """
+        :return: Sorted list of (group name, company, hosts) rows.
+        """
+        return [(name, companyForGroup(name, self.companyPrefixes) or '', count) for name, count in sorted(self.groupCounts.items())]
+
+    def summary(self):
+        """
+        :return: Dictionary with hosts per group and distinct hosts per company.
+        """
+        return {'groups': dict(sorted(self.groupCounts.items())), 'companies': self.companyCounts}
+
+    def writeCsv(self, out):
+        writer = csv.writer(out)
+        writer.writerow(['group', 'company', 'hosts'])
+        writer.writerows(self.rows())
+
+    def writeJson(self, out):
+        json.dump(self.summary(), out, indent=2)
+        out.write('\n')
+
+
+def main():
+    import zalert
+
+    args = sys.argv[1:]
+    command = args.pop(0) if args else ''
+    settings = zalert.settings
+    if command == 'billing':
+        tags = [arg for arg in args if not arg.startswith('--')]
+        report = BillingReport(zalert.jwzabbixapi, settings.companyTagName, settings.companyPrefixes, settings.defaultCompany, tags).run()
+    elif command == 'groups':
+        report = GroupCountReport(zalert.jwzabbixapi, settings.companyPrefixes).run()
+    else:
+        print('Usage: zreports.py billing [--csv | --json] [tag name ...] | groups [--csv | --json]')
+        sys.exit(1)
+    if '--json' in args:
+        report.writeJson(sys.stdout)
+    else:
+        report.writeCsv(sys.stdout)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,314 @@
+#! /usr/bin/env python3
+# Local host-to-company resolution.
+# Keeps a SQLite map of Zabbix host id to company short name, filled in bulk from host.get, so
+# resolving an alert's company is a local lookup instead of a host.get. Between full syncs the
+# daemon's sync thread refetches only the hosts the Zabbix audit log shows as changed. A host
+# missing from the map, or an entry nothing has confirmed within the TTL, is fetched on its own
+# and stored. Company records come from the ConnectWise company directory (zcompanies.py), which
+# the sync thread keeps current too.
+#
+# Usage: zresolver.py rebuild | sync | show | host <hostid> | company <identifier or name>
+import sys
+import time
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+# What host.get returns for working out a host's company.
+HOST_COMPANY_FIELDS = {
+    "output": ["hostid"],
+    "selectTags": ["tag", "value"],
+    "selectGroups": ["name"]
+}
+# auditlog.get resource types and actions.
+AUDIT_HOST = 4
+AUDIT_HOST_GROUP = 14
+AUDIT_DELETE = 2
+# Seconds the audit log is read back before the last sync started, for clock skew between zalert and Zabbix.
+AUDIT_OVERLAP = 60
+
+
+def companyForGroup(groupName, companyPrefixes):
+    """
+    :param groupName: Host group name, e.g. "Customers/acme/Linux".
+    :param companyPrefixes: Host group name prefixes that carry the company name.
+    :return: The lower-case company name from a "<prefix>/<company>" group, or None.
+    """
+    if any(groupName.startswith(prefix) for prefix in companyPrefixes):
+        groupmatch = groupName.split('/')
+        if len(groupmatch) > 1:
+            return groupmatch[1].lower()
+    return None
+
+
+def companyForHost(host, companyTagName, companyPrefixes, defaultCompany):
+    """
+    Same rules as zalert.getCompanyForTicket: the company tag first, then a "<prefix>/<company>" host group.
+    :param host: Host record with 'tags' and 'groups'.
+    :param companyTagName: Lower-case name of the company tag.
+    :param companyPrefixes: Host group name prefixes that carry the company name.
+    :param defaultCompany: Company used when neither tag nor group names one.
+    :return: The company short name for the host.
+    """
+    for tag in host.get('tags', []):
+        if tag['tag'].lower() == companyTagName:
+            return tag['value']
+    for group in host.get('groups', []):
+        company = companyForGroup(group['name'], companyPrefixes)
+        if company:
+            return company
+    return defaultCompany
+
+
+class CompanyResolver:
+
+    def __init__(self, cwapi, jwzabbixapi, path='/tmp/zalert_companies.db', ttl=3600, interval=300, fullInterval=86400, chunkSize=1000):
+        """
+        :param cwapi: ConnectWiseApi client used for company lookups; its company directory, if any, is synced with the hosts.
+        :param jwzabbixapi: JWZabbix client used for host syncs and lookups.
+        :param path: Path of the SQLite resolver file.
+        :param ttl: Seconds an entry is trusted after it was fetched or after the last host sync, whichever is later.
+        :param interval: Seconds between the sync thread's incremental host syncs.
+        :param fullInterval: Seconds between full host syncs.
+        :param chunkSize: Number of hosts fetched per host.get during a sync.
+        """
+        self.cwapi = cwapi
+        self.jwzabbixapi = jwzabbixapi
+        self.path = path
+        self.ttl = ttl
+        self.interval = interval
+        self.fullInterval = fullInterval
+        self.chunkSize = chunkSize
+        self.stopped = threading.Event()
+        self.thread = None
+        with self._connect() as db:
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('CREATE TABLE IF NOT EXISTS hosts (hostid TEXT PRIMARY KEY, company TEXT COLLATE NOCASE, fetched REAL)')
+            db.execute('CREATE TABLE IF NOT EXISTS syncs (kind TEXT PRIMARY KEY, finished REAL, mark REAL)')
+            if 'mark' not in [column[1] for column in db.execute('PRAGMA table_info(syncs)')]:
+                # Files written before incremental syncs.
+                db.execute('ALTER TABLE syncs ADD COLUMN mark REAL')
+
+    @contextmanager
+    def _connect(self):
+        # A short-lived connection per operation keeps this safe across daemon threads and processes.
+        db = sqlite3.connect(self.path, timeout=10)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def _fresh(self, fetched):
+        return fetched is not None and time.time() - fetched < self.ttl
+
+    def _syncs(self):
+        # kind -> (finished, mark). mark is when a host sync started; the next incremental sync reads the audit log from there.
+        with self._connect() as db:
+            return {kind: (finished, mark) for kind, finished, mark in db.execute('SELECT kind, finished, mark FROM syncs')}
+
+    def company(self, identifier):
+        """
+        :param identifier: The company identifier or name, matched without regard to case like ConnectWise does.
+        :return: The CWCompany, or None if ConnectWise has no such company.
+        """
+        return self.cwapi.getCompanyRecord(identifier)
+
+    def hostCompany(self, hostid, companyTagName, companyPrefixes, defaultCompany):
+        """
+        :param hostid: The Zabbix host id.
+        :param companyTagName: Lower-case name of the company tag.
+        :param companyPrefixes: Host group name prefixes that carry the company name.
+        :param defaultCompany: Company used when neither tag nor group names one.
+        :return: The company short name for the host.
+        """
+        with self._connect() as db:
+            # An entry is current as of its own fetch or the last host sync, which would have refetched it had it changed.
+            row = db.execute("SELECT company, MAX(fetched, IFNULL((SELECT MAX(finished) FROM syncs WHERE kind IN ('hosts', 'hostsDelta')), 0)) "
+                             'FROM hosts WHERE hostid = ?', (str(hostid),)).fetchone()
+        if row and self._fresh(row[1]):
+            return row[0]
+
+        hosts = self.jwzabbixapi.zabbixAPIResult('host.get', {**HOST_COMPANY_FIELDS, "hostids": [hostid]})
+        company = companyForHost(hosts[0], companyTagName, companyPrefixes, defaultCompany) if hosts else defaultCompany
+        with self._connect() as db:
+            db.execute('INSERT OR REPLACE INTO hosts (hostid, company, fetched) VALUES (?, ?, ?)', (str(hostid), company, time.time()))
+        return company
+
+    def resolveHost(self, hostid, companyTagName, companyPrefixes, defaultCompany):
+        """
+        :param hostid: The Zabbix host id.
+        :return: Tuple of (company short name, CWCompany or None if ConnectWise has no such company).
+        """
+        company = self.hostCompany(hostid, companyTagName, companyPrefixes, defaultCompany)
+        return company, self.company(company)
+
+    def syncCompanies(self):
+        """
+        Brings the ConnectWise company directory up to date, with a delta sync unless a full one is due.
+        :return: The directory's sync result, or None if the client has no directory.
+        """
+        result = self.cwapi.companies.sync() if self.cwapi.companies is not None else None
+        with self._connect() as db:
+            db.execute('INSERT OR REPLACE INTO syncs (kind, finished) VALUES (?, ?)', ('companies', time.time()))
+        return result
+
+    def syncHosts(self, companyTagName, companyPrefixes, defaultCompany):
+        """
+        Replaces the host map with every host in Zabbix, fetched in chunks.
+        :return: Number of hosts stored.
+        """
+        started = time.time()
+        rows = []
+        for hosts in self.jwzabbixapi.iterateHosts(HOST_COMPANY_FIELDS, self.chunkSize):
+            rows.extend((host['hostid'], companyForHost(host, companyTagName, companyPrefixes, defaultCompany), started) for host in hosts)
+        with self._connect() as db:
+            db.execute('DELETE FROM hosts')
+            db.executemany('INSERT OR REPLACE INTO hosts (hostid, company, fetched) VALUES (?, ?, ?)', rows)
+            db.execute('INSERT OR REPLACE INTO syncs (kind, finished, mark) VALUES (?, ?, ?)', ('hosts', time.time(), started))
+            db.execute('DELETE FROM syncs WHERE kind = ?', ('hostsDelta',))
+        return len(rows)
+
+    def syncChangedHosts(self, companyTagName, companyPrefixes, defaultCompany):
+        """
+        Refetches the hosts added or changed since the last host sync and drops deleted ones. The changes come from
+        the Zabbix audit log; a changed host group (e.g. renamed) refetches its member hosts.
+        :return: Number of hosts refetched or dropped, or None if a full sync is needed instead: none has run yet,
+                 or a host group was deleted, as the audit log does not say which hosts were in it.
+        """
+        syncs = self._syncs()
+        marks = [syncs[kind][1] for kind in ('hosts', 'hostsDelta') if kind in syncs and syncs[kind][1] is not None]
+        if 'hosts' not in syncs or not marks:
+            return None
+        started = time.time()
+        changes = self.jwzabbixapi.zabbixAPIResult('auditlog.get', {
+            "output": ["resourcetype", "resourceid", "action"],
+            "filter": {"resourcetype": [AUDIT_HOST, AUDIT_HOST_GROUP]},
+            "time_from": int(max(marks)) - AUDIT_OVERLAP,
+            "sortfield": "clock"
+        })
+        changedHosts, deletedHosts, changedGroups = set(), set(), set()
+        for change in changes:
+            deleted = int(change['action']) == AUDIT_DELETE
+            if int(change['resourcetype']) == AUDIT_HOST_GROUP:
+                if deleted:
+                    return None
+                changedGroups.add(change['resourceid'])
+            elif deleted:
+                deletedHosts.add(change['resourceid'])
+            else:
+                changedHosts.add(change['resourceid'])
+
+        hosts = self.jwzabbixapi.zabbixAPIResult('host.get', {**HOST_COMPANY_FIELDS, "groupids": sorted(changedGroups)}) if changedGroups else []
+        changedHosts = sorted(changedHosts - deletedHosts - {host['hostid'] for host in hosts}, key=int)
+        for start in range(0, len(changedHosts), self.chunkSize):
+            hosts.extend(self.jwzabbixapi.zabbixAPIResult('host.get', {**HOST_COMPANY_FIELDS, "hostids": changedHosts[start:start + self.chunkSize]}))
+
+        rows = [(host['hostid'], companyForHost(host, companyTagName, companyPrefixes, defaultCompany), started) for host in hosts]
+        with self._connect() as db:
+            db.executemany('DELETE FROM hosts WHERE hostid = ?', [(hostid,) for hostid in deletedHosts])
+            db.executemany('INSERT OR REPLACE INTO hosts (hostid, company, fetched) VALUES (?, ?, ?)', rows)
+            db.execute('INSERT OR REPLACE INTO syncs (kind, finished, mark) VALUES (?, ?, ?)', ('hostsDelta', time.time(), started))
+        return len(rows) + len(deletedHosts)
+
+    def sync(self, companyTagName, companyPrefixes, defaultCompany):
+        """
+        Brings the host map up to date with an incremental sync, or a full one if that is needed or due.
+        :return: Dictionary with the kind of host sync and the number of hosts it stored or dropped.
+        """
+        syncs = self._syncs()
+        if 'hosts' in syncs and time.time() - syncs['hosts'][0] < self.fullInterval:
+            changed = self.syncChangedHosts(companyTagName, companyPrefixes, defaultCompany)
+            if changed is not None:
+                return {'sync': 'delta', 'hosts': changed}
+        return {'sync': 'full', 'hosts': self.syncHosts(companyTagName, companyPrefixes, defaultCompany)}
+
+    def rebuild(self, companyTagName, companyPrefixes, defaultCompany):
+        """
+        :return: Dictionary with the company directory sync result and the number of hosts stored.
+        """
+        return {'companies': self.syncCompanies(), 'hosts': self.syncHosts(companyTagName, companyPrefixes, defaultCompany)}
+
+    def lastSync(self):
+        """
+        :return: Time of the oldest of the last host and company syncs, or None if either never ran.
+        """
+        syncs = self._syncs()
+        if 'hosts' not in syncs or 'companies' not in syncs:
+            return None
+        return min(max(syncs[kind][0] for kind in ('hosts', 'hostsDelta') if kind in syncs), syncs['companies'][0])
+
+    def start(self, rules, debugLog):
+        """
+        Keeps the maps current from a background thread. Every interval it runs an incremental host sync and, when
+        due, a company directory sync; a full rebuild runs every fullInterval, or once the maps are older than the TTL
+        because incremental syncs keep failing (e.g. the API token may not read the audit log).
+        :param rules: Callable returning the current (companyTagName, companyPrefixes, defaultCompany).
+        :param debugLog: Callable used to write debug messages.
+        """
+        self.thread = threading.Thread(target=self._loop, args=(rules, debugLog), name='resolver', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join(timeout=10)
+
+    def _loop(self, rules, debugLog):
+        while not self.stopped.is_set():
+            syncs = self._syncs()
+            if 'hosts' not in syncs or time.time() - syncs['hosts'][0] >= self.fullInterval or not self._fresh(self.lastSync()):
+                try:
+                    debugLog(f'Company resolver sync: {self.rebuild(*rules())}')
+                except Exception as e:
+                    debugLog(f'Company resolver sync failed: {e}')
+            else:
+                try:
+                    debugLog(f'Company resolver host sync: {self.sync(*rules())}')
+                except Exception as e:
+                    debugLog(f'Company resolver host sync failed: {e}')
+                if self.cwapi.companies is not None and self.cwapi.companies.due():
+                    # Delta syncs between rebuilds keep directory refreshes off the alert path.
+                    try:
+                        debugLog(f'Company directory sync: {self.syncCompanies()}')
+                    except Exception as e:
+                        debugLog(f'Company directory sync failed: {e}')
+            self.stopped.wait(self.interval)
+
+    def show(self):
+        """
+        :return: List of (host id, company, CW company id, deleted flag) rows.
+        """
+        with self._connect() as db:
+            hosts = db.execute('SELECT hostid, company FROM hosts ORDER BY CAST(hostid AS INTEGER)').fetchall()
+        rows = []
+        for hostid, company in hosts:
+            record = self.company(company)
+            rows.append((hostid, company, record.id if record else None, record.deletedFlag if record else None))
+        return rows
+
+
+def main():
+    import zalert
+
+    settings = zalert.settings
+    rules = (settings.companyTagName, settings.companyPrefixes, settings.defaultCompany)
+    command = sys.argv[1] if len(sys.argv) > 1 else 'show'
+    if command == 'rebuild':
+        print(zalert.resolver.rebuild(*rules))
+    elif command == 'sync':
+        print(zalert.resolver.sync(*rules))
+    elif command == 'show':
+        for row in zalert.resolver.show():
+            print('\t'.join(str(value) for value in row))
+    elif command == 'host' and len(sys.argv) > 2:
+        print(zalert.resolver.resolveHost(sys.argv[2], *rules))
+    elif command == 'company' and len(sys.argv) > 2:
+        print(zalert.resolver.company(sys.argv[2]))
+    else:
+        print('Usage: zresolver.py rebuild | sync | show | host <hostid> | company <identifier or name>')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,195 @@
+#! /usr/bin/env python3
+# Lightweight tracing for zalert.
+# processEvent opens one trace per alert. Each pipeline stage and each API request in it becomes
+# a span with its start time, duration, parent span and attributes. Event id, host, board and
+# company are trace attributes, copied onto every span when the trace is written. When the alert
+# finishes, its spans are appended to a JSON-lines file in a single write. Outside a trace, span()
+# costs one context variable lookup.
+#
+# Usage: ztrace.py show [path] [--event <id>]
+import os
+import sys
+import json
+import time
+import itertools
+import contextvars
+from contextlib import contextmanager
+
+currentTrace = contextvars.ContextVar('ztraceTrace', default=None)
+currentSpan = contextvars.ContextVar('ztraceSpan', default=None)
+
+_spanIds = itertools.count(1)
+# The trace finished most recently in this process, for zalert.py --profile.
+lastTrace = None
+
+
+class Span:
+    __slots__ = ('spanId', 'parentId', 'name', 'start', 'monotonic', 'seconds', 'status', 'attributes')
+
+    def __init__(self, name, parentId, attributes):
+        self.spanId = f'{os.getpid():x}-{next(_spanIds):x}'
+        self.parentId = parentId
+        self.name = name
+        self.start = time.time()
+        self.monotonic = time.monotonic()
+        self.seconds = None
+        self.status = 'ok'
+        self.attributes = attributes
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+
+class Trace:
+
+    def __init__(self, eventId):
+        self.traceId = f'{os.getpid():x}-{time.time_ns():x}'
+        self.attributes = {'event': str(eventId)}
+        # Appending to a list is atomic, so stages running in worker threads can add spans directly.
+        self.spans = []
+
+    def records(self):
+        """
+        :return: The finished spans as dictionaries, in start order, with the trace attributes merged in.
+        """
+        records = []
+        for span in sorted(self.spans, key=lambda span: span.monotonic):
+            record = {'trace': self.traceId, 'span': span.spanId, 'parent': span.parentId, 'name': span.name,
+                      'ts': round(span.start, 6), 'seconds': round(span.seconds, 6), 'status': span.status}
+            record.update(self.attributes)
+            record.update(span.attributes)
+            records.append(record)
+        return records
+
+
+@contextmanager
+def span(name, **attributes):
+    """
+    Times the block as a child of the current span. Does nothing outside a trace.
+    :param name: Span name, e.g. 'stage company' or 'cw GET /service/boards'.
+    :param attributes: Attributes for this span only.
+    :return: The Span, or None outside a trace; use span.set() to add attributes known later.
+    """
+    trace = currentTrace.get()
+    if trace is None:
+        yield None
+        return
+    parent = currentSpan.get()
+    current = Span(name, parent.spanId if parent else None, attributes)
+    token = currentSpan.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        # sys.exit(0) is how zalert ends an alert early, not an error.
+        if not (isinstance(e, SystemExit) and not e.code):
+            current.status = f'error: {type(e).__name__}'
+        raise
+    finally:
+        current.seconds = time.monotonic() - current.monotonic
+        currentSpan.reset(token)
+        trace.spans.append(current)
+
+
+def annotate(**attributes):
+    """
+    Adds attributes (host, board, company ...) to the current trace and so to all of its spans.
+    """
+    trace = currentTrace.get()
+    if trace is not None:
+        trace.attributes.update({key: value for key, value in attributes.items() if value is not None})
+
+
+@contextmanager
+def trace(eventId, path=None, maxBytes=10485760):
+    """
+    Traces one alert under a root span named 'alert'.
+    :param eventId: The Zabbix event id.
+    :param path: JSON-lines file the spans are appended to when the block ends; None keeps them in memory only.
+    :param maxBytes: Size at which the file is moved to <path>.1 before writing.
+    :return: The Trace.
+    """
+    global lastTrace
+    current = Trace(eventId)
+    token = currentTrace.set(current)
+    try:
+        with span('alert'):
+            yield current
+    finally:
+        currentTrace.reset(token)
+        lastTrace = current
+        if path:
+            write(path, current.records(), maxBytes)
+
+
+def write(path, records, maxBytes=10485760):
+    data = ''.join(json.dumps(record, default=str) + '\n' for record in records).encode()
+    try:
+        if maxBytes and os.path.exists(path) and os.path.getsize(path) + len(data) > maxBytes:
+            os.replace(path, path + '.1')
+        # One O_APPEND write per trace keeps traces from concurrent alert processes whole.
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+    except OSError:
+        # Tracing must never fail an alert.
+        pass
+
+
+def waterfall(records, width=50):
+    """
+    :param records: Span records of one trace, as returned by Trace.records().
+    :param width: Width of the bar column in characters.
+    :return: The spans as an indented text waterfall, one line per span.
+    """
+    if not records:
+        return ''
+    depth = {}
+    for record in records:
+        depth[record['span']] = depth.get(record['parent'], -1) + 1
+    started = min(record['ts'] for record in records)
+    total = max(record['ts'] + record['seconds'] - started for record in records) or 1e-9
+    lines = [f'{"span":<48} {"start ms":>9} {"ms":>9}  0{"":{width - 6}}{total * 1000:.0f} ms']
+    for record in records:
+        offset = record['ts'] - started
+        first = int(offset / total * width)
+        length = max(1, int(record['seconds'] / total * width))
+        bar = ' ' * first + '#' * min(length, width - first)
+        label = ('  ' * depth[record['span']] + record['name'])[:47]
+        status = '' if record['status'] == 'ok' else f'  {record["status"]}'
+        lines.append(f'{label:<48} {offset * 1000:9.1f} {record["seconds"] * 1000:9.1f}  {bar:<{width}}{status}')
+    return '\n'.join(lines)
+
+
+def main():
+    args = sys.argv[1:]
+    if not args or args[0] != 'show':
+        print('Usage: ztrace.py show [path] [--event <id>]')
+        sys.exit(1)
+    args = args[1:]
+    event = None
+    if '--event' in args:
+        index = args.index('--event')
+        event = args[index + 1]
+        del args[index:index + 2]
+    if args:
+        path = args[0]
+    else:
+        import zalert
+        path = zalert.settings.tracePath
+    traces = {}
+    with open(path) as traceFile:
+        for line in traceFile:
+            record = json.loads(line)
+            if event is None or record.get('event') == event:
+                traces.setdefault(record['trace'], []).append(record)
+    for traceId, records in traces.items():
+        root = records[0]
+        print(f'Trace {traceId} event {root.get("event")} host {root.get("host", "-")} board {root.get("board", "-")} company {root.get("company", "-")}')
+        print(waterfall(records))
+        print()
+
+
+if __name__ == '__main__':
+    main()